@@ -0,0 +1,191 @@
+import argparse
+import hashlib
+import logging
+import os
+import sys
+from multiprocessing import Pool, cpu_count
+
+import orjson
+import pandas as pd
+
+cpu_count = int(os.getenv('SLURM_CPUS_PER_TASK') or cpu_count())
+
+INDEX_COLUMNS = ['object_id', 'path', 'size', 'mtime_ns', 'n_loci', 'loci_hash', 'status', 'error']
+
+
+def loci_path(index_path: str) -> str:
+    """
+    Sidecar of an index with the loci of every distinct locus set, keyed by loci_hash.
+    """
+    return os.path.splitext(index_path)[0] + '_loci.json'
+
+
+def read_loci(path: str, input_format: str = 'json') -> list:
+    """
+    Loci a case or control file is paired on by the cooker: the LocusResults keys of a JSON,
+    the regions of an NDJSON.
+    """
+    if input_format == 'ndjson':
+        with open(path, 'rb') as f:
+            return [orjson.loads(line)['region'] for line in f if line.strip()]
+    with open(path, 'rb') as f:
+        return list(orjson.loads(f.read())['LocusResults'])
+
+
+def scan_file(task) -> tuple:
+    """
+    Index row of one file, and its sorted loci if it decodes.
+    """
+    path, input_format = task
+    stat = os.stat(path)
+    row = {'object_id': os.path.basename(path)[:-len(input_format) - 1], 'path': path,
+           'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'n_loci': 0, 'loci_hash': '', 'status': 'ok', 'error': ''}
+    try:
+        loci = sorted(set(read_loci(path, input_format)))
+    except Exception as e:
+        row['status'] = 'undecodable'
+        row['error'] = str(e)[:200]
+        return row, None
+    row['n_loci'] = len(loci)
+    row['loci_hash'] = hashlib.sha1('\n'.join(loci).encode()).hexdigest()
+    return row, loci
+
+
+def build_index(raw_eh_dir: str, input_format: str = 'json', processes: int = cpu_count, previous: str = None):
+    """
+    Scan the EH output directory in parallel.
+    Files whose size and mtime match a previous index are not decoded again.
+    Args:
+        raw_eh_dir: Directory with the EH outputs.
+        input_format: 'json' or 'ndjson'.
+        previous: Path of a previous index of the directory.
+    Returns:
+        index: One row per file, cols INDEX_COLUMNS.
+        loci: Dict of loci_hash to the sorted loci of that set.
+    """
+    suffix = f'.{input_format}'
+    paths = sorted(os.path.join(raw_eh_dir, name) for name in os.listdir(raw_eh_dir) if name.endswith(suffix))
+
+    rows, loci = [], {}
+    if previous and os.path.exists(previous):
+        old = pd.read_csv(previous, keep_default_na=False).set_index('path')
+        with open(loci_path(previous), 'rb') as f:
+            old_loci = orjson.loads(f.read())
+        todo = []
+        for path in paths:
+            stat = os.stat(path)
+            if path in old.index and old.at[path, 'size'] == stat.st_size and old.at[path, 'mtime_ns'] == stat.st_mtime_ns:
+                row = old.loc[path].to_dict()
+                row['path'] = path
+                rows.append(row)
+                if row['loci_hash']:
+                    loci[row['loci_hash']] = old_loci[row['loci_hash']]
+            else:
+                todo.append(path)
+        logging.info(f'{len(paths) - len(todo)} files unchanged since {previous}.')
+        paths = todo
+
+    with Pool(processes=processes) as pool:
+        for i, (row, file_loci) in enumerate(pool.imap_unordered(scan_file, [(path, input_format) for path in paths],
+                                                                  chunksize=16)):
+            rows.append(row)
+            if file_loci is not None:
+                loci.setdefault(row['loci_hash'], file_loci)
+            if (i + 1) % 1000 == 0:
+                logging.info(f'Scanned {i + 1}/{len(paths)} files.')
+
+    index = pd.DataFrame(rows, columns=INDEX_COLUMNS).sort_values('path').reset_index(drop=True)
+    return index, loci
+
+
+def save_index(index: pd.DataFrame, loci: dict, path: str) -> None:
+    index.to_csv(path, index=False)
+    with open(loci_path(path), 'wb') as f:
+        f.write(orjson.dumps(loci))
+
+
+def load_index(path: str):
+    """
+    Returns:
+        index: The index rows, keyed by file name.
+        loci: Dict of loci_hash to the set of loci.
+    """
+    index = pd.read_csv(path, keep_default_na=False, dtype={'object_id': str, 'loci_hash': str})
+    index.index = index['path'].map(os.path.basename)
+    with open(loci_path(path), 'rb') as f:
+        loci = {key: set(values) for key, values in orjson.loads(f.read()).items()}
+    return index, loci
+
+
+def validate_manifest(manifest: pd.DataFrame, index: pd.DataFrame, loci: dict, input_format: str = 'json') -> pd.DataFrame:
+    """
+    Check every case and control pair of a manifest against the index, before any compute.
+    A pair is invalid if a file is missing or undecodable, or if the control lacks loci of the case,
+    which would raise a KeyError in the locus loop of the cooker.
+    Returns:
+        report: One row per manifest row with 'issue' empty for valid pairs.
+    """
+    def lookup(object_id):
+        name = f'{object_id}.{input_format}'
+        return index.loc[name] if name in index.index else None
+
+    issues = []
+    for donor in manifest.to_dict('records'):
+        case = lookup(donor['case_object_id'])
+        control = lookup(donor['control_object_id'])
+        issue = ''
+        if case is None and control is None:
+            issue = 'missing_both'
+        elif case is None:
+            issue = 'missing_case'
+        elif control is None:
+            issue = 'missing_control'
+        elif case['status'] != 'ok':
+            issue = 'undecodable_case'
+        elif control['status'] != 'ok':
+            issue = 'undecodable_control'
+        elif case['loci_hash'] != control['loci_hash']:
+            missing = len(loci[case['loci_hash']] - loci[control['loci_hash']])
+            # extra control loci are ignored by the cooker, missing ones are not
+            if missing and input_format == 'json':
+                issue = f'control_missing_{missing}_case_loci'
+        issues.append({'donor_id': donor['donor_id'], 'case_object_id': donor['case_object_id'],
+                       'control_object_id': donor['control_object_id'], 'issue': issue})
+    return pd.DataFrame(issues)
+
+
+def init_argparse():
+    parser = argparse.ArgumentParser(description='Index an Expansion Hunter output directory and validate a manifest against it.')
+    parser.add_argument('raw_eh', metavar='RawDir', type=str, help='Directory with Expansion Hunter outputs.')
+    parser.add_argument('--output', '-o', required=True, help='Index csv, the loci sets are written next to it as {index}_loci.json.')
+    parser.add_argument('--input-format', default='json', choices=['json', 'ndjson'], help='Format of the files in RawDir. (Default: json)')
+    parser.add_argument('--processes', '-p', type=int, default=cpu_count, help='Scan processes. (Default: SLURM_CPUS_PER_TASK or all CPUs)')
+    parser.add_argument('--update', default=False, action='store_true', help='Reuse the rows of an existing index for files with unchanged size and mtime. (Default: False)')
+    parser.add_argument('--manifest', '-m', default=None, help='Manifest to validate against the index.')
+    parser.add_argument('--report', '-r', default=None, help='Validation report csv. (Default: {index}_validation.csv)')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    args = init_argparse().parse_args()
+
+    index, loci = build_index(args.raw_eh, args.input_format, args.processes, args.output if args.update else None)
+    save_index(index, loci, args.output)
+    logging.info(f'Indexed {len(index)} files ({(index["status"] != "ok").sum()} undecodable, {len(loci)} locus sets) to {args.output}')
+
+    if args.manifest:
+        index, loci = load_index(args.output)
+        report = validate_manifest(pd.read_csv(args.manifest), index, loci, args.input_format)
+        report_path = args.report or os.path.splitext(args.output)[0] + '_validation.csv'
+        report.to_csv(report_path, index=False)
+        invalid = report[report['issue'] != '']
+        for row in invalid.itertuples():
+            logging.error(f'{row.donor_id}: {row.issue}')
+        logging.info(f'{len(invalid)}/{len(report)} manifest pairs invalid, report saved to {report_path}')
+        if len(invalid):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
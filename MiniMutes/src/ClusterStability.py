@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# DBSCAN1D parameters of ExpansionFeatureExtractor.cluster_and_outliers
+EPS = 2
+# Empty bins around every locus histogram, so windows of +-EPS never reach the next locus
+PAD = EPS
+# Bins per chunk of loci in bootstrap_stability, the working set is about 10 * batch_size * CHUNK_BINS floats
+CHUNK_BINS = 50_000
+
+STABILITY_COLUMNS = ['ReferenceRegion', 'stability', 'stability_num_clusters']
+
+
+def min_samples(n: np.ndarray) -> np.ndarray:
+    """
+    min_samples of cluster_and_outliers for n values: 2/3 of int(sqrt(n)), at least 4.
+    """
+    return np.maximum(np.sqrt(n).astype(int) * 2 / 3, 4)
+
+
+class HistogramLayout:
+    """
+    All loci of a block as one flat array of integer value bins, locus l covering
+    starts[l]:starts[l] + widths[l] for the values mins[l]... , separated by PAD empty bins.
+    The donor values are a sparse one-hot matrix of donors by bins, so the histograms of
+    any weighting of the donors (e.g. bootstrap draw counts) are one sparse product.
+    """
+
+    def __init__(self, values: np.ndarray):
+        num_rows, num_loci = values.shape
+        observed = ~np.isnan(values)
+        has_values = observed.any(axis=0)
+        mins = np.where(observed, values, np.inf).min(axis=0)
+        maxs = np.where(observed, values, -np.inf).max(axis=0)
+        self.mins = np.where(has_values, mins, 0).astype(np.int64)
+        self.widths = np.where(has_values, maxs - self.mins + 1, 0).astype(np.int64)
+        self.starts = PAD + np.concatenate([[0], np.cumsum(self.widths + PAD)[:-1]]).astype(np.int64)
+        self.num_bins = int(self.starts[-1] + self.widths[-1] + PAD) if num_loci else PAD
+        self.num_loci = num_loci
+
+        # locus and value of every bin, pads take the locus before them and never hold counts
+        self.bin_locus = np.repeat(np.arange(num_loci), self.widths + PAD)
+        self.bin_locus = np.concatenate([np.zeros(PAD, dtype=np.int64), self.bin_locus])[:self.num_bins]
+        self.bin_values = (np.arange(self.num_bins) - self.starts[self.bin_locus] + self.mins[self.bin_locus]).astype(float)
+
+        rows, cols = np.nonzero(observed)
+        codes = self.starts[cols] + (values[rows, cols].astype(np.int64) - self.mins[cols])
+        self.onehot = sparse.csr_matrix((np.ones(len(rows)), (rows, codes)), shape=(num_rows, self.num_bins))
+
+    def histograms(self, weights: np.ndarray) -> np.ndarray:
+        """
+        Histograms of all loci for every row of donor weights.
+        Args:
+            weights: (batch, donors) counts of each donor.
+        Returns:
+            hists: (batch, num_bins)
+        """
+        return np.asarray(self.onehot.T @ weights.T).T
+
+
+def cluster_structure(hists: np.ndarray, layout: HistogramLayout) -> dict:
+    """
+    DBSCAN1D(eps=EPS, min_samples=min_samples(n)) of every locus and histogram row at once,
+    giving the same labels as cluster_and_outliers for integer values.
+    A value is core if at least min_samples values are within EPS of it. Cores closer than EPS
+    form one cluster. Other values join the cluster of the nearest core within EPS (the lower
+    one on ties), or are noise.
+    Args:
+        hists: (batch, num_bins) histograms in the layout.
+    Returns:
+        structure: Dict with per (row, locus) 'n', 'groups', 'noise' and 'num_clusters' (as reported by
+                   cluster_and_outliers: number of labels minus one), and per cluster 'cluster_row',
+                   'cluster_locus', 'cluster_k' (rank within the locus, by value) and 'cluster_mean'.
+    """
+    batch, num_bins = hists.shape
+    idx = np.arange(num_bins)
+    cum = np.concatenate([np.zeros((batch, 1)), np.cumsum(hists, axis=1)], axis=1)
+    ends = layout.starts + layout.widths
+    n = cum[:, ends] - cum[:, layout.starts]
+
+    # values within EPS of every bin
+    window = cum[:, np.minimum(idx + EPS + 1, num_bins)] - cum[:, np.maximum(idx - EPS, 0)]
+    occupied = hists > 0
+    core = occupied & (window >= min_samples(n)[:, layout.bin_locus])
+
+    # nearest core at or below and at or above every bin
+    big = 4 * num_bins
+    below = np.maximum.accumulate(np.where(core, idx, -big), axis=1)
+    above = np.minimum.accumulate(np.where(core, idx, big)[:, ::-1], axis=1)[:, ::-1]
+    before = np.concatenate([np.full((batch, 1), -big), below[:, :-1]], axis=1)
+    starts = core & (idx - before > EPS)
+
+    cum_starts = np.concatenate([np.zeros((batch, 1), dtype=np.int64), np.cumsum(starts, axis=1)], axis=1)
+    groups = cum_starts[:, ends] - cum_starts[:, layout.starts]
+    gid = cum_starts[:, 1:] - 1
+
+    use_below = (idx - below) <= (above - idx)
+    target = np.where(use_below, below, above)
+    assigned = occupied & (np.minimum(idx - below, above - idx) <= EPS)
+    noise_bins = occupied & ~assigned
+    noise = (np.add.reduceat(noise_bins, layout.starts, axis=1) > 0) if layout.num_loci else np.zeros((batch, 0), bool)
+    noise &= n > 0
+
+    # cluster means from the assigned bins
+    rows, bins = np.nonzero(assigned)
+    keys = rows * num_bins + gid[rows, target[rows, bins]]
+    weights = hists[rows, bins]
+    totals = np.bincount(keys, weights=weights * layout.bin_values[bins], minlength=batch * num_bins)
+    counts = np.bincount(keys, weights=weights, minlength=batch * num_bins)
+
+    cluster_row, cluster_bin = np.nonzero(starts)
+    cluster_locus = layout.bin_locus[cluster_bin]
+    cluster_gid = gid[cluster_row, cluster_bin]
+    cluster_keys = cluster_row * num_bins + cluster_gid
+    labels = groups + noise
+    return {
+        'n': n,
+        'groups': groups,
+        'noise': noise,
+        'num_clusters': np.maximum(labels - 1, 0),
+        'cluster_row': cluster_row,
+        'cluster_locus': cluster_locus,
+        'cluster_k': cluster_gid - cum_starts[cluster_row, layout.starts[cluster_locus]],
+        'cluster_mean': totals[cluster_keys] / counts[cluster_keys],
+    }
+
+
+def bootstrap_stability(df: pd.DataFrame, n_boot: int = 200, batch_size: int = 20, seed: int = 0) -> pd.DataFrame:
+    """
+    Bootstrap stability of the cluster structure of every locus under donor resampling.
+    Donors are drawn with replacement as integer weights, the histograms of all loci for a batch
+    of bootstraps are one sparse product, and the clustering of all of them is vectorized.
+    Loci are processed in chunks of about CHUNK_BINS histogram bins, so the memory does not grow
+    with the number of loci.
+    Args:
+        df: Processed diff dataframe with rows as samples and cols as regions, integer values.
+        n_boot: Number of bootstrap samples.
+        batch_size: Bootstrap samples per batch, memory is batch_size * bins of a chunk.
+        seed: Seed of the donor draws. The draws do not depend on the loci, so chunks and blocks of the
+              same donors get the same scores as the whole matrix.
+    Returns:
+        stability_df: Cols STABILITY_COLUMNS, empty without loci or donors. 'stability' is the
+                      fraction of bootstraps with the same clusters, each mean within EPS of the observed,
+                      'stability_num_clusters' the fraction with the same num_clusters as the features.
+    """
+    values = np.rint(df.values.astype(float))
+    if values.size == 0:
+        return pd.DataFrame(columns=STABILITY_COLUMNS)
+    with np.errstate(invalid='ignore'):
+        widths = np.nan_to_num(np.nanmax(values, axis=0) - np.nanmin(values, axis=0) + 1)
+    chunks = (np.cumsum(widths + PAD) // CHUNK_BINS).astype(np.int64)
+    bounds = np.concatenate([[0], np.nonzero(np.diff(chunks))[0] + 1, [len(chunks)]])
+    return pd.concat([_chunk_stability(df.columns[start:stop], values[:, start:stop], n_boot, batch_size, seed)
+                      for start, stop in zip(bounds[:-1], bounds[1:])], ignore_index=True)
+
+
+def _chunk_stability(regions: pd.Index, values: np.ndarray, n_boot: int, batch_size: int, seed: int) -> pd.DataFrame:
+    num_rows, num_loci = values.shape
+    layout = HistogramLayout(values)
+
+    observed = cluster_structure(layout.histograms(np.ones((1, num_rows))), layout)
+    obs_groups = observed['groups'][0]
+    obs_offsets = np.concatenate([[0], np.cumsum(obs_groups)])
+    obs_means = observed['cluster_mean']
+
+    rng = np.random.default_rng(seed)
+    same_clusters = np.zeros(num_loci)
+    same_num = np.zeros(num_loci)
+    for start in range(0, n_boot, batch_size):
+        batch = min(batch_size, n_boot - start)
+        draws = rng.integers(0, num_rows, size=(batch, num_rows))
+        weights = np.bincount((draws + num_rows * np.arange(batch)[:, None]).ravel(),
+                              minlength=batch * num_rows).reshape(batch, num_rows)
+        boot = cluster_structure(layout.histograms(weights), layout)
+
+        # a cluster matches if the observed locus has a cluster of the same rank with a close mean
+        rows, loci, ranks = boot['cluster_row'], boot['cluster_locus'], boot['cluster_k']
+        has_rank = ranks < obs_groups[loci]
+        obs_mean = obs_means[np.minimum(obs_offsets[loci] + ranks, max(len(obs_means) - 1, 0))] if len(obs_means) else 0
+        matched = has_rank & (np.abs(boot['cluster_mean'] - obs_mean) <= EPS)
+        mismatches = np.bincount(rows * num_loci + loci, weights=~matched, minlength=batch * num_loci).reshape(batch, num_loci)
+
+        same_clusters += ((boot['groups'] == obs_groups) & (mismatches == 0)).sum(axis=0)
+        same_num += (boot['num_clusters'] == observed['num_clusters'][0]).sum(axis=0)
+
+    return pd.DataFrame({'ReferenceRegion': regions,
+                         'stability': same_clusters / n_boot,
+                         'stability_num_clusters': same_num / n_boot})
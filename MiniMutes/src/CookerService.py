@@ -0,0 +1,469 @@
+import argparse
+import glob
+import itertools
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import pandas as pd
+
+import ArchiveIndex
+import ExpansionCooker as EC
+import ExpansionFeatureExtractor as EHF
+import LocusStats as LS
+import Progress
+
+DEFAULT_ADDRESS = '127.0.0.1:6010'
+# Environment variable with the shared secret of server and clients, connections with another key are refused
+KEY_VARIABLE = 'MINIMUTES_SERVICE_KEY'
+
+MATRICES = ['case', 'control', 'diff']
+
+# Disease names are used in output file names, so no path separators or leading dots
+DISEASE_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
+
+
+def parse_address(text: str):
+    """
+    'host:port' for a TCP socket, anything else is the path of a Unix socket.
+    """
+    host, _, port = text.rpartition(':')
+    return (host, int(port)) if host and port.isdigit() else text
+
+
+def service_key() -> bytes:
+    """
+    Shared secret from KEY_VARIABLE. Requests are unpickled, so anyone with the key can run code as
+    the service user: there is no default, and the key should be as private as the service account.
+    """
+    key = os.getenv(KEY_VARIABLE)
+    if not key:
+        raise ValueError(f'Set {KEY_VARIABLE} to the shared key of the service.')
+    return key.encode()
+
+
+def donor_of_rows(index: pd.Index) -> pd.Index:
+    """
+    Manifest donor of the rows of a cooker matrix, which are {donor_id}_{allele}.
+    """
+    return index.str.rsplit('_', n=1).str[0]
+
+
+def valid_disease(name) -> bool:
+    return isinstance(name, str) and bool(DISEASE_PATTERN.match(name))
+
+
+class DiseaseState:
+    """
+    Cooker matrices, tracking and LocusStats of one disease, kept in memory between jobs.
+    The rows of every job are written as a batch to {output_dir}/{name}_batches/ with the updated stats
+    and features, so a job costs the I/O of its own donors. flush rewrites the full {output_dir}/{name}_*
+    outputs and clears the batches; batches left by a stopped service are replayed when it is loaded again.
+    """
+
+    def __init__(self, name: str, output_dir: str):
+        self.name = name
+        self.output_dir = output_dir
+        self.matrices = {kind: pd.DataFrame() for kind in MATRICES}
+        self.tracking = pd.DataFrame()
+        self.stats = None
+
+        if os.path.exists(self.path('diff.csv')):
+            for kind in MATRICES:
+                self.matrices[kind] = pd.read_csv(self.path(f'{kind}.csv'), index_col=0)
+            if os.path.exists(self.path('tracking.csv')):
+                self.tracking = pd.read_csv(self.path('tracking.csv'), index_col=0)
+            logging.info(f'Loaded {len(self.matrices["diff"])} rows of {name} from {output_dir}.')
+        batches = self.batches()
+        for batch in batches:
+            self._replace(*[read_batch_file(f'{batch}_{kind}.csv') for kind in MATRICES + ['tracking']])
+        if batches:
+            logging.info(f'Replayed {len(batches)} unflushed batches of {name}.')
+
+        if os.path.exists(self.path('stats.npz')):
+            self.stats = LS.LocusStats.load(self.path('stats.npz'))
+        if len(self.matrices['diff']) and (self.stats is None or self.stats.n_rows != len(self.matrices['diff'])):
+            self.stats = LS.LocusStats.from_frame(self.matrices['diff'])
+
+    def path(self, suffix: str) -> str:
+        return os.path.join(self.output_dir, f'{self.name}_{suffix}')
+
+    def batches(self) -> list:
+        """
+        Path prefixes of the unflushed batches, in the order they were written.
+        """
+        return sorted(path[:-len('_diff.csv')] for path in glob.glob(os.path.join(self.path('batches'), '*_diff.csv')))
+
+    def _replace(self, case_df, control_df, diff_df, tracking) -> pd.DataFrame:
+        """
+        Add the rows of new donors to the matrices, replacing the rows of donors seen before.
+        Returns:
+            removed: The replaced rows of the diff matrix.
+        """
+        donors = set(donor_of_rows(diff_df.index)) | set(tracking.get('donor_id', []))
+        old = self.matrices['diff']
+        removed = old[donor_of_rows(old.index).isin(donors)] if len(old) else old
+        for kind, new in zip(MATRICES, [case_df, control_df, diff_df]):
+            current = self.matrices[kind]
+            if len(current):
+                current = current[~donor_of_rows(current.index).isin(donors)]
+            self.matrices[kind] = pd.concat([current, new]) if len(current) else new
+        if len(self.tracking):
+            self.tracking = self.tracking[~self.tracking['donor_id'].isin(donors)]
+        self.tracking = pd.concat([self.tracking, tracking], ignore_index=True)
+        return removed
+
+    def add(self, case_df, control_df, diff_df, tracking) -> bool:
+        """
+        Add the rows of new donors, replacing the rows of donors seen before.
+        The stats of the replaced rows are subtracted and those of the new rows merged in.
+        Returns:
+            replaced: Whether some donors were already present.
+        """
+        removed = self._replace(case_df, control_df, diff_df, tracking)
+        if self.stats is None:
+            self.stats = LS.LocusStats.from_frame(self.matrices['diff'])
+        else:
+            if len(removed):
+                self.stats = self.stats.subtract(LS.LocusStats.from_frame(removed))
+            if len(diff_df):
+                self.stats = self.stats.merge(LS.LocusStats.from_frame(diff_df))
+        return len(removed) > 0
+
+    def save_batch(self, case_df, control_df, diff_df, tracking, annotations: dict) -> None:
+        """
+        Write the rows of one job as the next batch, and the stats and features of all donors.
+        """
+        os.makedirs(self.path('batches'), exist_ok=True)
+        prefix = os.path.join(self.path('batches'), f'{len(self.batches()) + 1:06d}')
+        # the diff file marks a complete batch, so it is written last
+        for kind, df in [('case', case_df), ('control', control_df), ('tracking', tracking), ('diff', diff_df)]:
+            df.to_csv(f'{prefix}_{kind}.csv.tmp')
+            os.replace(f'{prefix}_{kind}.csv.tmp', f'{prefix}_{kind}.csv')
+        self.save_features(annotations)
+
+    def save_features(self, annotations: dict) -> None:
+        self.stats.save(self.path('stats.npz'))
+        if len(self.stats.regions):
+            EHF.write_features(EHF.annotate_features(self.stats.features(), annotations), self.name, self.output_dir)
+
+    def flush(self, sparse: bool = False, hists: bool = False) -> None:
+        """
+        Rewrite the full outputs of the disease and drop the batches they now hold.
+        """
+        EC.save_outputs(self.matrices['case'], self.matrices['control'], self.matrices['diff'], self.tracking,
+                        self.name, self.output_dir, sparse, hists)
+        shutil.rmtree(self.path('batches'), ignore_errors=True)
+
+    def summary(self) -> dict:
+        diff = self.matrices['diff']
+        return {'rows': len(diff), 'donors': donor_of_rows(diff.index).nunique() if len(diff) else 0,
+                'loci': diff.shape[1], 'batches': len(self.batches())}
+
+
+def read_batch_file(path: str) -> pd.DataFrame:
+    # pandas writes an empty frame as a bare header, which reads back as an error
+    try:
+        return pd.read_csv(path, index_col=0)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+
+
+class CookerService:
+    """
+    Long running cooker: keeps the annotation tables, the archive index and the matrices and
+    LocusStats of every disease in memory, and genotypes submitted manifest rows as they arrive.
+    Jobs run one at a time on a worker thread, each on a fresh pool forked from the warm process.
+    Jobs write only their own donors, the full outputs are rewritten by a flush job and at shutdown.
+    """
+
+    def __init__(self, raw_eh_dir, output_dir, input_format='json', index_path=None, thresholds=None,
+                 mem_budget=None, sparse=False, hists=False):
+        self.raw_eh_dir = raw_eh_dir
+        self.output_dir = output_dir
+        self.input_format = input_format
+        self.index_path = index_path
+        self.thresholds = thresholds
+        self.mem_budget = mem_budget
+        self.sparse = sparse
+        self.hists = hists
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.annotations = EHF.load_annotations()
+        self.index = None
+        self.index_mtime = None
+        self.diseases = {}
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.worker = threading.Thread(target=self._run_jobs, daemon=True)
+        self.worker.start()
+
+    ### JOBS ###
+
+    def submit(self, disease: str, rows: list) -> int:
+        """
+        Queue the manifest rows of a disease, or with rows None a flush of the outputs of every disease.
+        """
+        with self.lock:
+            job_id = next(self.job_ids)
+            self.jobs[job_id] = {'id': job_id, 'disease': disease, 'donors': len(rows or []), 'state': 'queued',
+                                 'submitted': time.time(), 'started': None, 'finished': None,
+                                 'added': 0, 'skipped': [], 'error': ''}
+        self.queue.put((job_id, disease, rows))
+        logging.info(f'Queued job {job_id}: ' + (f'{len(rows)} donors of {disease}.' if rows is not None else 'flush.'))
+        return job_id
+
+    def _update_job(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def _run_jobs(self):
+        while True:
+            job_id, disease, rows = self.queue.get()
+            if job_id is None:
+                return
+            self._update_job(job_id, state='running', started=time.time())
+            Progress.set_stage(f'job {job_id}')
+            try:
+                added, skipped = self.run_job(disease, rows) if rows is not None else self.flush()
+                self._update_job(job_id, state='done', added=added, skipped=skipped)
+            except Exception as e:
+                logging.exception(f'Job {job_id} failed.')
+                self._update_job(job_id, state='failed', error=str(e))
+            self._update_job(job_id, finished=time.time())
+            Progress.set_stage('idle')
+
+    def _refresh_index(self):
+        """
+        Reload the archive index if it changed since the last job, e.g. after ArchiveIndex.py --update.
+        """
+        mtime = os.path.getmtime(self.index_path)
+        if mtime != self.index_mtime:
+            self.index = ArchiveIndex.load_index(self.index_path)
+            self.index_mtime = mtime
+            ok = self.index[0][self.index[0]['status'] == 'ok']
+            EC.set_archive_index(dict(zip(ok.index, ok['size'].astype(int))))
+            logging.info(f'Loaded archive index {self.index_path}.')
+
+    def flush(self):
+        """
+        Rewrite the full outputs of the diseases with unflushed batches.
+        Returns:
+            added, skipped: Nothing, as run_job.
+        """
+        Progress.set_stage('saving')
+        for name, state in list(self.diseases.items()):
+            if state.batches():
+                state.flush(self.sparse, self.hists)
+                logging.info(f'Flushed {name}: {state.summary()["donors"]} donors.')
+        return 0, []
+
+    def run_job(self, disease: str, rows: list):
+        """
+        Genotype the manifest rows and update the outputs and features of the disease in place.
+        Returns:
+            added: Number of donors with genotypes.
+            skipped: Donors left out by the archive index validation.
+        """
+        manifest = pd.DataFrame(rows)
+        skipped = []
+        if self.index_path:
+            self._refresh_index()
+            report = ArchiveIndex.validate_manifest(manifest, *self.index, self.input_format)
+            invalid = (report['issue'] != '').values
+            skipped = [f'{row.donor_id}: {row.issue}' for row in report[invalid].itertuples()]
+            for issue in skipped:
+                logging.error(f'Skipping {issue}')
+            manifest = manifest[~invalid]
+
+        results = EC.run_donors(manifest.to_dict('records'), self.raw_eh_dir, self.input_format, self.mem_budget,
+                                thresholds=self.thresholds)
+        results = [result for result in results if result[2] or result[3]]
+        if not results:
+            return 0, skipped
+
+        case_df, control_df, diff_df, tracking = EC.combine_results(results)
+        if disease not in self.diseases:
+            self.diseases[disease] = DiseaseState(disease, self.output_dir)
+        state = self.diseases[disease]
+        replaced = state.add(case_df, control_df, diff_df, tracking)
+        Progress.set_stage('saving')
+        state.save_batch(case_df, control_df, diff_df, tracking, self.annotations)
+        logging.info(f'Added {donor_of_rows(diff_df.index).nunique()} donors to {disease} '
+                     f'({"replacing earlier rows, " if replaced else ""}{state.summary()["donors"]} donors in total).')
+        return donor_of_rows(diff_df.index).nunique(), skipped
+
+    ### REQUESTS ###
+
+    def handle(self, request: dict) -> dict:
+        cmd = request.get('cmd')
+        if cmd == 'submit':
+            # manifests are read by the client, the service does not open paths given by clients
+            rows = request.get('rows')
+            if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+                return {'ok': False, 'error': 'submit needs the manifest rows as a list of dicts'}
+            if not valid_disease(request.get('disease')):
+                return {'ok': False, 'error': f'Invalid disease name {request.get("disease")!r}: letters, digits, "_", "-" and "."'}
+            return {'ok': True, 'job': self.submit(request['disease'], rows)}
+        if cmd == 'flush':
+            return {'ok': True, 'job': self.submit(None, None)}
+        if cmd == 'status':
+            with self.lock:
+                if request.get('job') is not None:
+                    job = self.jobs.get(request['job'])
+                    return {'ok': job is not None, 'job': dict(job) if job else None,
+                            'error': '' if job else f'No job {request["job"]}'}
+                jobs = [dict(job) for job in self.jobs.values()]
+            diseases = {name: state.summary() for name, state in list(self.diseases.items())}
+            return {'ok': True, 'jobs': jobs, 'queued': self.queue.qsize(), 'diseases': diseases}
+        if cmd == 'shutdown':
+            self.stopped.set()
+            return {'ok': True}
+        return {'ok': False, 'error': f'Unknown command {cmd}'}
+
+    def _serve_connection(self, conn):
+        with conn:
+            while not self.stopped.is_set():
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    response = self.handle(request)
+                except Exception as e:
+                    logging.exception('Request failed.')
+                    response = {'ok': False, 'error': str(e)}
+                conn.send(response)
+
+    def serve(self, address, authkey: bytes) -> None:
+        """
+        Accept clients with authkey on address until a shutdown request, then finish the queued jobs.
+        """
+        with Listener(address, authkey=authkey) as listener:
+            logging.info(f'Listening on {listener.address}.')
+            threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+            self.stopped.wait()
+        logging.info('Shutting down after the queued jobs.')
+        self.submit(None, None)
+        self.queue.put((None, None, None))
+        self.worker.join()
+
+    def _accept(self, listener):
+        while not self.stopped.is_set():
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                if not self.stopped.is_set():
+                    logging.warning(f'Refused connection: {e}')
+                continue
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+
+def request(address, message: dict) -> dict:
+    with Client(address, authkey=service_key()) as conn:
+        conn.send(message)
+        return conn.recv()
+
+
+def init_argparse():
+    parser = argparse.ArgumentParser(description='Run ExpansionCooker as a long lived service that adds new donors to its outputs in place, or talk to one.')
+    parser.add_argument('--address', '-a', default=DEFAULT_ADDRESS, help=f'host:port, or the path of a Unix socket. The shared key is taken from {KEY_VARIABLE}, which must be set. (Default: {DEFAULT_ADDRESS})')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='Start the service.')
+    serve.add_argument('raw_eh', metavar='RawDir', type=str, help='Directory with Expansion Hunter outputs.')
+    serve.add_argument('--outdir', '-o', required=True, help='Output directory, existing {name}_case/control/diff.csv and unflushed batches are loaded and updated.')
+    serve.add_argument('--input-format', default='json', choices=['json', 'ndjson'], help='Format of the files in RawDir. (Default: json)')
+    serve.add_argument('--index', default=None, help='Archive index of RawDir, reloaded when it changes; invalid pairs are skipped. (Default: check the filesystem per donor)')
+    serve.add_argument('--min-reads', type=float, default=EC.MIN_READS, help=f'Minimum read counts of a genotype. (Default: {EC.MIN_READS})')
+    serve.add_argument('--high-cov', type=float, default=EC.HIGH_COV, help=f'Read counts above which the EH genotypes are trusted. (Default: {EC.HIGH_COV})')
+    serve.add_argument('--max-width', type=float, default=EC.MAX_WIDTH, help=f'Widest genotype confidence interval kept. (Default: {EC.MAX_WIDTH})')
+    serve.add_argument('--mem-budget', type=float, default=None, help='GiB of RAM for the worker pool of a job. (Default: no limit)')
+    serve.add_argument('--sparse', default=False, action='store_true', help='Also save the differences as a sparse {name}_diff.npz on flush. (Default: False)')
+    serve.add_argument('--hists', default=False, action='store_true', help='Also save per-locus histograms as {name}_hists.npz on flush. (Default: False)')
+    serve.add_argument('--progress-interval', type=float, default=0, help='Seconds between progress lines in the log, 0 to disable. (Default: 0)')
+    serve.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics of the service on this port. (Default: off)')
+
+    submit = commands.add_parser('submit', help='Queue the rows of a manifest.')
+    submit.add_argument('manifest', metavar='Manifest', type=str, help='Manifest file with case and control object ids.')
+    submit.add_argument('--name', '-n', required=True, help='Disease name of the outputs to add the donors to.')
+    submit.add_argument('--wait', '-w', default=False, action='store_true', help='Wait for the job to finish. (Default: False)')
+
+    commands.add_parser('flush', help='Queue a rewrite of the full outputs of every disease with new batches.')
+
+    status = commands.add_parser('status', help='Show the jobs and diseases of the service.')
+    status.add_argument('job', type=int, nargs='?', default=None, help='Show only this job.')
+
+    commands.add_parser('shutdown', help='Stop the service after its queued jobs and a flush.')
+    return parser
+
+
+def format_job(job: dict) -> str:
+    times = ''
+    if job['finished']:
+        times = f", {job['finished'] - job['started']:.1f}s"
+    skipped = f", {len(job['skipped'])} skipped" if job['skipped'] else ''
+    error = f": {job['error']}" if job['error'] else ''
+    if job['disease'] is None:
+        return f"job {job['id']} flush: {job['state']}{times}{error}"
+    return f"job {job['id']} {job['disease']}: {job['state']}, {job['added']}/{job['donors']} donors added{skipped}{times}{error}"
+
+
+def main():
+    parser = init_argparse()
+    args = parser.parse_args()
+    address = parse_address(args.address)
+    if not os.getenv(KEY_VARIABLE):
+        parser.error(f'Set {KEY_VARIABLE} to the shared key of the service.')
+    if args.command == 'submit' and not valid_disease(args.name):
+        parser.error(f'Invalid disease name {args.name}: use letters, digits, "_", "-" and ".".')
+
+    if args.command == 'serve':
+        thresholds = {'min_reads': args.min_reads, 'high_cov': args.high_cov, 'max_width': args.max_width}
+        mem_budget = int(args.mem_budget * 2 ** 30) if args.mem_budget else None
+        service = CookerService(args.raw_eh, args.outdir, args.input_format, args.index, thresholds, mem_budget,
+                                args.sparse, args.hists)
+        with Progress.Progress('service', interval=args.progress_interval, port=args.metrics_port):
+            service.serve(address, service_key())
+        return
+
+    if args.command == 'submit':
+        rows = pd.read_csv(args.manifest).to_dict('records')
+        response = request(address, {'cmd': 'submit', 'disease': args.name, 'rows': rows})
+        print(f"Submitted job {response['job']} ({len(rows)} donors).")
+        while args.wait:
+            job = request(address, {'cmd': 'status', 'job': response['job']})['job']
+            if job['state'] in ('done', 'failed'):
+                print(format_job(job))
+                break
+            time.sleep(1)
+    elif args.command == 'status':
+        response = request(address, {'cmd': 'status', 'job': args.job})
+        if not response['ok']:
+            print(response['error'])
+        elif args.job is not None:
+            print(format_job(response['job']))
+        else:
+            for job in response['jobs']:
+                print(format_job(job))
+            print(f"{response['queued']} jobs queued.")
+            for name, summary in response['diseases'].items():
+                print(f"{name}: {summary['donors']} donors, {summary['rows']} rows, {summary['loci']} loci, {summary['batches']} unflushed batches")
+    elif args.command == 'flush':
+        response = request(address, {'cmd': 'flush'})
+        print(f"Queued flush job {response['job']}.")
+    elif args.command == 'shutdown':
+        request(address, {'cmd': 'shutdown'})
+        print('Service stopping after its queued jobs.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import logging
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2, kstwo
+
+import ExpansionFeatureExtractor as EHF
+import HistogramStore as HS
+
+TEST_COLUMNS = ['ks_stat', 'ks_pvals', 'chi2_stat', 'chi2_pvals', 'emd']
+
+
+def paired_histograms(case_df: pd.DataFrame, control_df: pd.DataFrame) -> dict:
+    """
+    Case and control histograms of every locus on a common range of integer values, in one bincount each.
+    Only donors with both values are counted, as in Graphers.calculate_data.
+    Args:
+        case_df, control_df: Dataframes with rows as samples and the same regions as cols.
+    Returns:
+        hists: Dict with 'regions', 'mins', 'offsets' (as in HistogramStore.ragged_histograms),
+               'case' and 'control' count arrays.
+    """
+    case_df = case_df.drop(columns=['sample_id'], errors='ignore')
+    control_df = control_df.reindex(index=case_df.index, columns=case_df.columns)
+    case = np.rint(case_df.values.astype(float))
+    control = np.rint(control_df.values.astype(float))
+    paired = ~np.isnan(case) & ~np.isnan(control)
+    has_values = paired.any(axis=0)
+
+    mins = np.where(paired, np.minimum(case, control), np.inf).min(axis=0)
+    maxs = np.where(paired, np.maximum(case, control), -np.inf).max(axis=0)
+    mins = np.where(has_values, mins, 0).astype(np.int64)
+    widths = np.where(has_values, maxs - mins + 1, 0).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(widths)])
+
+    rows, cols = np.nonzero(paired)
+    hists = {'regions': np.asarray(case_df.columns, dtype=str), 'mins': mins, 'offsets': offsets}
+    for kind, values in [('case', case), ('control', control)]:
+        codes = offsets[cols] + (values[rows, cols].astype(np.int64) - mins[cols])
+        hists[kind] = np.bincount(codes, minlength=offsets[-1])
+    return hists
+
+
+def _realign(hists: dict, index: np.ndarray, mins: np.ndarray, starts: np.ndarray, size: int) -> np.ndarray:
+    """
+    Counts of the ragged histograms hists at the loci index, moved to a layout where those loci
+    start at the bins starts with the values mins.
+    """
+    widths = np.diff(hists['offsets'])[index]
+    locus = np.repeat(np.arange(len(index)), widths)
+    within = np.arange(widths.sum()) - np.repeat(np.cumsum(widths) - widths, widths)
+    source = hists['offsets'][:-1][index][locus] + within
+    target = starts[locus] + hists['mins'][index][locus] - mins[locus] + within
+    counts = np.zeros(size, dtype=np.int64)
+    counts[target] = hists['counts'][source]
+    return counts
+
+
+def store_histograms(path: str) -> dict:
+    """
+    Paired histograms from a HistogramStore file, on the loci of the case histograms.
+    Case and control are missing for the same donors in the cooker outputs, so these match paired_histograms.
+    """
+    store = HS.DiseaseHistograms(path).hists
+    case, control = store['case'], store['control']
+    control_index = pd.Index(control['regions']).get_indexer(case['regions'])
+    if (control_index < 0).any():
+        raise ValueError(f'{path} has case loci without control histograms.')
+
+    case_widths = np.diff(case['offsets'])
+    control_widths = np.diff(control['offsets'])[control_index]
+    has_values = (case_widths > 0) & (control_widths > 0)
+    case_max = case['mins'] + case_widths - 1
+    control_max = control['mins'][control_index] + control_widths - 1
+    mins = np.where(has_values, np.minimum(case['mins'], control['mins'][control_index]), 0)
+    widths = np.where(has_values, np.maximum(case_max, control_max) - mins + 1, 0)
+    offsets = np.concatenate([[0], np.cumsum(widths)])
+
+    keep = np.nonzero(has_values)[0]
+    return {'regions': case['regions'], 'mins': mins, 'offsets': offsets,
+            'case': _realign(case, keep, mins[keep], offsets[keep], offsets[-1]),
+            'control': _realign(control, control_index[keep], mins[keep], offsets[keep], offsets[-1])}
+
+
+def histogram_tests(hists: dict) -> pd.DataFrame:
+    """
+    Two-sample tests of the case and control distribution of every locus, from the histograms alone.
+    Each statistic is a segmented reduction over the bins, O(bins) for all loci together.
+        ks: Largest difference of the empirical CDFs, p-value from the one-sample Kolmogorov distribution
+            at the effective sample size, as scipy's ks_2samp(method='asymp') (conservative with the ties
+            of integer lengths).
+        chi2: Pearson chi-square of the 2 x bins contingency table of the occupied bins.
+        emd: Earth Mover's (1-Wasserstein) distance in repeat units, the summed CDF difference.
+    Args:
+        hists: Paired histograms, from paired_histograms or store_histograms.
+    Returns:
+        tests_df: Cols ['ReferenceRegion'] + TEST_COLUMNS, nan for loci without paired values.
+    """
+    offsets = hists['offsets']
+    widths = np.diff(offsets)
+    case = hists['case'].astype(float)
+    control = hists['control'].astype(float)
+    locus = np.repeat(np.arange(len(widths)), widths)
+
+    def segment_sum(values):
+        cum = np.concatenate([[0], np.cumsum(values)])
+        return cum[offsets[1:]] - cum[offsets[:-1]]
+
+    def segment_cumsum(values):
+        cum = np.concatenate([[0], np.cumsum(values)])
+        return cum[1:] - np.repeat(cum[offsets[:-1]], widths)
+
+    n_case = segment_sum(case)
+    n_control = segment_sum(control)
+    valid = (n_case > 0) & (n_control > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cdf_gap = np.abs(segment_cumsum(case) / n_case[locus] - segment_cumsum(control) / n_control[locus])
+        nonempty = widths > 0
+        ks = np.full(len(widths), np.nan)
+        if nonempty.any():
+            ks[nonempty] = np.maximum.reduceat(cdf_gap, offsets[:-1][nonempty])
+        emd = segment_sum(cdf_gap)
+        ks_pvals = kstwo.sf(ks, np.maximum(np.round(n_case * n_control / (n_case + n_control)), 1))
+
+        total = case + control
+        n = n_case + n_control
+        expected_case = total * (n_case / n)[locus]
+        expected_control = total * (n_control / n)[locus]
+        occupied = total > 0
+        terms = np.where(occupied, (case - expected_case) ** 2 / expected_case
+                         + (control - expected_control) ** 2 / expected_control, 0)
+    chi2_stat = segment_sum(terms)
+    dof = segment_sum(occupied) - 1
+    chi2_pvals = np.where(dof > 0, chi2.sf(chi2_stat, np.maximum(dof, 1)), 1.0)
+
+    tests_df = pd.DataFrame({'ReferenceRegion': hists['regions'], 'ks_stat': ks, 'ks_pvals': ks_pvals,
+                             'chi2_stat': chi2_stat, 'chi2_pvals': chi2_pvals, 'emd': emd})
+    tests_df.loc[~valid, TEST_COLUMNS] = np.nan
+    return tests_df
+
+
+def matrix_paths(diff_path: str) -> tuple:
+    """
+    Case and control matrices written by the cooker next to a diff file.
+    """
+    folder = os.path.dirname(diff_path)
+    disease = EHF.disease_from_path(diff_path)
+    return os.path.join(folder, f'{disease}_case.csv'), os.path.join(folder, f'{disease}_control.csv')
+
+
+def distribution_tests(diff_path: str, hists_dir: str = None, block_size: int = None) -> pd.DataFrame:
+    """
+    Case vs control tests of the disease of a diff file, from its HistogramStore file if hists_dir has one,
+    else from the case and control matrices next to the diff file.
+    Args:
+        block_size: If given, read the matrices in blocks of this many loci.
+    Returns:
+        tests_df: See histogram_tests, None if neither histograms nor matrices are found.
+    """
+    disease = EHF.disease_from_path(diff_path)
+    if hists_dir and os.path.exists(HS.store_path(hists_dir, disease)):
+        return histogram_tests(store_histograms(HS.store_path(hists_dir, disease)))
+
+    case_path, control_path = matrix_paths(diff_path)
+    if not (os.path.exists(case_path) and os.path.exists(control_path)):
+        logging.warning(f'No histograms or case and control matrices for {disease}, skipping the distribution tests.')
+        return None
+    if not block_size:
+        return histogram_tests(paired_histograms(pd.read_csv(case_path, index_col=0), pd.read_csv(control_path, index_col=0)))
+
+    # both matrices are parsed once, the control columns of every case block are sliced from the spill
+    with tempfile.TemporaryDirectory() as directory:
+        case_spill = EHF.spill_diff(case_path, os.path.join(directory, 'case'))
+        control_spill = EHF.spill_diff(control_path, os.path.join(directory, 'control'))
+        control_columns = EHF.read_diff_header(control_spill)
+        parts = []
+        for case_block in EHF.read_diff_blocks(case_spill, block_size):
+            positions = control_columns.get_indexer(case_block.columns)
+            control_block = EHF.read_spilled(control_spill, positions[positions >= 0])
+            parts.append(histogram_tests(paired_histograms(case_block, control_block)))
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=['ReferenceRegion'] + TEST_COLUMNS)
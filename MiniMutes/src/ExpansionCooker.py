@@ -7,18 +7,36 @@ import logging
 from datetime import datetime
 import logging.handlers
 from ExpansionFeatureExtractor import process_features
+from SparseDiff import SparseDiff
+import HistogramStore
+import Progress
+import ArchiveIndex
+import Profiling
 import re
-from collections import Counter
+from collections import Counter, deque
+from itertools import zip_longest
 import random
+import time
+import queue
 
 from multiprocessing import Pool, cpu_count
 from functools import partial
 
-cpu_count = int(os.getenv('SLURM_CPUS_PER_TASK')) or cpu_count()
+cpu_count = int(os.getenv('SLURM_CPUS_PER_TASK') or cpu_count())
 MIN_READS = 6
 HIGH_COV = 24
 MAX_WIDTH = 4
 
+# Working set of a donor task as a multiple of its input size: decoded JSON documents are
+# several times larger than the files, NDJSON records are streamed
+DECODE_FACTOR = {'json': 8, 'ndjson': 2}
+# Memory of an idle worker (interpreter, pandas, numpy)
+WORKER_BASE_BYTES = 200 * 2 ** 20
+
+# File name to size of the decodable files of the archive index given with --index,
+# set in the main process and in every worker; None to look at the filesystem
+ARCHIVE_INDEX = None
+
 
 LOG_LEVEL = os.getenv('LOG_LEVEL') or 'info'
 log_dict = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 
@@ -40,9 +58,9 @@ logging.basicConfig(filename=os.path.join(log_dir, f'{dis_id}_ExpansionCooker.lo
                     datefmt='%Y-%m-%d %H:%M:%S')
 
 
-def is_wide(ci):
+def is_wide(ci, max_width=MAX_WIDTH):
     ci = list(map(int, ci.split('-')))
-    return ci[1] - ci[0] > MAX_WIDTH
+    return ci[1] - ci[0] > max_width
 
 def decide_genotype_order(case, control):
 
@@ -54,14 +72,14 @@ def decide_genotype_order(case, control):
 
     return case, control
 
-def getPairs(case_ci, control_ci, case_genotypes, control_genotypes):
-    if is_wide(case_ci[0]):
-        if is_wide(control_ci[1]):
+def getPairs(case_ci, control_ci, case_genotypes, control_genotypes, max_width=MAX_WIDTH):
+    if is_wide(case_ci[0], max_width):
+        if is_wide(control_ci[1], max_width):
             return [case_genotypes[1], control_genotypes[0]], [case_ci[0], control_ci[1]]
         else:
             return [case_genotypes[1], control_genotypes[1]], [case_ci[0], control_ci[0]]
     else:
-        if is_wide(control_ci[0]):
+        if is_wide(control_ci[0], max_width):
             return [case_genotypes[0], control_genotypes[1]], [case_ci[1], control_ci[0]]
         else:
             return [case_genotypes[0], control_genotypes[0]], [case_ci[1], control_ci[1]]
@@ -238,13 +256,12 @@ def append_genotype_data(case_genotypes, control_genotypes, donor_id, ReferenceR
         local_diff_df.append({'donor_id': donor_id + f'_{i}', 'ReferenceRegion': ReferenceRegion, 'value': case_genotypes[i] - control_genotypes[i]})
 
 
-def process_locus(donor_id, data_case, data_control, local_case_df, local_control_df, local_diff_df, local_df_tracking):
+def process_locus(donor_id, data_case, data_control, local_case_df, local_control_df, local_diff_df, local_df_tracking,
+                  min_reads=MIN_READS, high_cov=HIGH_COV, max_width=MAX_WIDTH):
     allele_count = data_case['AlleleCount']
-    high_cov = HIGH_COV
-    min_reads = MIN_READS
     if allele_count == 1:
-        high_cov = HIGH_COV / 2
-        min_reads = MIN_READS / 2
+        high_cov = high_cov / 2
+        min_reads = min_reads / 2
     for variant in set(data_case['Variants']):
         case = data_case['Variants'][variant]
         control = data_control['Variants'][variant]
@@ -351,10 +368,10 @@ def process_locus(donor_id, data_case, data_control, local_case_df, local_contro
 
         
         # otherwise, use CI approach
-        ci_approach(allele_count, donor_id, case, control, local_case_df, local_control_df, local_diff_df, local_df_tracking)
+        ci_approach(allele_count, donor_id, case, control, local_case_df, local_control_df, local_diff_df, local_df_tracking, max_width)
         
 
-def ci_approach(allele_count, donor_id, case, control, local_case_df, local_control_df, local_diff_df, local_df_tracking):
+def ci_approach(allele_count, donor_id, case, control, local_case_df, local_control_df, local_diff_df, local_df_tracking, max_width=MAX_WIDTH):
     ReferenceRegion = case['ReferenceRegion']
     # get values
     case_ci = case.get('GenotypeConfidenceInterval')
@@ -362,7 +379,7 @@ def ci_approach(allele_count, donor_id, case, control, local_case_df, local_cont
 
 
     if allele_count == 1:
-        if is_wide(case_ci) or is_wide(control_ci):
+        if is_wide(case_ci, max_width) or is_wide(control_ci, max_width):
             local_df_tracking.append({'donor_id': donor_id, 
                                 'ReferenceRegion': ReferenceRegion,
                                 'motif': case.get('RepeatUnit'),
@@ -382,13 +399,13 @@ def ci_approach(allele_count, donor_id, case, control, local_case_df, local_cont
         case_genotypes = list(map(int, case_genotypes.split('/')))
         control_genotypes = list(map(int, control_genotypes.split('/')))
         # make any genotypes with a wide confidence interval nan
-        if is_wide(case_ci[0]):
+        if is_wide(case_ci[0], max_width):
             case_genotypes[0] = np.nan
-        if is_wide(case_ci[1]):
+        if is_wide(case_ci[1], max_width):
             case_genotypes[1] = np.nan
-        if is_wide(control_ci[0]):
+        if is_wide(control_ci[0], max_width):
             control_genotypes[0] = np.nan
-        if is_wide(control_ci[1]):
+        if is_wide(control_ci[1], max_width):
             control_genotypes[1] = np.nan
 
         tot_wide = np.isnan(case_genotypes).sum() + np.isnan(control_genotypes).sum()
@@ -399,7 +416,7 @@ def ci_approach(allele_count, donor_id, case, control, local_case_df, local_cont
             return
 
         # if 3 out of 4 values are nan, skip
-        if tot_wide >= 3 or (is_wide(case_ci[0]) and is_wide(case_ci[1])) or (is_wide(control_ci[0]) and is_wide(control_ci[1])):
+        if tot_wide >= 3 or (is_wide(case_ci[0], max_width) and is_wide(case_ci[1], max_width)) or (is_wide(control_ci[0], max_width) and is_wide(control_ci[1], max_width)):
             local_df_tracking.append({'donor_id': donor_id, 
                                 'ReferenceRegion': ReferenceRegion, 
                                 'motif': case.get('RepeatUnit'),
@@ -412,7 +429,7 @@ def ci_approach(allele_count, donor_id, case, control, local_case_df, local_cont
                                 'case_ci': case_ci[1]})
             return
         
-        goodPair, badCi = getPairs(case_ci, control_ci, case_genotypes, control_genotypes)
+        goodPair, badCi = getPairs(case_ci, control_ci, case_genotypes, control_genotypes, max_width)
         local_case_df.append({'donor_id': donor_id + '_0', 'ReferenceRegion': ReferenceRegion, 'value': goodPair[0]})
         local_control_df.append({'donor_id': donor_id + '_0', 'ReferenceRegion': ReferenceRegion, 'value': goodPair[1]})
         local_diff_df.append({'donor_id': donor_id + '_0', 'ReferenceRegion': ReferenceRegion, 'value': goodPair[0] - goodPair[1]})
@@ -421,20 +438,89 @@ def ci_approach(allele_count, donor_id, case, control, local_case_df, local_cont
                             'motif': case.get('RepeatUnit'),
                             'control_ci': badCi[1], 
                             'case_ci': badCi[0]})
-def process_donor(donor, raw_eh_dir):
-    donor_id = donor['donor_id']
-    logging.info(f'Processing {donor_id}.')
-    file_path_case = os.path.join(raw_eh_dir, f"{donor['case_object_id']}.json")
-    file_path_control = os.path.join(raw_eh_dir, f"{donor['control_object_id']}.json")
+def read_ndjson(file):
+    for line in file:
+        if line.strip():
+            yield orjson.loads(line)
+
+
+def ndjson_locus(record):
+    """
+    Locus in the layout of the EH JSON LocusResults, with the single variant of an NDJSON record
+    written by expansionhunter-json-to-ndjson.py --reads.
+    """
+    if 'allele_count' not in record:
+        raise ValueError('NDJSON record without read fields, convert with expansionhunter-json-to-ndjson.py --reads')
+    variant = {
+        'Genotype': record.get('genotype'),
+        'GenotypeConfidenceInterval': record.get('ci'),
+        'CountsOfSpanningReads': record.get('spanning_reads'),
+        'CountsOfFlankingReads': record.get('flanking_reads'),
+        'ReferenceRegion': record.get('region'),
+        'RepeatUnit': record.get('motif'),
+    }
+    return {'AlleleCount': record['allele_count'], 'Variants': {record.get('variant') or record['region']: variant}}
+
+
+def paired_ndjson_records(file_case, file_control, donor_id):
+    """
+    Stream the records of a case and a control NDJSON, paired by region.
+    Files converted from the same catalog list the variants in the same order, so pairs are yielded
+    as they are read. Records out of order wait until their counterpart shows up.
+    """
+    case_pending = {}
+    control_pending = {}
+    for case, control in zip_longest(read_ndjson(file_case), read_ndjson(file_control)):
+        if case is not None and control is not None and case['region'] == control['region']:
+            yield case, control
+            continue
+        if case is not None:
+            if case['region'] in control_pending:
+                yield case, control_pending.pop(case['region'])
+            else:
+                case_pending[case['region']] = case
+        if control is not None:
+            if control['region'] in case_pending:
+                yield case_pending.pop(control['region']), control
+            else:
+                control_pending[control['region']] = control
 
-    local_case_df = []
-    local_control_df = []
-    local_diff_df = []
-    local_df_tracking = []
+    if case_pending:
+        logging.warning(f'{len(case_pending)} case regions missing from the control of {donor_id}.')
+
+
+class DecodeError(Exception):
+    pass
+
+
+def input_paths(donor, raw_eh_dir, input_format='json'):
+    return (os.path.join(raw_eh_dir, f"{donor['case_object_id']}.{input_format}"),
+            os.path.join(raw_eh_dir, f"{donor['control_object_id']}.{input_format}"))
+
+
+def set_archive_index(index):
+    global ARCHIVE_INDEX
+    ARCHIVE_INDEX = index
+
+
+def init_worker(index, profile):
+    set_archive_index(index)
+    if profile:
+        Profiling.configure(*profile)
+
+
+def input_size(path):
+    """
+    Size of an input file from the archive index if one is set, else from the filesystem. None if missing.
+    """
+    if ARCHIVE_INDEX is not None:
+        return ARCHIVE_INDEX.get(os.path.basename(path))
+    return os.path.getsize(path) if os.path.isfile(path) else None
 
-       # Test if the files exist
-    case_exists = os.path.isfile(file_path_case)
-    control_exists = os.path.isfile(file_path_control)
+
+def inputs_exist(donor_id, file_path_case, file_path_control):
+    case_exists = input_size(file_path_case) is not None
+    control_exists = input_size(file_path_control) is not None
 
     if not case_exists and not control_exists:
         logging.error(f'Missing both files for{donor_id}, both files do not exist: {file_path_case}, {file_path_control}')
@@ -442,26 +528,357 @@ def process_donor(donor, raw_eh_dir):
         logging.error(f'Missing case for {donor_id}: {file_path_case}')
     elif not control_exists:
         logging.error(f'Missing control for {donor_id}: {file_path_control}')
-        
-    if not case_exists or not control_exists:
-        return local_case_df, local_control_df, local_diff_df, local_df_tracking, donor_id
+    return case_exists and control_exists
+
+
+def decode_control(file_path_control, input_format='json'):
+    """
+    All loci of a control, decoded once to be paired with several cases.
+    Returns:
+        control: Dict of locus (JSON) or region (NDJSON) to its results in the layout of the
+                 EH JSON LocusResults, None if the file is missing or can not be decoded.
+    """
+    if input_size(file_path_control) is None:
+        return None
+    try:
+        if input_format == 'ndjson':
+            with open(file_path_control, 'rb') as file_control:
+                return {record['region']: ndjson_locus(record) for record in read_ndjson(file_control)}
+        with open(file_path_control, 'r') as file_control:
+            return orjson.loads(file_control.read())['LocusResults']
+    except (OSError, ValueError, KeyError) as e:
+        logging.error(f'Could not decode shared control {file_path_control} Error: {str(e)}')
+        return None
+
+
+def locus_pairs(donor_id, file_path_case, file_path_control, input_format='json', control=None):
+    """
+    Decode a case and control pair and yield the (case, control) results of each locus,
+    in the layout of the EH JSON LocusResults.
+    Args:
+        control: Control already decoded by decode_control, the control file is then not read.
+    Raises:
+        DecodeError: If a file can not be read or decoded. NDJSONs are streamed, so this can
+                     happen after some loci were yielded.
+    """
+    if input_format == 'ndjson' and control is not None:
+        missing = 0
+        try:
+            with open(file_path_case, 'rb') as file_case:
+                for record in read_ndjson(file_case):
+                    if record['region'] not in control:
+                        missing += 1
+                        continue
+                    yield ndjson_locus(record), control[record['region']]
+        except (OSError, ValueError) as e:
+            raise DecodeError(f'Could not decode NDJSON for {donor_id} Error: {str(e)}')
+        if missing:
+            logging.warning(f'{missing} case regions missing from the control of {donor_id}.')
+        return
 
-    with open(file_path_case, 'r') as file_case, open(file_path_control, 'r') as file_control:
+    if input_format == 'ndjson':
         try:
+            with open(file_path_case, 'rb') as file_case, open(file_path_control, 'rb') as file_control:
+                for case, control in paired_ndjson_records(file_case, file_control, donor_id):
+                    yield ndjson_locus(case), ndjson_locus(control)
+        except (OSError, ValueError) as e:
+            raise DecodeError(f'Could not decode NDJSON for {donor_id} Error: {str(e)}')
+        return
+
+    try:
+        with open(file_path_case, 'r') as file_case:
             data_case = orjson.loads(file_case.read())
-            data_control = orjson.loads(file_control.read())
-        except Exception as e:
-            logging.error(f'Could not decode JSON for {donor_id} Error: {str(e)}')
-            return local_case_df, local_control_df, local_diff_df, local_df_tracking, donor_id
+        if control is None:
+            with open(file_path_control, 'r') as file_control:
+                control = orjson.loads(file_control.read())['LocusResults']
+    except Exception as e:
+        raise DecodeError(f'Could not decode JSON for {donor_id} Error: {str(e)}')
+
+    for locus in set(data_case['LocusResults']):
+        yield data_case['LocusResults'][locus], control[locus]
+
+
+def process_donor(donor, raw_eh_dir, input_format='json', thresholds=None, control=None):
+    """
+    Args:
+        thresholds: min_reads, high_cov and max_width for process_locus (default: the module constants).
+        control: Control already decoded by decode_control.
+    """
+    donor_id = donor['donor_id']
+    logging.info(f'Processing {donor_id}.')
+    file_path_case, file_path_control = input_paths(donor, raw_eh_dir, input_format)
 
-        for locus in set(data_case['LocusResults']):
-            process_locus(donor_id, data_case['LocusResults'][locus], data_control['LocusResults'][locus], local_case_df, local_control_df, local_diff_df, local_df_tracking)
+    local_case_df = []
+    local_control_df = []
+    local_diff_df = []
+    local_df_tracking = []
+
+    if not inputs_exist(donor_id, file_path_case, file_path_control):
+        return local_case_df, local_control_df, local_diff_df, local_df_tracking, donor_id
+
+    try:
+        for data_case, data_control in locus_pairs(donor_id, file_path_case, file_path_control, input_format, control):
+            process_locus(donor_id, data_case, data_control, local_case_df, local_control_df, local_diff_df, local_df_tracking,
+                          **(thresholds or {}))
+    except DecodeError as e:
+        logging.error(str(e))
+        return [], [], [], [], donor_id
 
     logging.info(f'Finished {donor_id} succesfully.')
     return local_case_df, local_control_df, local_diff_df, local_df_tracking, donor_id
 
 
-def extract_genotypes_diffs(manifest_path, disease_name, raw_eh_dir, output_dir):
+def sweep_donor(donor, raw_eh_dir, input_format='json', settings=(), control=None):
+    """
+    process_donor for several threshold settings, decoding the donor's files once.
+    Every setting sees the same random state at each locus, so settings differ only by their thresholds.
+    Returns:
+        results: One process_donor result per setting.
+    """
+    donor_id = donor['donor_id']
+    logging.info(f'Processing {donor_id} for {len(settings)} settings.')
+    file_path_case, file_path_control = input_paths(donor, raw_eh_dir, input_format)
+    results = [([], [], [], [], donor_id) for _ in settings]
+
+    if not inputs_exist(donor_id, file_path_case, file_path_control):
+        return results
+
+    try:
+        for data_case, data_control in locus_pairs(donor_id, file_path_case, file_path_control, input_format, control):
+            state = random.getstate()
+            for setting, result in zip(settings, results):
+                random.setstate(state)
+                process_locus(donor_id, data_case, data_control, *result[:4], **setting)
+    except DecodeError as e:
+        logging.error(str(e))
+        return [([], [], [], [], donor_id) for _ in settings]
+
+    logging.info(f'Finished {donor_id} succesfully.')
+    return results
+
+
+def task_input_sizes(donors, raw_eh_dir, input_format='json'):
+    """
+    Sizes of the case files and of the shared control file of rows sharing a control, 0 if missing.
+    """
+    def size(path):
+        return input_size(path) or 0
+
+    case_sizes = [size(input_paths(donor, raw_eh_dir, input_format)[0]) for donor in donors]
+    return case_sizes, size(input_paths(donors[0], raw_eh_dir, input_format)[1])
+
+
+def group_by_control(donors):
+    """
+    Group manifest rows sharing a control sample, e.g. several tumours of one donor against one normal.
+    Returns:
+        tasks: List of (manifest positions, rows), in order of first appearance.
+    """
+    groups = {}
+    for i, donor in enumerate(donors):
+        indices, rows = groups.setdefault(str(donor['control_object_id']), ([], []))
+        indices.append(i)
+        rows.append(donor)
+    return list(groups.values())
+
+
+def process_control_group(donors, raw_eh_dir, input_format='json', worker=process_donor, **kwargs):
+    """
+    Run a donor worker (process_donor or sweep_donor) on the rows sharing a control.
+    With several rows the control is decoded once and passed to the worker for every tumour.
+    Returns:
+        results: Results of the worker per row.
+    """
+    control = None
+    if len(donors) > 1:
+        control = decode_control(input_paths(donors[0], raw_eh_dir, input_format)[1], input_format)
+    return [worker(donor, raw_eh_dir, input_format, control=control, **kwargs) for donor in donors]
+
+
+def tracked_process_donor(task, raw_eh_dir, input_format='json', worker=process_donor, **kwargs):
+    """
+    Run process_control_group on the rows sharing a control and report the numbers shown by Progress:
+    run time, loci, bytes read and worker peak RSS. A profiled task includes the decode of the shared control.
+    Args:
+        task: (manifest positions, rows) of one control, as given by group_by_control.
+    Returns:
+        indices, results, stats: Results of the worker per row.
+    """
+    indices, donors = task
+    start = time.time()
+    results = Profiling.maybe_profile(process_control_group, donors, raw_eh_dir, input_format, worker=worker, **kwargs)
+
+    loci = 0
+    for result in results:
+        case, _, _, tracking, _ = result[0] if isinstance(result, list) else result
+        loci += len({r['ReferenceRegion'] for r in case} | {r['ReferenceRegion'] for r in tracking})
+    case_sizes, control_size = task_input_sizes(donors, raw_eh_dir, input_format)
+    stats = {
+        'done': len(donors),
+        'loci': loci,
+        'bytes_read': sum(case_sizes) + control_size,
+        'usage': Progress.worker_usage(),
+        'item': ','.join(str(donor['donor_id']) for donor in donors),
+        'seconds': time.time() - start,
+    }
+    return indices, results, stats
+
+
+def estimate_working_set(donors, raw_eh_dir, input_format='json'):
+    """
+    Working set of a task of rows sharing a control: the decoded control and one case at a time.
+    """
+    case_sizes, control_size = task_input_sizes(donors, raw_eh_dir, input_format)
+    return DECODE_FACTOR[input_format] * (control_size + max(case_sizes))
+
+
+def budgeted_imap(pool, func, tasks, estimates, budget, processes):
+    """
+    Run func over tasks on the pool, admitting a task only while the estimates of the running
+    tasks fit in the budget. At most one task per worker is in flight, so admitted tasks are
+    running and not waiting in the pool's queue. A task larger than the budget still runs, alone.
+    Yields results as they finish, in any order.
+    Args:
+        estimates: Working set estimate of every task, in bytes.
+        budget: Bytes available to the running tasks.
+    """
+    pending = deque(range(len(tasks)))
+    done = queue.Queue()
+    in_flight = {}
+    used = 0
+    while pending or in_flight:
+        while pending and len(in_flight) < processes and (not in_flight or used + estimates[pending[0]] <= budget):
+            i = pending.popleft()
+            in_flight[i] = estimates[i]
+            used += estimates[i]
+            pool.apply_async(func, (tasks[i],), callback=lambda res, i=i: done.put((i, res, None)),
+                             error_callback=lambda err, i=i: done.put((i, None, err)))
+        if pending and len(in_flight) < processes:
+            logging.debug(f'Memory budget holds back {len(pending)} tasks, {used / 2 ** 30:.2f} GiB in flight.')
+
+        i, res, err = done.get()
+        used -= in_flight.pop(i)
+        if err is not None:
+            raise err
+        yield res
+
+
+def budget_workers(mem_budget, estimates, processes):
+    """
+    Workers that fit in a memory budget, each with its base memory and the working set of a median task,
+    and the bytes left to the running tasks once their base memory is reserved.
+    Returns:
+        workers, budget: At least one worker, at most processes.
+    """
+    typical = int(np.median(estimates)) if len(estimates) else 0
+    workers = int(min(processes, max(1, mem_budget // (WORKER_BASE_BYTES + typical))))
+    return workers, max(mem_budget - workers * WORKER_BASE_BYTES, 0)
+
+
+def run_donors(donors, raw_eh_dir, input_format='json', mem_budget=None, max_tasks_per_child=None, profile=None, **kwargs):
+    """
+    Run a donor worker over the manifest rows on the pool, one task per control sample.
+    Args:
+        mem_budget: If given, bytes of RAM for the workers; the pool has only the workers the budget holds
+                    (see budget_workers), and donors are admitted only while their estimated working sets
+                    (DECODE_FACTOR times the input size) fit in it.
+        max_tasks_per_child: If given, replace each worker after this many tasks.
+        profile: If given, (profile_dir, tasks, interval, mode) for Profiling.configure in every worker.
+        kwargs: Passed to tracked_process_donor, e.g. worker=sweep_donor and its settings.
+    Returns:
+        results: Worker results in manifest order.
+    """
+    Progress.add_total(len(donors))
+    Progress.set_stage('decoding')
+    results = [None] * len(donors)
+    tasks = group_by_control(donors)
+    if len(tasks) < len(donors):
+        logging.info(f'{len(donors)} manifest rows share {len(tasks)} controls, each control is decoded once.')
+    processes = cpu_count
+    if mem_budget:
+        estimates = [estimate_working_set(rows, raw_eh_dir, input_format) for _, rows in tasks]
+        processes, budget = budget_workers(mem_budget, estimates, cpu_count)
+        logging.info(f'Scheduling within {mem_budget / 2 ** 30:.2f} GiB, largest donor estimate {max(estimates, default=0) / 2 ** 30:.2f} GiB.')
+        if processes < cpu_count:
+            logging.warning(f'The memory budget of {mem_budget / 2 ** 30:.2f} GiB holds {processes} of {cpu_count} workers, '
+                            f'raise --mem-budget or lower the cpus to use them all.')
+    with Pool(processes=processes, maxtasksperchild=max_tasks_per_child,
+              initializer=init_worker, initargs=(ARCHIVE_INDEX, profile)) as pool:
+        func = partial(tracked_process_donor, raw_eh_dir=raw_eh_dir, input_format=input_format, **kwargs)
+        if mem_budget:
+            finished = budgeted_imap(pool, func, tasks, estimates, budget, processes)
+        else:
+            # unordered so progress is not held back by slow donors, results keep the manifest order
+            finished = pool.imap_unordered(func, tasks)
+        for indices, task_results, stats in finished:
+            for i, result in zip(indices, task_results):
+                results[i] = result
+            Progress.update(**stats)
+    return results
+
+
+def preflight(manifest, index_path, input_format, disease_name, output_dir):
+    """
+    Validate the manifest against an archive index built by ArchiveIndex.py before any compute,
+    and use the index instead of the filesystem to find the inputs.
+    Invalid pairs are reported in {disease_name}_validation.csv and left out of the run.
+    Returns:
+        manifest: The valid rows.
+    """
+    index, loci = ArchiveIndex.load_index(index_path)
+    report = ArchiveIndex.validate_manifest(manifest, index, loci, input_format)
+    report.to_csv(os.path.join(output_dir, f'{disease_name}_validation.csv'), index=False)
+    invalid = report['issue'] != ''
+    for row in report[invalid].itertuples():
+        logging.error(f'Skipping {row.donor_id}: {row.issue}')
+    logging.info(f'{invalid.sum()}/{len(report)} manifest pairs invalid in {index_path}.')
+
+    ok = index[index['status'] == 'ok']
+    set_archive_index(dict(zip(ok.index, ok['size'].astype(int))))
+    return manifest[~invalid.values]
+
+
+def combine_results(results):
+    """
+    Pivot the per-donor records of process_donor into the case, control and diff matrices.
+    Returns:
+        case_df, control_df, diff_df: Rows as donor alleles, cols as regions.
+        df_tracking: Tracked loci.
+    """
+    case_df_list, control_df_list, diff_df_list, df_tracking_list, donor_ids = zip(*results)
+    case_df = [item for sublist in case_df_list for item in sublist]
+    control_df = [item for sublist in control_df_list for item in sublist]
+    diff_df = [item for sublist in diff_df_list for item in sublist]
+    df_tracking = [item for sublist in df_tracking_list for item in sublist]
+
+    # Convert lists to DataFrames and pivot
+    case_df = pd.DataFrame(case_df).pivot(index='donor_id', columns='ReferenceRegion', values='value')
+    control_df = pd.DataFrame(control_df).pivot(index='donor_id', columns='ReferenceRegion', values='value')
+    diff_df = pd.DataFrame(diff_df).pivot(index='donor_id', columns='ReferenceRegion', values='value')
+    df_tracking = pd.DataFrame(df_tracking)
+    return case_df, control_df, diff_df, df_tracking
+
+
+def save_outputs(case_df, control_df, diff_df, df_tracking, disease_name, output_dir, sparse=False, hists=False):
+    case_df.to_csv(os.path.join(output_dir, f'{disease_name}_case.csv'))
+    control_df.to_csv(os.path.join(output_dir, f'{disease_name}_control.csv'))
+    diff_df.to_csv(os.path.join(output_dir, f'{disease_name}_diff.csv'))
+    df_tracking.to_csv(os.path.join(output_dir, f'{disease_name}_tracking.csv'))
+    if sparse:
+        SparseDiff.from_frame(diff_df).save(os.path.join(output_dir, f'{disease_name}_diff.npz'))
+    if hists:
+        HistogramStore.save_frame_histograms({'case': case_df, 'control': control_df, 'diff': diff_df},
+                                             HistogramStore.store_path(output_dir, disease_name))
+
+
+def extract_genotypes_diffs(manifest_path, disease_name, raw_eh_dir, output_dir, sparse=False, hists=False, input_format='json',
+                            mem_budget=None, max_tasks_per_child=None, thresholds=None, index_path=None, profile=None):
+    """
+    Args:
+        mem_budget, max_tasks_per_child, profile: Scheduling and profiling of the pool, see run_donors.
+        thresholds: min_reads, high_cov and max_width for process_locus (default: the module constants).
+        index_path: Archive index to validate the manifest against and to find the inputs with.
+    """
     
     # Load the manifest
     manifest = pd.read_csv(manifest_path)
@@ -470,41 +887,99 @@ def extract_genotypes_diffs(manifest_path, disease_name, raw_eh_dir, output_dir)
     # Ensure output directory exists
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
+
+    if index_path:
+        manifest = preflight(manifest, index_path, input_format, disease_name, output_dir)
     
-    with Pool(processes=cpu_count) as pool:
-        func = partial(process_donor, raw_eh_dir=raw_eh_dir)
-        results = pool.map(func, manifest.to_dict('records'))
+    results = run_donors(manifest.to_dict('records'), raw_eh_dir, input_format, mem_budget, max_tasks_per_child,
+                         profile, thresholds=thresholds)
 
 
     logging.info('Finished processing files, combining results.')
+    Progress.set_stage('combining')
     # Aggregate results
-    case_df_list, control_df_list, diff_df_list, df_tracking_list, donor_ids = zip(*results)
-    case_df = [item for sublist in case_df_list for item in sublist]
-    control_df = [item for sublist in control_df_list for item in sublist]
-    diff_df = [item for sublist in diff_df_list for item in sublist]
-    df_tracking = [item for sublist in df_tracking_list for item in sublist]
-
-    # Convert lists to DataFrames and pivot
-    case_df = pd.DataFrame(case_df).pivot(index='donor_id', columns='ReferenceRegion', values='value')
-    control_df = pd.DataFrame(control_df).pivot(index='donor_id', columns='ReferenceRegion', values='value')
-    diff_df = pd.DataFrame(diff_df).pivot(index='donor_id', columns='ReferenceRegion', values='value')
-    df_tracking = pd.DataFrame(df_tracking)
+    case_df, control_df, diff_df, df_tracking = combine_results(results)
     
     # log proportion of problematic loci
     logging.info(f'Proportion of problematic loci: {len(df_tracking)/(diff_df.shape[1] * diff_df.shape[0])}')
 
     logging.info(f'Saving DataFrames.')
+    Progress.set_stage('saving')
 
     # Save the DataFrames
-    case_df.to_csv(os.path.join(output_dir, f'{disease_name}_case.csv'))
-    control_df.to_csv(os.path.join(output_dir, f'{disease_name}_control.csv'))
-    diff_df.to_csv(os.path.join(output_dir, f'{disease_name}_diff.csv'))
-    df_tracking.to_csv(os.path.join(output_dir, f'{disease_name}_tracking.csv'))
+    save_outputs(case_df, control_df, diff_df, df_tracking, disease_name, output_dir, sparse, hists)
 
     logging.info('Finished Saving DataFrames.')
 
     return diff_df
 
+
+def setting_name(setting):
+    return f"mr{setting['min_reads']:g}_hc{setting['high_cov']:g}_mw{setting['max_width']:g}"
+
+
+def tracking_issues(df_tracking):
+    """
+    Issue of every tracking row, rows from ci_approach have CIs instead of an issue and count as wide_ci.
+    """
+    if df_tracking.empty:
+        return pd.Series(dtype=object)
+    issues = df_tracking['issue'] if 'issue' in df_tracking.columns else pd.Series(np.nan, index=df_tracking.index)
+    return issues.fillna('wide_ci')
+
+
+def sweep_genotypes_diffs(manifest_path, disease_name, raw_eh_dir, output_dir, settings, input_format='json',
+                          mem_budget=None, max_tasks_per_child=None, index_path=None, profile=None):
+    """
+    Run the cooker for a grid of threshold settings in one pass over the raw files.
+    Each donor is decoded once and process_locus runs for every setting on the same parsed data.
+    Writes the usual outputs of every setting to {output_dir}/{disease_name}_{setting}_*.csv and
+    a summary of the kept and tracked values per setting to {disease_name}_sweep_summary.csv.
+    Args:
+        settings: List of dicts with min_reads, high_cov and max_width.
+        index_path: Archive index to validate the manifest against and to find the inputs with.
+    Returns:
+        summary: One row per setting.
+    """
+    manifest = pd.read_csv(manifest_path)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if index_path:
+        manifest = preflight(manifest, index_path, input_format, disease_name, output_dir)
+
+    donor_results = run_donors(manifest.to_dict('records'), raw_eh_dir, input_format, mem_budget, max_tasks_per_child,
+                               profile, worker=sweep_donor, settings=settings)
+
+    Progress.set_stage('saving')
+    summary = []
+    for k, setting in enumerate(settings):
+        name = f'{disease_name}_{setting_name(setting)}'
+        case_df, control_df, diff_df, df_tracking = combine_results([results[k] for results in donor_results])
+        save_outputs(case_df, control_df, diff_df, df_tracking, name, output_dir)
+
+        row = dict(setting)
+        row['donor_alleles'] = diff_df.shape[0]
+        row['loci'] = int(diff_df.notna().any(axis=0).sum())
+        row['kept_values'] = int(diff_df.notna().sum().sum())
+        row['nonzero_diffs'] = int((diff_df.notna() & diff_df.ne(0)).sum().sum())
+        # process_locus can log a locus twice for a donor, count each (donor, locus, issue) once
+        tracked = df_tracking.assign(issue=tracking_issues(df_tracking))
+        tracked = tracked.drop_duplicates(['donor_id', 'ReferenceRegion', 'issue']) if len(tracked) else tracked
+        row['tracked'] = len(tracked)
+        for issue, count in tracked['issue'].value_counts().items():
+            row[f'tracked_{issue}'] = count
+        summary.append(row)
+        logging.info(f'Saved outputs of {name}.')
+
+    summary = pd.DataFrame(summary)
+    tracked = [col for col in summary.columns if col.startswith('tracked_')]
+    summary[tracked] = summary[tracked].fillna(0).astype(int)
+    summary_path = os.path.join(output_dir, f'{disease_name}_sweep_summary.csv')
+    summary.to_csv(summary_path, index=False)
+    logging.info(f'Sweep summary saved to {summary_path}')
+    return summary
+
+
 def init_argparse():
     parser = argparse.ArgumentParser(description='Process Expansion Hunter output for analysis of paired genotype differences.')
     parser.add_argument('raw_eh', metavar='RawDir', type=str, help='Directory with Expansion Hunter output JSONs.')
@@ -512,17 +987,68 @@ def init_argparse():
     parser.add_argument('--name', '-n', required=True, help='Disease name for output files.')
     parser.add_argument('--outdir', '-o', required=True, help='Output directory (default .).')
     parser.add_argument('--feats', '-f', default=False, action='store_true', help='Create features from the output? (Default: False)')
+    parser.add_argument('--input-format', default='json', choices=['json', 'ndjson'], help='Format of the files in RawDir: EH JSONs, or NDJSONs from expansionhunter-json-to-ndjson.py --reads. (Default: json)')
+    parser.add_argument('--sparse', default=False, action='store_true', help='Also save the differences as a sparse {name}_diff.npz. (Default: False)')
+    parser.add_argument('--index', default=None, help='Archive index of RawDir built by ArchiveIndex.py; the manifest is validated against it first and invalid pairs are skipped. (Default: check the filesystem per donor)')
+    parser.add_argument('--sweep', default=False, action='store_true', help='Run every combination of the --min-reads, --high-cov and --max-width values in one pass, decoding each donor once. (Default: False)')
+    parser.add_argument('--min-reads', type=float, nargs='+', default=[MIN_READS], help=f'Minimum read counts of a genotype (halved for single allele loci). (Default: {MIN_READS})')
+    parser.add_argument('--high-cov', type=float, nargs='+', default=[HIGH_COV], help=f'Read counts above which the EH genotypes are trusted (halved for single allele loci). (Default: {HIGH_COV})')
+    parser.add_argument('--max-width', type=float, nargs='+', default=[MAX_WIDTH], help=f'Widest genotype confidence interval kept by the CI approach. (Default: {MAX_WIDTH})')
+    parser.add_argument('--mem-budget', type=float, default=None, help='GiB of RAM for the worker pool; fewer workers are started if it can not hold one per cpu, and donors are admitted only while their estimated working sets fit. (Default: SLURM_MEM_PER_NODE if set, else no limit)')
+    parser.add_argument('--max-tasks-per-child', type=int, default=None, help='Replace each worker after this many tasks (one task per control sample), to limit memory growth. (Default: never)')
+    parser.add_argument('--profile', type=int, default=0, help='Profile the first N tasks of every worker (a control and its cases, including the decode of the control) and write the merged {name}_profile.pstats or .collapsed and .txt to the outdir. (Default: 0, off)')
+    parser.add_argument('--profile-mode', default='cprofile', choices=Profiling.MODES, help='Profiler of --profile: cProfile (.pstats) or stack sampling (.collapsed, for flame graphs). (Default: cprofile)')
+    parser.add_argument('--profile-interval', type=float, default=5, help='Milliseconds of CPU time between stack samples with --profile-mode sample. (Default: 5)')
+    parser.add_argument('--progress-interval', type=float, default=60, help='Seconds between progress lines in the log, 0 to disable. (Default: 60)')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics of the run on this port (host from METRICS_HOST, default 127.0.0.1). (Default: off)')
+    parser.add_argument('--hists', default=False, action='store_true', help='Also save per-locus case, control and diff histograms as {name}_hists.npz, for plotting. (Default: False)')
     return parser
 
 
 def main():
     parser = init_argparse()
     args = parser.parse_args()
-    diffs = extract_genotypes_diffs(args.manifest, args.name, args.raw_eh, args.outdir)
+    if args.mem_budget is not None:
+        mem_budget = int(args.mem_budget * 2 ** 30)
+    elif os.getenv('SLURM_MEM_PER_NODE'):
+        mem_budget = int(os.getenv('SLURM_MEM_PER_NODE')) * 2 ** 20
+    else:
+        mem_budget = None
+
+    profile = None
+    if args.profile:
+        profile_dir = os.path.join(args.outdir, f'.{args.name}_profile')
+        os.makedirs(profile_dir, exist_ok=True)
+        profile = (profile_dir, args.profile, args.profile_interval / 1000, args.profile_mode)
+
+    if args.sweep:
+        ignored = [option for option, value in [('--sparse', args.sparse), ('--hists', args.hists), ('--feats', args.feats)] if value]
+        if ignored:
+            parser.error(f'--sweep does not support {", ".join(ignored)}.')
+        settings = [{'min_reads': min_reads, 'high_cov': high_cov, 'max_width': max_width}
+                    for min_reads in args.min_reads for high_cov in args.high_cov for max_width in args.max_width]
+        with Progress.Progress(args.name, interval=args.progress_interval, port=args.metrics_port):
+            sweep_genotypes_diffs(args.manifest, args.name, args.raw_eh, args.outdir, settings, args.input_format,
+                                  mem_budget, args.max_tasks_per_child, args.index, profile)
+        if profile:
+            Profiling.merge_profiles(profile[0], os.path.join(args.outdir, args.name))
+        logging.info('Finished.')
+        return
+
+    if any(len(values) > 1 for values in [args.min_reads, args.high_cov, args.max_width]):
+        parser.error('Several threshold values need --sweep.')
+    thresholds = {'min_reads': args.min_reads[0], 'high_cov': args.high_cov[0], 'max_width': args.max_width[0]}
+
+    with Progress.Progress(args.name, interval=args.progress_interval, port=args.metrics_port):
+        diffs = extract_genotypes_diffs(args.manifest, args.name, args.raw_eh, args.outdir, args.sparse, args.hists, args.input_format,
+                                        mem_budget, args.max_tasks_per_child, thresholds, args.index, profile)
+        if profile:
+            Profiling.merge_profiles(profile[0], os.path.join(args.outdir, args.name))
 
-    if args.feats:
-        logging.info('Creating features from the output.')
-        process_features(diffs, args.name, args.outdir)  # Pass the diffs dataframe to the refactored function
+        if args.feats:
+            logging.info('Creating features from the output.')
+            Progress.set_stage('features')
+            process_features(diffs, args.name, args.outdir)  # Pass the diffs dataframe to the refactored function
 
     logging.info('Finished.')
 
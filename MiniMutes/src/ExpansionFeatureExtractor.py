@@ -1,20 +1,40 @@
 from datetime import datetime
 import pandas as pd
 import numpy as np
-from scipy.stats import wilcoxon
+from scipy.stats import wilcoxon, norm
 from statsmodels.stats.multitest import multipletests
 from dbscan1d.core import DBSCAN1D
 import pyranges as pr
+import LocusStats as LS
+import SparseDiff as SD
+import Progress
+import Profiling
+import ClusterStability as CS
+import DistributionTests as DT
 
 import argparse
 import os
 import logging
+import tempfile
 import warnings
+from functools import lru_cache
+from multiprocessing import Pool, cpu_count
 
 
 # Get the directory where this script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
+cpu_count = int(os.getenv('SLURM_CPUS_PER_TASK') or cpu_count())
+
+# Loci per task in multi-input mode when no block size is given
+DEFAULT_BLOCK_SIZE = 2000
+
+# Up to this many non-missing values (and without zeros) scipy uses the exact Wilcoxon distribution
+EXACT_MAX_N = 50
+
+# Values per chunk of rows when a dense diff csv is parsed once and spilled column-major for block reads
+SPILL_CHUNK_VALUES = 2 ** 22
+
 def split_to_bed(df: pd.DataFrame, colname) -> pd.DataFrame:
     """ 
     Splits the given column into 3 columns with titles Chromosome, Start, End
@@ -27,24 +47,41 @@ def split_to_bed(df: pd.DataFrame, colname) -> pd.DataFrame:
     return df
 
 
-def get_COSMIC_regions(df: pd.DataFrame) -> pd.DataFrame:
+def load_COSMIC() -> pr.PyRanges:
+    path = os.path.join(script_dir, 'refFiles', 'COSMIC.csv')
+    cosmic_data = pd.read_csv(path)
+    return pr.PyRanges(cosmic_data)
+
+
+def get_COSMIC_regions(df: pd.DataFrame, pyranges_cosmic: pr.PyRanges = None) -> pd.DataFrame:
     """
     Get COSMIC regions from the dataframe.
     Args:
         df: Dataframe with locations of mutations.
+        pyranges_cosmic: Preloaded COSMIC regions (default: load from refFiles).
     Returns:
         df: Dataframe with added COSMIC annotations
     """
+    # Load the COSMIC data
+    if pyranges_cosmic is None:
+        pyranges_cosmic = load_COSMIC()
+
+    columns_to_rename = {
+        'Tumour Types(Somatic)': 'COSMIC_TumorType', 
+        'Tissue Type': 'COSMIC_TissueType',
+        'Gene Symbol': 'COSMIC_GeneSymbol', 
+        'Tier': 'COSMIC_Tier'
+    }
+    if df.empty:
+        # pyranges cannot join an empty frame, return the columns of the join
+        cosmic_columns = [c for c in pyranges_cosmic.columns if c not in ['Chromosome', 'Start', 'End']]
+        return df.reindex(columns=list(df.columns) + cosmic_columns + ['COSMIC_loc']).rename(columns=columns_to_rename)
+
     df_bed_format = split_to_bed(df, 'ReferenceRegion')
 
     # Convert pandas DataFrames to PyRanges objects
     pyranges_df = pr.PyRanges(df_bed_format)
 
-    # Load the COSMIC data
-    path = os.path.join(script_dir, 'refFiles', 'COSMIC.csv')
-    cosmic_data = pd.read_csv(path)
-    pyranges_cosmic = pr.PyRanges(cosmic_data)
-
     # Join the data with COSMIC regions using a left join
     joined_pyranges = pyranges_df.join(pyranges_cosmic, how='left')
     joined_df = joined_pyranges.df
@@ -57,20 +94,14 @@ def get_COSMIC_regions(df: pd.DataFrame) -> pd.DataFrame:
     joined_df.drop(columns=columns_to_drop, inplace=True)
 
     # Rename columns for clarity
-    columns_to_rename = {
-        'Tumour Types(Somatic)': 'COSMIC_TumorType', 
-        'Tissue Type': 'COSMIC_TissueType',
-        'Gene Symbol': 'COSMIC_GeneSymbol', 
-        'Tier': 'COSMIC_Tier'
-    }
     joined_df.rename(columns=columns_to_rename, inplace=True)
 
     return joined_df
 
 
-def calculate_wilcoxon_pvals(df: pd.DataFrame) -> np.ndarray:
+def calculate_raw_wilcoxon_pvals(df: pd.DataFrame) -> np.ndarray:
     """
-    Calculate Wilcoxon p-values for each column in a dataframe.
+    Calculate uncorrected Wilcoxon p-values for each column in a dataframe.
     Args:
         df: Dataframe with rows as samples and cols as regions.
     Returns:
@@ -84,8 +115,59 @@ def calculate_wilcoxon_pvals(df: pd.DataFrame) -> np.ndarray:
                 logging.warning('Exact p-value calculation switched to normal approximation due to presence of zeros.')
             elif str(warning.message) == 'Sample size too small for normal approximation.':
                 logging.warning('Sample size is too small for normal approximation.')
+    return pvals
+
+
+def signed_rank_normal_pvals(r_plus, r_minus, count, n_zero, ties) -> np.ndarray:
+    """
+    Two-sided Wilcoxon signed-rank p-values (zero_method='pratt') by normal approximation,
+    as scipy computes them, from per-locus rank sums. Lets compact representations of the
+    diffs skip building dense columns.
+    Args:
+        r_plus: Rank sums of the positive values, zeros included in the ranking.
+        r_minus: Rank sums of the negative values.
+        count: Number of non-missing values.
+        n_zero: Number of zeros.
+        ties: Sum of t * (t^2 - 1) over the groups of t tied non-zero absolute values.
+    Returns:
+        pvals: Array of p-values, nan where all values are zero.
+    """
+    T = np.minimum(r_plus, r_minus)
+    mn = count * (count + 1) * 0.25 - n_zero * (n_zero + 1) * 0.25
+    se = count * (count + 1) * (2 * count + 1) - n_zero * (n_zero + 1) * (2 * n_zero + 1) - 0.5 * ties
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (T - mn) / np.sqrt(se / 24)
+    pvals = 2 * norm.sf(np.abs(z))
+    pvals[n_zero == count] = np.nan
+    return pvals
+
+
+def correct_pvals(pvals: np.ndarray) -> np.ndarray:
+    """
+    Benjamini-Hochberg correction of p-values.
+    Args:
+        pvals: Array of raw p-values.
+    Returns:
+        pvals_corrected: Array of corrected p-values.
+    """
+    if len(pvals) == 0:
+        # multipletests divides by the number of tests
+        return np.array([], dtype=float)
     _, pvals_corrected, _, _ = multipletests(pvals, alpha=0.05, method='fdr_bh')
-    return pvals, pvals_corrected
+    return pvals_corrected
+
+
+def calculate_wilcoxon_pvals(df: pd.DataFrame) -> np.ndarray:
+    """
+    Calculate Wilcoxon p-values for each column in a dataframe.
+    Args:
+        df: Dataframe with rows as samples and cols as regions.
+    Returns:
+        pvals: Array of p-values for each region.
+        pvals_corrected: Array of BH corrected p-values.
+    """
+    pvals = calculate_raw_wilcoxon_pvals(df)
+    return pvals, correct_pvals(pvals)
 
 
 
@@ -99,22 +181,162 @@ def process_df(df: pd.DataFrame) -> pd.DataFrame:
     """
     if 'sample_id' in df.columns:
         df.drop(columns=['sample_id'], axis=1, inplace=True)
-    df = df.loc[:, (df.fillna(0) != 0).any(axis=0)]
+    # boolean masks only, avoids a full float copy of the matrix
+    df = df.loc[:, (df.notna() & df.ne(0)).any(axis=0)]
     return df
 
 
-def add_motif_info(df: pd.DataFrame) -> pd.DataFrame:
+def is_sparse_path(path: str) -> bool:
+    """
+    Sparse diffs written by ExpansionCooker --sparse are .npz files, dense ones are csv.
+    """
+    return path.endswith('.npz')
+
+
+def is_spilled_path(path: str) -> bool:
+    """
+    Dense diffs spilled by spill_diff are directories.
+    """
+    return os.path.isdir(path)
+
+
+def spill_diff(path: str, directory: str, chunk_values: int = SPILL_CHUNK_VALUES) -> str:
+    """
+    Parse a dense diff csv once, about chunk_values values at a time, and write every chunk of rows
+    transposed (loci by rows) to directory. A range of locus columns is then one contiguous read per
+    chunk, instead of a re-parse of the whole csv per block. A sample_id column is dropped, as in process_df.
+    Args:
+        path: Path to a ExpansionCooker diff (or case, control) csv.
+        directory: Output directory, created if missing.
+    Returns:
+        directory: To read blocks from with read_diff_columns and read_diff_blocks in place of path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    header = read_diff_header(path)
+    chunk_rows = max(1, chunk_values // max(len(header), 1))
+    indexes, columns = [], None
+    # the chunks already bound the memory, low_memory would only split them again
+    for i, chunk in enumerate(pd.read_csv(path, index_col=0, chunksize=chunk_rows, low_memory=False)):
+        chunk = chunk.drop(columns=['sample_id']) if 'sample_id' in chunk.columns else chunk
+        chunk = chunk.apply(pd.to_numeric, errors='coerce') if (chunk.dtypes == object).any() else chunk
+        np.save(os.path.join(directory, f'chunk_{i}.npy'), np.ascontiguousarray(chunk.values.astype(float).T))
+        indexes.append(chunk.index)
+        columns = chunk.columns
+    if columns is None:
+        # header only
+        columns = header.drop('sample_id', errors='ignore')
+        np.save(os.path.join(directory, 'chunk_0.npy'), np.empty((len(columns), 0)))
+        indexes = [pd.read_csv(path, index_col=0).index]
+    index = indexes[0].append(indexes[1:])
+    pd.to_pickle({'index': index, 'columns': columns}, os.path.join(directory, 'meta.pkl'))
+    return directory
+
+
+def read_spilled(directory: str, cols) -> pd.DataFrame:
+    """
+    Locus columns of a spilled diff, cols being a slice or an array of column positions.
+    """
+    meta = pd.read_pickle(os.path.join(directory, 'meta.pkl'))
+    num_chunks = sum(name.startswith('chunk_') for name in os.listdir(directory))
+    values = np.concatenate([np.load(os.path.join(directory, f'chunk_{i}.npy'), mmap_mode='r')[cols]
+                             for i in range(num_chunks)], axis=1)
+    return pd.DataFrame(values.T, index=meta['index'], columns=meta['columns'][cols])
+
+
+def _spill_task(task):
+    path, directory = task
+    return path, spill_diff(path, directory)
+
+
+def spill_diffs(paths: list, directory: str, pool) -> dict:
+    """
+    Spill the dense diff csvs among paths to subdirectories of directory, one file per pool task.
+    Returns:
+        sources: Dict of every path to the path its blocks are read from (itself for sparse diffs).
+    """
+    sources = {path: path for path in paths}
+    dense = [path for path in paths if not is_sparse_path(path)]
+    tasks = [(path, os.path.join(directory, str(i))) for i, path in enumerate(dense)]
+    for path, spilled in pool.imap_unordered(_spill_task, tasks):
+        sources[path] = spilled
+    return sources
+
+
+def read_diff_header(path: str) -> pd.Index:
+    """
+    Read only the region names from a diff file.
+    Args:
+        path: Path to a ExpansionCooker diff file, or a spilled diff.
+    Returns:
+        columns: Regions in the file, in file order.
+    """
+    if is_sparse_path(path):
+        return SD.SparseDiff.read_regions(path)
+    if is_spilled_path(path):
+        return pd.read_pickle(os.path.join(path, 'meta.pkl'))['columns']
+    # nrows=0 filters the empty columns in quadratic time in pandas, one row is much faster on wide files
+    return pd.read_csv(path, index_col=0, nrows=1).columns
+
+
+def read_diff_blocks(path: str, block_size: int):
+    """
+    Read a diff file in blocks of locus columns, so only one block is in memory at a time.
+    A csv is parsed once and spilled to a temporary directory (see spill_diff) for the blocks.
+    Args:
+        path: Path to a ExpansionCooker diff file, or a spilled diff.
+        block_size: Number of locus columns per block.
+    Yields:
+        df: Dataframe with rows as samples and cols as the regions of the block.
+    """
+    if not is_spilled_path(path):
+        with tempfile.TemporaryDirectory() as directory:
+            yield from read_diff_blocks(spill_diff(path, directory), block_size)
+        return
+    num_cols = len(read_diff_header(path))
+    for start in range(0, num_cols, block_size):
+        yield read_diff_columns(path, start, min(start + block_size, num_cols))
+
+
+def read_diff_columns(path: str, start: int, stop: int) -> pd.DataFrame:
+    """
+    Read the locus columns start to stop (exclusive, counted without the sample index) of a diff file.
+    Spilled diffs are sliced, csvs are parsed whole, so blocks of one file should be read from its spill.
+    """
+    if is_spilled_path(path):
+        return read_spilled(path, slice(start, stop))
+    # column 0 is the sample index
+    usecols = [0] + list(range(start + 1, stop + 1))
+    return pd.read_csv(path, index_col=0, usecols=usecols)
+
+
+def load_locus_structures() -> pd.DataFrame:
+    path = os.path.join(script_dir, 'refFiles', 'locus_structures.csv')
+    loc_to_motif = pd.read_csv(path)
+    loc_to_motif['ReferenceRegion'] = loc_to_motif['ReferenceRegion'].str.lstrip('chr')
+    return loc_to_motif
+
+
+def load_annotations() -> dict:
+    """
+    Load the reference tables used by annotate_features, to share them across many feature tables.
+    """
+    return {'loc_to_motif': load_locus_structures(), 'pyranges_cosmic': load_COSMIC()}
+
+
+def add_motif_info(df: pd.DataFrame, loc_to_motif: pd.DataFrame = None) -> pd.DataFrame:
     """ 
     Add motif information to the dataframe, from the locus_structures.csv file.
     Args:
         df: Dataframe with rows as samples and cols as regions.
+        loc_to_motif: Preloaded locus structures (default: load from refFiles).
     Returns:
         df: Dataframe with motif information added.
     """
-    path = os.path.join(script_dir, 'refFiles', 'locus_structures.csv')
-    loc_to_motif = pd.read_csv(path)
-    loc_to_motif['ReferenceRegion'] = loc_to_motif['ReferenceRegion'].str.lstrip('chr')
-    df = df.merge(loc_to_motif[['ReferenceRegion', 'LocusStructure']], on='ReferenceRegion', how='left')
+    if loc_to_motif is None:
+        loc_to_motif = load_locus_structures()
+    columns = list(df.columns) + ['LocusStructure']
+    # merging an empty frame moves the key column, keep the order
+    df = df.merge(loc_to_motif[['ReferenceRegion', 'LocusStructure']], on='ReferenceRegion', how='left')[columns]
     return df
 
 
@@ -174,17 +396,61 @@ def cluster_and_outliers(x: pd.Series) -> list:
     return [len(means), means, sds, out3, out5]  # Return a list instead of a tuple
 
     
-def process_and_extract_features(df) -> pd.DataFrame:
-    logging.debug("Processing and extracting features...")
-    
-    df = process_df(df)
+def assemble_features(regions, raw_pvals, columns, prop_nonzero, counts, std) -> pd.DataFrame:
+    """
+    Build the extract_block_features table from per-locus statistics computed on another
+    representation of the diffs (LocusStats, SparseDiff).
+    Args:
+        regions: Regions of the loci.
+        raw_pvals: Uncorrected Wilcoxon p-values.
+        columns: Iterable over the non-missing values of each locus, for the cluster features.
+        prop_nonzero, counts, std: Arrays with one value per locus.
+    Returns:
+        features_df: One row per region.
+    """
+    features_df = pd.DataFrame({'ReferenceRegion': regions})
+    features_df['raw_pvals'] = raw_pvals
 
-    features_df = pd.DataFrame({'ReferenceRegion': df.columns})
+    clusts = [cluster_and_outliers(pd.Series(values)) for values in columns]
+    clusts = pd.DataFrame(clusts, columns=['num_clusters', 'cluster_means', 'cluster_sds', 'out3', 'out5'])
+    features_df = pd.concat([features_df, clusts], axis=1)
+
+    features_df['prop_nonzero'] = prop_nonzero
+    features_df['counts'] = counts
+    features_df['std'] = std
+    return features_df
+
+
+def empty_block_features(n_bootstrap: int = 0) -> pd.DataFrame:
+    """
+    extract_block_features of a diff without any loci left, e.g. all zero or missing.
+    """
+    columns = ['ReferenceRegion', 'raw_pvals', 'num_clusters', 'cluster_means', 'cluster_sds', 'out3', 'out5',
+               'prop_nonzero', 'counts', 'std']
+    if n_bootstrap:
+        columns += ['stability', 'stability_num_clusters']
+    return pd.DataFrame(columns=columns)
 
 
-    features_df['raw_pvals'], features_df['corrected_pvals'] = calculate_wilcoxon_pvals(df)
+def extract_block_features(df: pd.DataFrame, n_bootstrap: int = 0) -> pd.DataFrame:
+    """
+    Per-locus features that only depend on the locus' own column.
+    Multiple testing correction and annotations are left to annotate_features.
+    Args:
+        df: Processed dataframe with rows as samples and cols as regions.
+        n_bootstrap: If given, add the stability of the cluster structure over this many donor resamplings.
+    Returns:
+        features_df: One row per region.
+    """
+    if df.shape[1] == 0:
+        return empty_block_features(n_bootstrap)
+    features_df = pd.DataFrame({'ReferenceRegion': df.columns})
+
+    Progress.set_stage('wilcoxon')
+    features_df['raw_pvals'] = calculate_raw_wilcoxon_pvals(df)
     logging.info("Calculated Wilcoxon p-values.")
 
+    Progress.set_stage('clustering')
     clusts = cluster_features(df)
     clusts = clusts.reset_index().rename(columns={'index': 'ReferenceRegion'})
     features_df = features_df.merge(clusts, how = 'left', on='ReferenceRegion')
@@ -201,28 +467,366 @@ def process_and_extract_features(df) -> pd.DataFrame:
     features_df['std'] = df.std().values
     logging.debug("Calculated standard deviation.")
 
-    features_df = add_motif_info(features_df)
+    if n_bootstrap:
+        Progress.set_stage('bootstrap')
+        stability = CS.bootstrap_stability(df, n_bootstrap)
+        features_df = features_df.merge(stability, how='left', on='ReferenceRegion')
+        logging.info(f"Calculated cluster stability over {n_bootstrap} bootstrap samples.")
+
+    return features_df
+
+
+def annotate_features(features_df: pd.DataFrame, annotations: dict = None) -> pd.DataFrame:
+    """
+    Add corrected p-values, motif and COSMIC annotations to the per-locus features.
+    Args:
+        features_df: Features of all loci, as given by extract_block_features.
+        annotations: Preloaded tables from load_annotations (default: load from refFiles).
+    Returns:
+        features_df: Annotated features.
+    """
+    annotations = annotations or {}
+    Progress.set_stage('annotating')
+    corrected = correct_pvals(features_df['raw_pvals'].values)
+    features_df.insert(features_df.columns.get_loc('raw_pvals') + 1, 'corrected_pvals', corrected)
+
+    features_df = add_motif_info(features_df, annotations.get('loc_to_motif'))
     logging.debug("Added motif information.")
 
-    features_df = get_COSMIC_regions(features_df)
+    features_df = get_COSMIC_regions(features_df, annotations.get('pyranges_cosmic'))
     logging.debug("Added COSMIC regions.")
 
     return features_df
 
-def process_features(input_df: pd.DataFrame, name: str, outdir: str) -> None:
 
-    feats_df = process_and_extract_features(input_df)
+def process_and_extract_features(df, n_bootstrap: int = 0) -> pd.DataFrame:
+    logging.debug("Processing and extracting features...")
+
+    df = process_df(df)
+    features_df = extract_block_features(df, n_bootstrap)
+    return annotate_features(features_df)
+
+
+def stream_and_extract_features(path: str, block_size: int, n_bootstrap: int = 0) -> pd.DataFrame:
+    """
+    Same features as process_and_extract_features, reading the diff file in locus column blocks.
+    Only the per-locus features are kept between blocks, BH correction and annotation run once at the end.
+    Args:
+        path: Path to a ExpansionCooker diff file.
+        block_size: Number of locus columns per block.
+        n_bootstrap: Bootstrap samples for the cluster stability, 0 to skip it.
+    Returns:
+        features_df: Annotated features of all loci.
+    """
+    logging.debug("Streaming and extracting features...")
+
+    num_cols = len(read_diff_header(path))
+    Progress.add_total(-(-num_cols // block_size))
+    block_feats = []
+    for i, block in enumerate(read_diff_blocks(path, block_size)):
+        block = process_df(block)
+        Progress.update(loci=block.shape[1])
+        if block.shape[1] == 0:
+            continue
+        block_feats.append(extract_block_features(block, n_bootstrap))
+        logging.info(f"Extracted features for block {i} ({block.shape[1]} loci).")
+
+    if block_feats:
+        features_df = pd.concat(block_feats, ignore_index=True)
+    else:
+        # every block was all zero or missing
+        logging.warning("No loci with non-zero differences.")
+        features_df = empty_block_features(n_bootstrap)
+    return annotate_features(features_df)
+
+
+def update_stats_and_extract_features(path: str, stats_path: str, block_size: int = None) -> pd.DataFrame:
+    """
+    Merge the donors of a diff file into a LocusStats store and compute the features from the store.
+    If the store does not exist yet it is created from the diff file alone.
+    Args:
+        path: Path to a ExpansionCooker diff file, with only the new donors.
+        stats_path: Path of the LocusStats store, updated in place.
+        block_size: If given, read the diff file in blocks of this many loci.
+    Returns:
+        features_df: Annotated features of all loci over old and new donors.
+    """
+    if is_sparse_path(path):
+        new_stats = LS.LocusStats.from_sparse(SD.SparseDiff.load(path))
+    elif block_size:
+        new_stats = None
+        for block in read_diff_blocks(path, block_size):
+            block_stats = LS.LocusStats.from_frame(block)
+            new_stats = block_stats if new_stats is None else new_stats.concat(block_stats)
+    else:
+        new_stats = LS.LocusStats.from_frame(pd.read_csv(path, index_col=0))
+
+    if os.path.exists(stats_path):
+        stats = LS.LocusStats.load(stats_path).merge(new_stats)
+        logging.info(f"Merged {new_stats.n_rows} new rows into {stats_path} ({stats.n_rows} rows).")
+    else:
+        stats = new_stats
+    stats.save(stats_path)
+    logging.info(f"Stats saved to {stats_path}")
+
+    return annotate_features(stats.features())
+
+
+def disease_from_path(path: str) -> str:
+    """
+    Disease name of a {disease}_diff file.
+    """
+    name = os.path.basename(path).split('.')[0]
+    return name[:-len('_diff')] if name.endswith('_diff') else name
+
+
+@lru_cache(maxsize=1)
+def _load_sparse(path: str):
+    # tasks of one disease tend to follow each other, keep the last sparse file per worker
+    return SD.SparseDiff.load(path)
+
+
+def _extract_block_task(task):
+    return Profiling.maybe_profile(_extract_block, task)
+
+
+def _extract_block(task):
+    disease, path, start, stop, n_bootstrap = task
+    if is_sparse_path(path):
+        block = _load_sparse(path).columns(start, stop).drop_zero_columns()
+        if len(block.regions) == 0:
+            return disease, start, None, Progress.worker_usage()
+        feats = block.features()
+        if n_bootstrap:
+            feats = feats.merge(CS.bootstrap_stability(block.to_frame(), n_bootstrap), how='left', on='ReferenceRegion')
+        return disease, start, feats, Progress.worker_usage()
 
+    block = process_df(read_diff_columns(path, start, stop))
+    if block.shape[1] == 0:
+        return disease, start, None, Progress.worker_usage()
+    return disease, start, extract_block_features(block, n_bootstrap), Progress.worker_usage()
+
+
+def process_many_features(paths: list, name: str, outdir: str, block_size: int = None, pan_fdr: bool = False,
+                          profile: tuple = None, n_bootstrap: int = 0, dist_tests: bool = False,
+                          hists_dir: str = None) -> pd.DataFrame:
+    """
+    Extract features for many diff files on one worker pool, loading the annotations once.
+    Every file is split in blocks of loci and all blocks of all files share the pool.
+    Writes {disease}_feats.csv per file, with BH correction within the disease, and a
+    combined long table {name}_feats.csv with a disease column.
+    Args:
+        paths: Paths to ExpansionCooker diff files, one per disease.
+        name: Prefix of the combined output.
+        outdir: Output directory.
+        block_size: Number of loci per task (default: DEFAULT_BLOCK_SIZE).
+        pan_fdr: Also BH correct the p-values across the loci of all diseases, as pan_corrected_pvals.
+        profile: If given, (profile_dir, blocks, interval, mode) for Profiling.configure in every worker.
+        n_bootstrap: Bootstrap samples for the cluster stability, 0 to skip it.
+        dist_tests: Add the case vs control distribution tests, from the store in hists_dir or the matrices next to each diff.
+    Returns:
+        combined_df: Features of all diseases.
+    """
+    block_size = block_size or DEFAULT_BLOCK_SIZE
+    annotations = load_annotations()
+
+    block_feats = {}
+    with Pool(processes=cpu_count, initializer=Profiling.configure if profile else None, initargs=profile or ()) as pool, \
+            tempfile.TemporaryDirectory() as spill_dir:
+        # every csv is parsed once, its blocks are then sliced from the spill
+        Progress.set_stage('spilling')
+        sources = spill_diffs(paths, spill_dir, pool)
+
+        tasks = []
+        for path in paths:
+            disease = disease_from_path(path)
+            num_cols = len(read_diff_header(sources[path]))
+            tasks += [(disease, sources[path], start, min(start + block_size, num_cols), n_bootstrap)
+                      for start in range(0, num_cols, block_size)]
+        logging.info(f"Extracting features for {len(paths)} diseases in {len(tasks)} blocks.")
+        Progress.add_total(len(tasks))
+        Progress.set_stage('blocks')
+
+        for disease, start, feats, usage in pool.imap_unordered(_extract_block_task, tasks):
+            if feats is not None:
+                block_feats.setdefault(disease, []).append((start, feats))
+            Progress.update(loci=0 if feats is None else len(feats), usage=usage, item=f'{disease}:{start}')
+            logging.debug(f"Finished block {start} of {disease}.")
+
+    all_feats = []
+    for path in paths:
+        disease = disease_from_path(path)
+        if disease not in block_feats:
+            logging.warning(f"No loci with non-zero differences for {disease}.")
+            continue
+        feats = [f for _, f in sorted(block_feats.pop(disease), key=lambda x: x[0])]
+        feats_df = annotate_features(pd.concat(feats, ignore_index=True), annotations)
+        if dist_tests:
+            feats_df = add_distribution_tests(feats_df, path, hists_dir, block_size)
+        write_features(feats_df, disease, outdir)
+        feats_df.insert(0, 'disease', disease)
+        all_feats.append(feats_df)
+
+    if all_feats:
+        combined_df = pd.concat(all_feats, ignore_index=True)
+    else:
+        logging.warning("No loci with non-zero differences in any disease, the combined table is empty.")
+        combined_df = annotate_features(empty_block_features(n_bootstrap), annotations)
+        if dist_tests:
+            combined_df = combined_df.reindex(columns=list(combined_df.columns) + DT.TEST_COLUMNS)
+        combined_df.insert(0, 'disease', pd.Series(dtype=str))
+    if pan_fdr:
+        # one test per disease and locus, the COSMIC join repeats loci overlapping several genes
+        loci = combined_df.drop_duplicates(['disease', 'ReferenceRegion'])[['disease', 'ReferenceRegion', 'raw_pvals']]
+        loci = loci.assign(pan_corrected_pvals=correct_pvals(loci['raw_pvals'].values))
+        pan = combined_df[['disease', 'ReferenceRegion']].merge(loci, how='left', on=['disease', 'ReferenceRegion'])
+        combined_df.insert(combined_df.columns.get_loc('corrected_pvals') + 1, 'pan_corrected_pvals',
+                           pan['pan_corrected_pvals'].values)
+    write_features(combined_df, name, outdir)
+    return combined_df
+
+
+def ragged_clusters(feats_df: pd.DataFrame) -> dict:
+    """
+    Ragged array layout of the cluster features: the means and sds of all loci are
+    flattened into one array each, the clusters of row i being offsets[i]:offsets[i + 1].
+    Args:
+        feats_df: Features with cluster_means and cluster_sds as lists.
+    Returns:
+        clusters: Dict of arrays, one entry per row of feats_df for all but means and sds.
+    """
+    lengths = feats_df['cluster_means'].apply(len).values
+    clusters = {
+        'ReferenceRegion': feats_df['ReferenceRegion'].values.astype(str),
+        'num_clusters': feats_df['num_clusters'].values.astype(np.int32),
+        'offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        'means': np.array([m for means in feats_df['cluster_means'] for m in means], dtype=float),
+        'sds': np.array([sd for sds in feats_df['cluster_sds'] for sd in sds], dtype=float),
+    }
+    if 'disease' in feats_df.columns:
+        clusters['disease'] = feats_df['disease'].values.astype(str)
+    return clusters
+
+
+def write_cluster_features(feats_df: pd.DataFrame, path: str) -> None:
+    with open(path, 'wb') as f:
+        np.savez(f, **ragged_clusters(feats_df))
+
+
+def read_cluster_features(path: str) -> dict:
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def cluster_table(clusters: dict) -> pd.DataFrame:
+    """
+    Long table with one row per cluster, ordered by absolute mean within a locus as in cluster_and_outliers.
+    Args:
+        clusters: Ragged cluster features, as given by read_cluster_features.
+    Returns:
+        df: Cols ['ReferenceRegion', ('disease',) 'cluster', 'mean', 'sd']
+    """
+    lengths = np.diff(clusters['offsets'])
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    df = pd.DataFrame({'ReferenceRegion': clusters['ReferenceRegion'][rows]})
+    if 'disease' in clusters:
+        df['disease'] = clusters['disease'][rows]
+    df['cluster'] = np.arange(len(rows)) - clusters['offsets'][rows]
+    df['mean'] = clusters['means']
+    df['sd'] = clusters['sds']
+    return df
+
+
+def one_cluster_mask(clusters: dict, min_abs_mean: float = 3) -> np.ndarray:
+    """
+    Rows with exactly one cluster whose absolute mean is at least min_abs_mean.
+    """
+    lengths = np.diff(clusters['offsets'])
+    first = np.minimum(clusters['offsets'][:-1], max(len(clusters['means']) - 1, 0))
+    first_means = clusters['means'][first] if len(clusters['means']) else np.zeros(len(lengths))
+    return (clusters['num_clusters'] == 1) & (lengths == 1) & (np.abs(first_means) >= min_abs_mean)
+
+
+def write_features(feats_df: pd.DataFrame, name: str, outdir: str) -> None:
     output_path = os.path.join(outdir, f"{name}_feats.csv")
     feats_df.to_csv(output_path, index=False)
     logging.info(f"Feats saved to {output_path}")
 
+    clusters_path = os.path.join(outdir, f"{name}_clusters.npz")
+    write_cluster_features(feats_df, clusters_path)
+    logging.info(f"Cluster features saved to {clusters_path}")
+
+
+def process_features(input_df: pd.DataFrame, name: str, outdir: str, n_bootstrap: int = 0) -> None:
+
+    feats_df = process_and_extract_features(input_df, n_bootstrap)
+    write_features(feats_df, name, outdir)
+
+
+def sparse_stability(sd: 'SD.SparseDiff', n_bootstrap: int, block_size: int) -> pd.DataFrame:
+    """
+    Cluster stability of a sparse diff, densifying block_size loci at a time.
+    """
+    sd = sd.drop_zero_columns()
+    num_cols = len(sd.regions)
+    return pd.concat([CS.bootstrap_stability(sd.columns(start, min(start + block_size, num_cols)).to_frame(), n_bootstrap)
+                      for start in range(0, num_cols, block_size)], ignore_index=True)
+
+
+def add_distribution_tests(feats_df: pd.DataFrame, path: str, hists_dir: str = None, block_size: int = None) -> pd.DataFrame:
+    """
+    Add the case vs control distribution tests of the disease of a diff file to its features.
+    """
+    Progress.set_stage('distribution tests')
+    tests_df = DT.distribution_tests(path, hists_dir, block_size)
+    if tests_df is None:
+        return feats_df
+    logging.info("Calculated case vs control distribution tests.")
+    return feats_df.merge(tests_df, how='left', on='ReferenceRegion')
+
+
+def process_single_input(path: str, name: str, outdir: str, stats_path: str = None, block_size: int = None,
+                         n_bootstrap: int = 0, dist_tests: bool = False, hists_dir: str = None) -> None:
+    """
+    Extract and write the features of one diff file, with the mode given by the options of main.
+    """
+    if stats_path:
+        if n_bootstrap:
+            logging.warning("A LocusStats store has no donors to resample, skipping the cluster stability.")
+        feats_df = update_stats_and_extract_features(path, stats_path, block_size)
+    elif is_sparse_path(path):
+        sd = SD.SparseDiff.load(path)
+        feats_df = sd.features()
+        if n_bootstrap:
+            feats_df = feats_df.merge(sparse_stability(sd, n_bootstrap, block_size or DEFAULT_BLOCK_SIZE),
+                                      how='left', on='ReferenceRegion')
+        feats_df = annotate_features(feats_df)
+    elif block_size:
+        feats_df = stream_and_extract_features(path, block_size, n_bootstrap)
+    else:
+        feats_df = process_and_extract_features(pd.read_csv(path, index_col=0), n_bootstrap)
+
+    if dist_tests:
+        feats_df = add_distribution_tests(feats_df, path, hists_dir, block_size)
+    write_features(feats_df, name, outdir)
+
 
 def init_argparse():
     parser = argparse.ArgumentParser(description='Create features from ExpansionCooker output.')
-    parser.add_argument('input', metavar='Diff_File', type=str, help='Location of the Expansion Cooker difference file')
-    parser.add_argument('--name', '-n', help='Prefix for output file (default same as input file)')
+    parser.add_argument('input', metavar='Diff_File', type=str, nargs='+', help='Location of the Expansion Cooker difference file (.csv, or .npz for sparse diffs). Several {disease}_diff files are processed together on one pool.')
+    parser.add_argument('--name', '-n', help='Prefix for output file (default same as input file, "pancancer" for the combined table of several inputs)')
     parser.add_argument('--outdir', '-o', default='', help='Output directory for the features. (default: script running directory)')
+    parser.add_argument('--block-size', '-b', type=int, default=None, help='Stream the diff file in blocks of this many loci instead of loading it whole. (default: load whole file)')
+    parser.add_argument('--stats', '-s', default=None, help='LocusStats store (.npz) to merge the input donors into; features are then computed over all donors in the store. Created if missing. Single input only.')
+    parser.add_argument('--progress-interval', type=float, default=60, help='Seconds between progress lines in the log, 0 to disable. (Default: 60)')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics of the run on this port (host from METRICS_HOST, default 127.0.0.1). (Default: off)')
+    parser.add_argument('--profile', type=int, default=0, help='Profile the first N blocks of every worker in multi-input mode, or the whole run for one input, and write the merged {name}_profile.pstats or .collapsed and .txt to the outdir. (Default: 0, off)')
+    parser.add_argument('--profile-mode', default='cprofile', choices=Profiling.MODES, help='Profiler of --profile: cProfile (.pstats) or stack sampling (.collapsed, for flame graphs). (Default: cprofile)')
+    parser.add_argument('--profile-interval', type=float, default=5, help='Milliseconds of CPU time between stack samples with --profile-mode sample. (Default: 5)')
+    parser.add_argument('--bootstrap', type=int, default=0, help='Add the stability of the cluster structure of every locus over this many donor resamplings. (Default: 0, off)')
+    parser.add_argument('--dist-tests', default=False, action='store_true', help='Add KS, chi-square and EMD tests of the case vs control distribution of every locus, from the {disease}_case/control.csv next to the diff file. (Default: False)')
+    parser.add_argument('--hists-dir', default=None, help='HistogramStore folder to take the case and control histograms of --dist-tests from instead. (Default: None)')
+    parser.add_argument('--pan-fdr', default=False, action='store_true', help='With several inputs, also correct p-values across all diseases. (Default: False)')
     return parser
 
 
@@ -247,14 +851,38 @@ def main():
     
     parser = init_argparse()
     args = parser.parse_args()
-
-    if not os.path.exists(args.input):
-        logging.error(f"{args.input} does not exist.")
+    if args.stats and len(args.input) > 1:
+        parser.error('--stats takes a single input.')
+    if args.pan_fdr and len(args.input) == 1:
+        parser.error('--pan-fdr needs several inputs.')
+
+    missing = [path for path in args.input if not os.path.exists(path)]
+    for path in missing:
+        logging.error(f"{path} does not exist.")
+    if missing:
         return
 
-    df = pd.read_csv(args.input, index_col=0)
-    name = args.name or os.path.basename(args.input).split('.')[0]
-    process_features(df, name, args.outdir)
- 
+    job = args.name or ('pancancer' if len(args.input) > 1 else os.path.basename(args.input[0]).split('.')[0])
+    profile = None
+    if args.profile:
+        profile_dir = os.path.join(args.outdir, f'.{job}_profile')
+        os.makedirs(profile_dir, exist_ok=True)
+        profile = (profile_dir, args.profile, args.profile_interval / 1000, args.profile_mode)
+
+    with Progress.Progress(job, unit='blocks', interval=args.progress_interval, port=args.metrics_port):
+        if len(args.input) > 1:
+            process_many_features(args.input, job, args.outdir, args.block_size, args.pan_fdr, profile, args.bootstrap,
+                                  args.dist_tests, args.hists_dir)
+        else:
+            if profile:
+                # a single input runs in this process, profile all of it
+                Profiling.configure(*profile)
+            Profiling.maybe_profile(process_single_input, args.input[0], job, args.outdir, args.stats, args.block_size,
+                                    args.bootstrap, args.dist_tests, args.hists_dir)
+
+    if profile:
+        Profiling.merge_profiles(profile[0], os.path.join(args.outdir, job))
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -6,11 +6,72 @@ import seaborn as sns
 from matplotlib.lines import Line2D
 from matplotlib.patches import Patch
 import os
+import argparse
+from functools import lru_cache
+from multiprocessing import Pool, cpu_count
+import HistogramStore as HS
+import LocusIndex as LI
 
 
 # Locations of the data folders
 diff_folder = os.getenv('DIFF_FOLDER') or "../data/CookerOut/"
 genotypes_folder = os.getenv('GENO_FOLDER') or "../data/CookerOut/"
+# Folder of precomputed histograms (HistogramStore.py), used instead of the csvs when set
+hist_folder = os.getenv('HIST_FOLDER')
+# Folder of the locus-major index across diseases (LocusIndex.py), used for cross-disease plots when set
+locus_index_folder = os.getenv('LOCUS_INDEX')
+
+
+@lru_cache(maxsize=None)
+def load_histograms(disease):
+    """
+    Precomputed histograms of a disease, or None if there is no histogram store for it.
+    """
+    if not hist_folder:
+        return None
+    path = HS.store_path(hist_folder, disease)
+    return HS.DiseaseHistograms(path) if os.path.exists(path) else None
+
+
+def locus_histogram(locus, disease, kind):
+    """
+    (values, counts) of a locus from the histogram store, None if not in the store.
+    """
+    hists = load_histograms(disease)
+    return hists.get(kind, locus) if hists is not None else None
+
+
+@lru_cache(maxsize=1)
+def load_locus_index():
+    if not locus_index_folder or not os.path.exists(locus_index_folder):
+        return None
+    return LI.LocusIndex(locus_index_folder)
+
+
+def load_locus_across_diseases(locus, diseases):
+    """
+    Case, control and diff values of a locus for all diseases in one read of the locus index,
+    or None if there is no index or the locus is not in it.
+    """
+    index = load_locus_index()
+    if index is None or locus not in index:
+        return None
+    return index.locus(locus, diseases)
+
+
+def plot_histogram(hist, ax, **kwargs):
+    values, counts = hist
+    ax.bar(values, counts, width=1, **kwargs)
+
+
+def histograms_to_melt(case_hist, control_hist):
+    """
+    Long dataframe of the case and control values of a locus, expanded from its histograms.
+    """
+    return pd.DataFrame({
+        'group': ['control'] * int(control_hist[1].sum()) + ['case'] * int(case_hist[1].sum()),
+        'Repeat Length': np.concatenate([np.repeat(*control_hist), np.repeat(*case_hist)]).astype(float),
+    })
 
 
 def load_genotypes(cols, disease):
@@ -27,14 +88,27 @@ def graph_genotypes(locus, disease):
     Graph the genotypes of a single locus for a single disease.
     """
     fig, ax = plt.subplots(figsize=(10, 6))
+    graph_genotypes_locus(locus, disease, ax)
+    plt.show()
+
+
+def graph_genotypes_locus(locus, disease, ax):
+    case_hist = locus_histogram(locus, disease, 'case')
+    control_hist = locus_histogram(locus, disease, 'control')
+    if case_hist is not None and control_hist is not None:
+        graph_genotypes_helper(case_hist, control_hist, locus, ax, from_hist=True)
+        return
     case, control = load_genotypes(locus, disease)
     graph_genotypes_helper(case, control, locus, ax)
-    plt.show()
 
 
-def graph_genotypes_helper(case, control, name, ax):
-    ax.hist(case, bins=100, alpha=0.5, label='case', color='red')
-    ax.hist(control, bins=100, alpha=0.5, label='control', color='blue')
+def graph_genotypes_helper(case, control, name, ax, from_hist=False):
+    if from_hist:
+        plot_histogram(case, ax, alpha=0.5, label='case', color='red')
+        plot_histogram(control, ax, alpha=0.5, label='control', color='blue')
+    else:
+        ax.hist(case, bins=100, alpha=0.5, label='case', color='red')
+        ax.hist(control, bins=100, alpha=0.5, label='control', color='blue')
     ax.set_title(f'{name} Distribution')
     ax.set_xlabel('Genotype')
     ax.set_ylabel('Frequency')
@@ -69,7 +143,7 @@ def calculate_data(loci, case_df, control_df):
 
         # Melt the dataframe to long format for plotting
         df_melt = df.melt(value_name='Repeat Length', var_name='group')
-        bins = np.arange(df_melt['Repeat Length'].min() - 0.5, df_melt['Repeat Length'].max() + 0.5)
+        bins = np.arange(df_melt['Repeat Length'].min() - 0.5, df_melt['Repeat Length'].max() + 1.5)
 
         
         # Get histogram data for case and control groups
@@ -102,6 +176,42 @@ def calculate_data(loci, case_df, control_df):
 
     return data_dict, max_diff
 
+def calculate_data_from_store(loci, disease):
+    """
+    Same as calculate_data, from the precomputed case and control histograms of the disease.
+    Case and control are missing for the same donors, so the histograms match the paired values.
+    Both cover every value from the lowest to the highest, one bin each.
+    """
+    data_dict = {}
+    max_diff = 0
+
+    for loc in loci:
+        case_hist = locus_histogram(loc, disease, 'case')
+        control_hist = locus_histogram(loc, disease, 'control')
+        values, (hist_case, hist_control) = HS.aligned_counts(case_hist, control_hist)
+
+        diff = hist_case - hist_control
+        conv_diff = np.convolve(diff, np.ones(9)/9, mode='same')
+
+        if np.abs(conv_diff).max() > max_diff:
+            max_diff = np.abs(conv_diff).max()
+
+        if len(conv_diff) <= 9:
+            conv_diff = diff
+
+        scatter_data = pd.DataFrame({
+            'bin_midpoints': values,
+            'diff': conv_diff
+        })
+        scatter_data = scatter_data.loc[scatter_data['diff'] != 0]
+
+        data_dict[loc] = (histograms_to_melt(case_hist, control_hist), scatter_data)
+
+    return data_dict, max_diff
+
+def in_store(loci, disease, kinds=('case', 'control')):
+    return all(locus_histogram(loc, disease, kind) is not None for loc in loci for kind in kinds)
+
 def plot_data(data_dict, max_diff, num_cols, disease, motifs, sample_case, sample_control):
     num_loci = len(data_dict.keys())
     num_rows = np.ceil(num_loci / num_cols).astype(int)
@@ -155,6 +265,11 @@ def plot_data(data_dict, max_diff, num_cols, disease, motifs, sample_case, sampl
 def graphLociGenotypes(loci, disease, case_df=None, control_df=None, sample=None, num_cols=4):
     motifs = get_motifs(loci)
 
+    if case_df is None and sample is None and in_store(loci, disease):
+        data_dict, max_diff = calculate_data_from_store(loci, disease)
+        plot_data(data_dict, max_diff, num_cols, disease, motifs, None, None)
+        return
+
     case_df = case_df or load_genotypes(loci.append('sample_id'), disease)
     sample_cases = case_df[case_df['sample_id'] == sample] if sample else None
     sample_controls = control_df[control_df['sample_id'] == sample] if sample else None
@@ -195,25 +310,38 @@ def graphdiseasesGenotypes(locus, diseases):
     plt.subplots_adjust(wspace=0.3, hspace=0.3)
     plt.subplots_adjust(top=0.95)  # adjust top margin
 
-    for i, disease in enumerate(diseases):
-        # Read in the case and control data for each disease
-        case_df, control_df = load_genotypes(locus, disease)
-
-        # Combine the case and control dataframes along columns
-        df = pd.concat([case_df, control_df], axis=1)
-        df.columns = ['case', 'control']
-        df.dropna(inplace=True)
-
-        # Melt the dataframe to long format for plotting
-        df_melt = df.melt(value_name='Repeat Length', var_name='group')
-        bins = np.arange(df_melt['Repeat Length'].min() - 0.5, df_melt['Repeat Length'].max() + 0.5)
-        # Create the overlaid histograms
-        sns.histplot(data=df_melt, x='Repeat Length', hue='group', element='step', common_norm=False, bins=bins, ax=axs[i])
+    across = load_locus_across_diseases(locus, diseases)
 
-        
-        # Get histogram data for case and control groups
-        hist_case, bins_case = np.histogram(df['case'], bins=bins)
-        hist_control, bins_control = np.histogram(df['control'], bins=bins)
+    for i, disease in enumerate(diseases):
+        if in_store([locus], disease):
+            # Counts straight from the histogram store
+            case_hist = locus_histogram(locus, disease, 'case')
+            control_hist = locus_histogram(locus, disease, 'control')
+            values, (hist_case, hist_control) = HS.aligned_counts(case_hist, control_hist)
+            bins = bins_case = np.append(values, values[-1] + 1) - 0.5
+            df_melt = histograms_to_melt(case_hist, control_hist)
+            sns.histplot(data=df_melt, x='Repeat Length', hue='group', element='step', common_norm=False, bins=bins, ax=axs[i])
+        else:
+            if across is not None:
+                df = across.loc[across['disease'] == disease, ['case', 'control']]
+            else:
+                # Read in the case and control data for each disease
+                case_df, control_df = load_genotypes(locus, disease)
+
+                # Combine the case and control dataframes along columns
+                df = pd.concat([case_df, control_df], axis=1)
+                df.columns = ['case', 'control']
+            df = df.dropna()
+
+            # Melt the dataframe to long format for plotting
+            df_melt = df.melt(value_name='Repeat Length', var_name='group')
+            bins = np.arange(df_melt['Repeat Length'].min() - 0.5, df_melt['Repeat Length'].max() + 1.5)
+            # Create the overlaid histograms
+            sns.histplot(data=df_melt, x='Repeat Length', hue='group', element='step', common_norm=False, bins=bins, ax=axs[i])
+
+            # Get histogram data for case and control groups
+            hist_case, bins_case = np.histogram(df['case'], bins=bins)
+            hist_control, bins_control = np.histogram(df['control'], bins=bins)
 
         # Calculate the difference in bin counts
         diff = hist_case - hist_control
@@ -247,9 +375,13 @@ def graphdiseasesGenotypes(locus, diseases):
 ### DIFFERENCE GRAPHING FUNCTIONS ###
 
 def graphDiff(loc, disease):
-    path = os.path.join(diff_folder, f'{disease}_diff.csv')
-    dat = pd.read_csv(path, usecols=[loc])
-    dat[loc].hist(bins=100)
+    hist = locus_histogram(loc, disease, 'diff')
+    if hist is not None:
+        plot_histogram(hist, plt.gca())
+    else:
+        path = os.path.join(diff_folder, f'{disease}_diff.csv')
+        dat = pd.read_csv(path, usecols=[loc])
+        dat[loc].hist(bins=100)
     plt.title(f'{disease} ; {loc} Distribution')
     plt.xlabel('Tumor - Normal')
     plt.ylabel('Frequency')
@@ -258,9 +390,13 @@ def graphDiff(loc, disease):
     plt.show()
 
 def graphDiffLociHelper(loc, disease, ax):
-    path = os.path.join(diff_folder, f'{disease}_diff.csv')
-    dat = pd.read_csv(path, usecols=[loc])
-    ax.hist(dat[loc], bins=100)
+    hist = locus_histogram(loc, disease, 'diff')
+    if hist is not None:
+        plot_histogram(hist, ax)
+    else:
+        path = os.path.join(diff_folder, f'{disease}_diff.csv')
+        dat = pd.read_csv(path, usecols=[loc])
+        ax.hist(dat[loc], bins=100)
     ax.set_title(f'{loc} Distribution')
     ax.set_xlabel('Tumor - Normal')
     ax.set_ylabel('Frequency')
@@ -296,10 +432,15 @@ def graphLoci(loc, diseases):
     fig, axs = plt.subplots(num_rows, num_cols, figsize=(30, num_rows*5)) # Adjust the figure size as per your requirement
     axs = axs.ravel() # flatten the array of axes
 
+    across = load_locus_across_diseases(loc, diseases)
+
     for idx, disease in enumerate(diseases):
         ax = axs[idx]
         try:
-            graphLocus(loc, disease, ax)
+            if across is not None and locus_histogram(loc, disease, 'diff') is None:
+                graphLocus(loc, disease, ax, diffs=across.loc[across['disease'] == disease, 'diff'])
+            else:
+                graphLocus(loc, disease, ax)
         except:
             print(f'Could not graph {disease}')
             continue
@@ -307,11 +448,144 @@ def graphLoci(loc, diseases):
     plt.tight_layout()  # To prevent overlap of subplots
     plt.show()
 
-def graphLocus(loc, disease, ax):
-    path = os.path.join(diff_folder, f'{disease}_diff.csv')
-    dat = pd.read_csv(path, usecols=[loc])
-    ax.hist(dat[loc], bins=100)
+def graphLocus(loc, disease, ax, diffs=None):
+    hist = locus_histogram(loc, disease, 'diff')
+    if diffs is not None:
+        ax.hist(diffs.dropna(), bins=100)
+    elif hist is not None:
+        plot_histogram(hist, ax)
+    else:
+        path = os.path.join(diff_folder, f'{disease}_diff.csv')
+        dat = pd.read_csv(path, usecols=[loc])
+        ax.hist(dat[loc], bins=100)
     ax.set_title(f'{disease} Distribution')
     ax.set_xlabel('Tumor - Normal')
     ax.set_ylabel('Frequency')
 
+
+
+### BATCH RENDERING ###
+
+def locus_fig_path(outdir, disease, locus, fmt):
+    return os.path.join(outdir, disease, f"{locus.replace(':', '_')}.{fmt}")
+
+
+def locus_sources(disease):
+    sources = [os.path.join(genotypes_folder, f'{disease}_case.csv'),
+               os.path.join(genotypes_folder, f'{disease}_control.csv'),
+               os.path.join(diff_folder, f'{disease}_diff.csv')]
+    if hist_folder:
+        sources.append(HS.store_path(hist_folder, disease))
+    return sources
+
+
+def is_up_to_date(path, sources):
+    """
+    True if path exists and is newer than all existing sources.
+    """
+    if not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    return all(os.path.getmtime(src) <= mtime for src in sources if os.path.exists(src))
+
+
+def render_locus(locus, disease, path):
+    """
+    Save one page for a locus of a disease: case/control genotypes and the differences.
+    """
+    fig, axs = plt.subplots(1, 2, figsize=(16, 5))
+    graph_genotypes_locus(locus, disease, axs[0])
+    graphDiffLociHelper(locus, disease, axs[1])
+    fig.suptitle(f'{disease} ; {locus}')
+    fig.tight_layout()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def _init_render_worker():
+    # workers never show figures, render off-screen
+    plt.switch_backend('Agg')
+
+
+def _render_task(task):
+    locus, disease, path = task
+    try:
+        render_locus(locus, disease, path)
+        return locus, disease, 'rendered'
+    except Exception as e:
+        return locus, disease, f'failed: {e}'
+
+
+def render_batch(loci_by_disease, outdir, fmt='png', processes=None, force=False):
+    """
+    Render one figure per locus and disease on a process pool, without displaying them.
+    Figures newer than the disease's case, control and diff files are skipped.
+    args:
+        loci_by_disease: dict of disease to list of loci
+        outdir: figures are saved to outdir/{disease}/{locus}.{fmt}
+        fmt: 'png' or 'svg'
+        processes: number of workers (default: all cpus)
+        force: render even if the figure is up to date
+    returns:
+        status: DataFrame with the locus, disease and status of each figure
+    """
+    tasks = []
+    status = []
+    for disease, loci in loci_by_disease.items():
+        sources = locus_sources(disease)
+        for locus in loci:
+            path = locus_fig_path(outdir, disease, locus, fmt)
+            if not force and is_up_to_date(path, sources):
+                status.append((locus, disease, 'up to date'))
+            else:
+                tasks.append((locus, disease, path))
+
+    with Pool(processes=processes or cpu_count(), initializer=_init_render_worker) as pool:
+        status += pool.imap_unordered(_render_task, tasks)
+
+    return pd.DataFrame(status, columns=['ReferenceRegion', 'disease', 'status'])
+
+
+def loci_from_table(path, top=None, disease=None):
+    """
+    Loci by disease from a features file (or any csv with a ReferenceRegion column).
+    Without a disease column, the disease is taken from the {disease}_feats.csv file name.
+    If top is given, keeps the top loci of each disease by corrected p-value. Each locus is listed once.
+    """
+    df = pd.read_csv(path)
+    if 'disease' not in df.columns:
+        name = os.path.basename(path).split('.')[0]
+        df['disease'] = disease or (name[:-len('_feats')] if name.endswith('_feats') else name)
+    if top and 'corrected_pvals' in df.columns:
+        df = df.sort_values('corrected_pvals')
+    # the COSMIC join repeats loci overlapping several genes, render each locus once
+    df = df.drop_duplicates(['disease', 'ReferenceRegion'])
+    if top:
+        df = df.groupby('disease', sort=False).head(top)
+    return {d: group['ReferenceRegion'].tolist() for d, group in df.groupby('disease', sort=False)}
+
+
+def init_argparse():
+    parser = argparse.ArgumentParser(description='Render locus figures from ExpansionCooker outputs without a display.')
+    parser.add_argument('input', metavar='Loci_File', type=str, help='Features file, or csv with ReferenceRegion (and disease) columns.')
+    parser.add_argument('--outdir', '-o', default='figs', help='Output directory for the figures. (default: figs)')
+    parser.add_argument('--disease', '-d', default=None, help='Disease of the loci if the file has no disease column. (default: from the file name)')
+    parser.add_argument('--top', '-t', type=int, default=None, help='Only render the top loci per disease by corrected p-value.')
+    parser.add_argument('--fmt', default='png', choices=['png', 'svg'], help='Figure format. (default: png)')
+    parser.add_argument('--processes', '-p', type=int, default=None, help='Number of worker processes. (default: all cpus)')
+    parser.add_argument('--force', default=False, action='store_true', help='Render figures even if they are up to date.')
+    return parser
+
+
+def main():
+    args = init_argparse().parse_args()
+    loci_by_disease = loci_from_table(args.input, args.top, args.disease)
+    os.makedirs(args.outdir, exist_ok=True)
+    status = render_batch(loci_by_disease, args.outdir, args.fmt, args.processes, args.force)
+    status.to_csv(os.path.join(args.outdir, 'render_status.csv'), index=False)
+    print(status['status'].str.split(':').str[0].value_counts().to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+import ExpansionFeatureExtractor as EHF
+
+KINDS = ['case', 'control', 'diff']
+
+
+def ragged_histograms(df: pd.DataFrame) -> dict:
+    """
+    Integer count histograms of every column of a wide matrix, in one bincount.
+    The histogram of column j counts the values mins[j] .. mins[j] + width - 1 and is
+    counts[offsets[j]:offsets[j + 1]]. Columns without values get an empty histogram.
+    Args:
+        df: Dataframe with rows as samples and cols as regions.
+    Returns:
+        hists: Dict with 'regions', 'mins', 'offsets' and 'counts' arrays.
+    """
+    if 'sample_id' in df.columns:
+        df = df.drop(columns=['sample_id'])
+    if (df.dtypes == object).any():
+        df = df.apply(pd.to_numeric, errors='coerce')
+    values = np.rint(df.values.astype(float))
+    observed = ~np.isnan(values)
+    has_values = observed.any(axis=0)
+
+    mins = np.where(observed, values, np.inf).min(axis=0)
+    maxs = np.where(observed, values, -np.inf).max(axis=0)
+    mins = np.where(has_values, mins, 0).astype(np.int64)
+    widths = np.where(has_values, maxs - mins + 1, 0).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(widths)])
+
+    rows, cols = np.nonzero(observed)
+    codes = offsets[cols] + (values[rows, cols].astype(np.int64) - mins[cols])
+    counts = np.bincount(codes, minlength=offsets[-1]).astype(np.int32)
+    return {'regions': np.asarray(df.columns, dtype=str), 'mins': mins, 'offsets': offsets, 'counts': counts}
+
+
+def concat_ragged(parts: list) -> dict:
+    """
+    Concatenate the ragged histograms of consecutive column blocks.
+    """
+    shifts = np.cumsum([0] + [part['offsets'][-1] for part in parts[:-1]])
+    return {
+        'regions': np.concatenate([part['regions'] for part in parts]),
+        'mins': np.concatenate([part['mins'] for part in parts]),
+        'offsets': np.concatenate([[0]] + [part['offsets'][1:] + shift for part, shift in zip(parts, shifts)]),
+        'counts': np.concatenate([part['counts'] for part in parts]),
+    }
+
+
+def save_histograms(hists_by_kind: dict, path: str) -> None:
+    arrays = {f'{kind}_{key}': arr for kind, hists in hists_by_kind.items() for key, arr in hists.items()}
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def save_frame_histograms(frames: dict, path: str) -> None:
+    """
+    Save the histograms of in-memory matrices, e.g. the case, control and diff frames of the cooker.
+    Args:
+        frames: Dict of kind ('case', 'control', 'diff') to dataframe with rows as samples and cols as regions.
+        path: Output path.
+    """
+    save_histograms({kind: ragged_histograms(df) for kind, df in frames.items()}, path)
+
+
+def store_path(store_dir: str, disease: str) -> str:
+    return os.path.join(store_dir, f'{disease}_hists.npz')
+
+
+def build_histograms(disease: str, folder: str, store_dir: str, block_size: int = None) -> str:
+    """
+    Index the case, control and diff matrices of a disease into {store_dir}/{disease}_hists.npz.
+    Args:
+        disease: Disease name of the ExpansionCooker outputs.
+        folder: Folder with the {disease}_case/control/diff.csv files.
+        store_dir: Folder of the histogram store.
+        block_size: If given, read the matrices in blocks of this many loci.
+    Returns:
+        path: Path of the written histograms.
+    """
+    hists_by_kind = {}
+    for kind in KINDS:
+        path = os.path.join(folder, f'{disease}_{kind}.csv')
+        if block_size:
+            parts = [ragged_histograms(block) for block in EHF.read_diff_blocks(path, block_size)]
+            hists_by_kind[kind] = concat_ragged(parts)
+        else:
+            hists_by_kind[kind] = ragged_histograms(pd.read_csv(path, index_col=0))
+        logging.info(f'Built {kind} histograms for {disease}.')
+
+    os.makedirs(store_dir, exist_ok=True)
+    out = store_path(store_dir, disease)
+    save_histograms(hists_by_kind, out)
+    return out
+
+
+class DiseaseHistograms:
+    """
+    Histograms of one disease loaded from the store, looked up by kind and locus.
+    """
+
+    def __init__(self, path: str):
+        with np.load(path) as data:
+            self.hists = {kind: {key: data[f'{kind}_{key}'] for key in ['regions', 'mins', 'offsets', 'counts']}
+                          for kind in KINDS if f'{kind}_regions' in data.files}
+        self.index = {kind: pd.Index(hists['regions']) for kind, hists in self.hists.items()}
+
+    def get(self, kind: str, locus: str):
+        """
+        Returns:
+            (values, counts) of the locus, or None if the locus has no values.
+        """
+        if kind not in self.index or locus not in self.index[kind]:
+            return None
+        hists = self.hists[kind]
+        j = self.index[kind].get_loc(locus)
+        counts = hists['counts'][hists['offsets'][j]:hists['offsets'][j + 1]]
+        if len(counts) == 0:
+            return None
+        return np.arange(hists['mins'][j], hists['mins'][j] + len(counts)), counts
+
+
+def aligned_counts(*hists):
+    """
+    Put (values, counts) histograms on a common range of integer values.
+    Returns:
+        values: The common values.
+        counts: List of count arrays, one per histogram.
+    """
+    lo = min(values[0] for values, _ in hists)
+    hi = max(values[-1] for values, _ in hists)
+    out = []
+    for values, counts in hists:
+        full = np.zeros(hi - lo + 1, dtype=np.int64)
+        full[values[0] - lo:values[0] - lo + len(counts)] = counts
+        out.append(full)
+    return np.arange(lo, hi + 1), out
+
+
+def init_argparse():
+    parser = argparse.ArgumentParser(description='Precompute per-locus case, control and diff histograms of ExpansionCooker outputs.')
+    parser.add_argument('diseases', metavar='Disease', nargs='+', help='Disease names of the ExpansionCooker outputs.')
+    parser.add_argument('--folder', '-f', default='.', help='Folder with the {disease}_case/control/diff.csv files. (default: .)')
+    parser.add_argument('--outdir', '-o', required=True, help='Folder of the histogram store.')
+    parser.add_argument('--block-size', '-b', type=int, default=None, help='Read the matrices in blocks of this many loci. (default: load whole files)')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    args = init_argparse().parse_args()
+    for disease in args.diseases:
+        path = build_histograms(disease, args.folder, args.outdir, args.block_size)
+        logging.info(f'Histograms saved to {path}')
+
+
+if __name__ == '__main__':
+    main()
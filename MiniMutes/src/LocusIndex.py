@@ -0,0 +1,165 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+import ExpansionFeatureExtractor as EHF
+
+KINDS = ['case', 'control', 'diff']
+
+# One record per donor allele, locus and disease, records of a locus are contiguous
+RECORD_DTYPE = np.dtype([('disease', np.int16), ('donor', np.int32),
+                         ('case', np.float32), ('control', np.float32), ('diff', np.float32)])
+
+
+def _long_values(path, locus_codes, donor_codes, block_size):
+    """
+    Non-missing values of a wide cooker matrix as (key, value) arrays, key = locus code * 2^32 + donor code.
+    """
+    keys, values = [], []
+    blocks = EHF.read_diff_blocks(path, block_size) if block_size else [pd.read_csv(path, index_col=0)]
+    for block in blocks:
+        if 'sample_id' in block.columns:
+            block = block.drop(columns=['sample_id'])
+        block = block.apply(pd.to_numeric, errors='coerce') if (block.dtypes == object).any() else block
+        vals = block.values.astype(np.float32)
+        rows, cols = np.nonzero(~np.isnan(vals))
+        donors = np.array([donor_codes.setdefault(d, len(donor_codes)) for d in block.index], dtype=np.int64)
+        loci = locus_codes.get_indexer(block.columns).astype(np.int64)
+        keys.append((loci[cols] << 32) | donors[rows])
+        values.append(vals[rows, cols])
+    return np.concatenate(keys), np.concatenate(values)
+
+
+def _disease_run(disease, disease_code, folder, locus_codes, donor_codes, block_size):
+    """
+    Records of one disease sorted by locus code, with case, control and diff aligned by donor.
+    """
+    long_by_kind = {kind: _long_values(os.path.join(folder, f'{disease}_{kind}.csv'), locus_codes, donor_codes, block_size)
+                    for kind in KINDS}
+    keys = np.unique(np.concatenate([keys for keys, _ in long_by_kind.values()]))
+
+    run = np.zeros(len(keys), dtype=RECORD_DTYPE)
+    run['disease'] = disease_code
+    run['donor'] = keys & 0xFFFFFFFF
+    for kind, (kind_keys, kind_values) in long_by_kind.items():
+        run[kind] = np.nan
+        run[kind][np.searchsorted(keys, kind_keys)] = kind_values
+    return run, keys >> 32
+
+
+def build_locus_index(diseases, folder, index_dir, block_size=None):
+    """
+    Build a locus-major index of the case, control and diff values of many diseases.
+    All records of a locus, over all diseases and donors, are stored contiguously in
+    {index_dir}/values.npy, so a locus is read with a single slice of a memory map.
+    Diseases are read one at a time: each is written to a temporary run sorted by locus,
+    then the runs are scattered into their locus' slots.
+    Args:
+        diseases: Disease names of the ExpansionCooker outputs.
+        folder: Folder with the {disease}_case/control/diff.csv files.
+        index_dir: Output folder of the index.
+        block_size: If given, read the matrices in blocks of this many loci.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+
+    # locus codes from the headers only
+    loci = set()
+    for disease in diseases:
+        for kind in KINDS:
+            loci.update(EHF.read_diff_header(os.path.join(folder, f'{disease}_{kind}.csv')))
+    loci.discard('sample_id')
+    locus_codes = pd.Index(sorted(loci))
+
+    donor_codes = {}
+    counts = np.zeros(len(locus_codes), dtype=np.int64)
+    run_paths = []
+    for code, disease in enumerate(diseases):
+        run, run_loci = _disease_run(disease, code, folder, locus_codes, donor_codes, block_size)
+        counts += np.bincount(run_loci, minlength=len(locus_codes))
+        run_path = os.path.join(index_dir, f'.{disease}_run.npy')
+        np.save(run_path, run)
+        np.save(run_path.replace('_run.npy', '_run_loci.npy'), run_loci)
+        run_paths.append(run_path)
+        logging.info(f'Indexed {len(run)} records of {disease}.')
+
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    values = np.lib.format.open_memmap(os.path.join(index_dir, 'values.npy'), mode='w+',
+                                       dtype=RECORD_DTYPE, shape=(offsets[-1],))
+    cursor = offsets[:-1].copy()
+    for run_path in run_paths:
+        loci_path = run_path.replace('_run.npy', '_run_loci.npy')
+        run, run_loci = np.load(run_path), np.load(loci_path)
+        # position of every record within its locus in this run, the run is sorted by locus
+        run_counts = np.bincount(run_loci, minlength=len(locus_codes))
+        run_starts = np.concatenate([[0], np.cumsum(run_counts)[:-1]])
+        dest = cursor[run_loci] + np.arange(len(run)) - run_starts[run_loci]
+        values[dest] = run
+        cursor += run_counts
+        os.remove(run_path)
+        os.remove(loci_path)
+    values.flush()
+
+    donors = np.empty(len(donor_codes), dtype=object)
+    for donor, code in donor_codes.items():
+        donors[code] = donor
+    with open(os.path.join(index_dir, 'index.npz'), 'wb') as f:
+        np.savez(f, loci=np.asarray(locus_codes, dtype=str), offsets=offsets,
+                 diseases=np.asarray(diseases, dtype=str), donors=donors.astype(str))
+
+
+class LocusIndex:
+    """
+    Reader of an index built by build_locus_index.
+    """
+
+    def __init__(self, index_dir):
+        with np.load(os.path.join(index_dir, 'index.npz')) as data:
+            self.loci = pd.Index(data['loci'])
+            self.offsets = data['offsets']
+            self.diseases = data['diseases']
+            self.donors = data['donors']
+        self.values = np.load(os.path.join(index_dir, 'values.npy'), mmap_mode='r')
+
+    def __contains__(self, locus):
+        return locus in self.loci
+
+    def locus(self, locus, diseases=None) -> pd.DataFrame:
+        """
+        All values of a locus across diseases.
+        Returns:
+            df: Cols ['disease', 'donor_id', 'case', 'control', 'diff'], empty if the locus is not indexed.
+        """
+        if locus not in self.loci:
+            return pd.DataFrame(columns=['disease', 'donor_id'] + KINDS)
+        j = self.loci.get_loc(locus)
+        records = np.array(self.values[self.offsets[j]:self.offsets[j + 1]])
+        df = pd.DataFrame({'disease': self.diseases[records['disease']],
+                           'donor_id': self.donors[records['donor']]})
+        for kind in KINDS:
+            df[kind] = records[kind].astype(float)
+        if diseases is not None:
+            df = df[df['disease'].isin(diseases)]
+        return df
+
+
+def init_argparse():
+    parser = argparse.ArgumentParser(description='Build a locus-major index of ExpansionCooker outputs across diseases.')
+    parser.add_argument('diseases', metavar='Disease', nargs='+', help='Disease names of the ExpansionCooker outputs.')
+    parser.add_argument('--folder', '-f', default='.', help='Folder with the {disease}_case/control/diff.csv files. (default: .)')
+    parser.add_argument('--outdir', '-o', required=True, help='Output folder of the index.')
+    parser.add_argument('--block-size', '-b', type=int, default=None, help='Read the matrices in blocks of this many loci. (default: load whole files)')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    args = init_argparse().parse_args()
+    build_locus_index(args.diseases, args.folder, args.outdir, args.block_size)
+    logging.info(f'Index saved to {args.outdir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+import numpy as np
+import pandas as pd
+
+import ExpansionFeatureExtractor as EHF
+
+
+def _ragged(locus: np.ndarray, values: np.ndarray, num_loci: int, weights: np.ndarray = None) -> tuple:
+    """
+    Per-locus histograms of integer values, each spanning only the range of its own locus,
+    laid out as HistogramStore.ragged_histograms: locus j counts the values mins[j] .. mins[j] + width - 1
+    in counts[offsets[j]:offsets[j + 1]].
+    Args:
+        locus: Locus of every value, sorted.
+        weights: Count of every value, 1 if None.
+    Returns:
+        mins, offsets, counts
+    """
+    present = np.bincount(locus, minlength=num_loci) > 0
+    mins = np.zeros(num_loci, dtype=np.int64)
+    widths = np.zeros(num_loci, dtype=np.int64)
+    if len(values):
+        starts = np.searchsorted(locus, np.nonzero(present)[0])
+        mins[present] = np.minimum.reduceat(values, starts)
+        widths[present] = np.maximum.reduceat(values, starts) - mins[present] + 1
+    offsets = np.concatenate([[0], np.cumsum(widths)])
+    codes = offsets[locus] + (values - mins[locus])
+    counts = np.bincount(codes, weights=weights, minlength=offsets[-1]).astype(np.int32)
+    return mins, offsets, counts
+
+
+class LocusStats:
+    """
+    Mergeable per-locus sufficient statistics of the integer diffs of a cohort.
+
+    For every locus keeps the number of non-missing values, their sum and sum of squares,
+    the number of non-zero values and a histogram of the values. The histograms are ragged
+    as in HistogramStore: locus j counts the values mins[j] .. mins[j] + width - 1 in
+    bin_counts[offsets[j]:offsets[j + 1]], so one expanded locus does not widen the others.
+    Stats of two sets of donors are combined with merge, so features can be updated
+    as new donors arrive without re-reading the old diffs.
+    """
+
+    def __init__(self, regions, n_rows, n, total, total_sq, nonzero, mins, offsets, bin_counts):
+        self.regions = pd.Index(regions)
+        self.n_rows = int(n_rows)
+        self.n = n
+        self.total = total
+        self.total_sq = total_sq
+        self.nonzero = nonzero
+        self.mins = np.asarray(mins, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.bin_counts = np.asarray(bin_counts, dtype=np.int32)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'LocusStats':
+        """
+        Build the stats from a diff dataframe with rows as samples and cols as regions.
+        """
+        if 'sample_id' in df.columns:
+            df = df.drop(columns=['sample_id'])
+        values = df.values.astype(float)
+        observed = ~np.isnan(values)
+        # transposed, so the observed values come sorted by locus
+        locus, rows = np.nonzero(observed.T)
+        obs_values = values[rows, locus]
+        if not np.array_equal(obs_values, np.round(obs_values)):
+            raise ValueError('LocusStats only supports integer diffs.')
+        mins, offsets, counts = _ragged(locus, obs_values.astype(np.int64), values.shape[1])
+
+        filled = np.where(observed, values, 0)
+        return cls(regions=df.columns,
+                   n_rows=values.shape[0],
+                   n=observed.sum(axis=0),
+                   total=filled.sum(axis=0),
+                   total_sq=(filled ** 2).sum(axis=0),
+                   nonzero=(filled != 0).sum(axis=0),
+                   mins=mins,
+                   offsets=offsets,
+                   bin_counts=counts)
+
+    @classmethod
+    def from_sparse(cls, sd) -> 'LocusStats':
+        """
+        Build the stats from a SparseDiff without densifying it, zeros are counted in the bin of 0.
+        """
+        data = sd.data.astype(float)
+        if not np.array_equal(data, np.round(data)):
+            raise ValueError('LocusStats only supports integer diffs.')
+
+        n_zero = sd.n_zero()
+        num_loci = len(sd.regions)
+        col_ids = np.repeat(np.arange(num_loci), sd.n_nonzero())
+        zero_loci = np.nonzero(n_zero)[0]
+        locus = np.concatenate([col_ids, zero_loci])
+        order = np.argsort(locus, kind='stable')
+        values = np.concatenate([data.astype(np.int64), np.zeros(len(zero_loci), dtype=np.int64)])
+        weights = np.concatenate([np.ones(len(data)), n_zero[zero_loci]])
+        mins, offsets, counts = _ragged(locus[order], values[order], num_loci, weights[order])
+
+        return cls(regions=sd.regions,
+                   n_rows=sd.num_rows,
+                   n=sd.counts(),
+                   total=np.bincount(col_ids, weights=data, minlength=num_loci),
+                   total_sq=np.bincount(col_ids, weights=data ** 2, minlength=num_loci),
+                   nonzero=sd.n_nonzero(),
+                   mins=mins,
+                   offsets=offsets,
+                   bin_counts=counts)
+
+    def widths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def _place(self, idx: np.ndarray, mins: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """
+        Counts of the loci idx (-1 for missing loci) in a ragged layout with the given mins and offsets,
+        which must hold the range of every placed locus.
+        """
+        present = np.nonzero(idx >= 0)[0]
+        src = idx[present]
+        widths = self.widths()[src]
+        locus = np.repeat(present, widths)
+        within = np.arange(widths.sum()) - np.repeat(np.cumsum(widths) - widths, widths)
+        source = np.repeat(self.offsets[:-1][src], widths) + within
+        target = offsets[locus] + np.repeat(self.mins[src], widths) - mins[locus] + within
+        counts = np.zeros(offsets[-1], dtype=np.int32)
+        counts[target] = self.bin_counts[source]
+        return counts
+
+    def _ranges(self, idx: np.ndarray) -> tuple:
+        """
+        Lowest and highest value of the loci idx, inf and -inf for missing loci and loci without values.
+        """
+        has = idx >= 0
+        has[has] = self.widths()[idx[has]] > 0
+        lo = np.full(len(idx), np.inf)
+        hi = np.full(len(idx), -np.inf)
+        lo[has] = self.mins[idx[has]]
+        hi[has] = lo[has] + self.widths()[idx[has]] - 1
+        return lo, hi
+
+    def _align(self, regions):
+        """
+        Reindex the sums onto the given regions, missing loci get zero counts.
+        """
+        idx = self.regions.get_indexer(regions)
+        present = idx >= 0
+
+        def take(arr):
+            out = np.zeros((len(regions),) + arr.shape[1:], dtype=arr.dtype)
+            out[present] = arr[idx[present]]
+            return out
+
+        return idx, (take(self.n), take(self.total), take(self.total_sq), take(self.nonzero))
+
+    def merge(self, other: 'LocusStats') -> 'LocusStats':
+        """
+        Combine with the stats of another set of donors.
+        Loci missing from one of the sets count as missing values for its donors,
+        as they would in the pivoted diff matrix.
+        """
+        regions = self.regions.append(other.regions[~other.regions.isin(self.regions)])
+        a_idx, a = self._align(regions)
+        b_idx, b = other._align(regions)
+        n, total, total_sq, nonzero = [x + y for x, y in zip(a, b)]
+
+        a_lo, a_hi = self._ranges(a_idx)
+        b_lo, b_hi = other._ranges(b_idx)
+        lo, hi = np.minimum(a_lo, b_lo), np.maximum(a_hi, b_hi)
+        has = np.isfinite(lo)
+        mins = np.where(has, lo, 0).astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.where(has, hi - lo + 1, 0).astype(np.int64))])
+        counts = self._place(a_idx, mins, offsets) + other._place(b_idx, mins, offsets)
+        return LocusStats(regions, self.n_rows + other.n_rows, n, total, total_sq, nonzero, mins, offsets, counts)
+
+    def subtract(self, other: 'LocusStats') -> 'LocusStats':
+        """
+        Remove the stats of a subset of the donors, e.g. the old rows of donors genotyped again.
+        The histogram ranges are kept, emptied bins stay as zero counts.
+        """
+        negated = LocusStats(other.regions, -other.n_rows, -other.n, -other.total, -other.total_sq,
+                             -other.nonzero, other.mins, other.offsets, -other.bin_counts)
+        return self.merge(negated)
+
+    def concat(self, other: 'LocusStats') -> 'LocusStats':
+        """
+        Combine with the stats of other loci for the same donors, e.g. the next column block.
+        """
+        merged = self.merge(other)
+        merged.n_rows = max(self.n_rows, other.n_rows)
+        return merged
+
+    def save(self, path: str) -> None:
+        # write through a file handle so numpy does not append .npz to the path
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, regions=np.asarray(self.regions, dtype=str), n_rows=self.n_rows,
+                                n=self.n, total=self.total, total_sq=self.total_sq, nonzero=self.nonzero,
+                                mins=self.mins, offsets=self.offsets, counts=self.bin_counts)
+
+    @classmethod
+    def load(cls, path: str) -> 'LocusStats':
+        with np.load(path) as data:
+            if 'hist' in data.files:
+                # stores written with one dense histogram range for all loci
+                locus, bins = np.nonzero(data['hist'])
+                ragged = _ragged(locus, bins + int(data['hist_min']), len(data['regions']), data['hist'][locus, bins])
+            else:
+                ragged = data['mins'], data['offsets'], data['counts']
+            return cls(data['regions'], data['n_rows'], data['n'], data['total'], data['total_sq'],
+                       data['nonzero'], *ragged)
+
+    ### DERIVED FEATURES ###
+
+    def values(self, i: int) -> np.ndarray:
+        """
+        Non-missing values of locus i, sorted. Exact since the diffs are integers.
+        """
+        counts = self.bin_counts[self.offsets[i]:self.offsets[i + 1]]
+        return np.repeat(np.arange(self.mins[i], self.mins[i] + len(counts)), counts).astype(float)
+
+    def counts(self) -> np.ndarray:
+        return self.n
+
+    def std(self) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = (self.total_sq - self.total ** 2 / self.n) / (self.n - 1)
+        return np.sqrt(np.clip(var, 0, None))
+
+    def prop_nonzero(self) -> np.ndarray:
+        # missing values count as non-zero, as with astype(bool) in extract_block_features
+        missing = self.n_rows - self.n
+        return (self.nonzero + missing) / (self.n_rows + (2 * np.sqrt(self.n_rows)) + 3)
+
+    def wilcoxon_pvals(self) -> np.ndarray:
+        """
+        Two-sided Wilcoxon signed-rank p-values (zero_method='pratt') from the histograms.
+        Ranks of tied absolute values are computed per occupied bin, segment by segment over the
+        ragged histograms, so it is O(bins) for all loci together.
+        Loci small enough for scipy's exact distribution fall back to scipy on the expanded values.
+        """
+        num_loci = len(self.regions)
+        widths = self.widths()
+        locus = np.repeat(np.arange(num_loci), widths)
+        bins = np.arange(self.offsets[-1]) - np.repeat(self.offsets[:-1], widths) + self.mins[locus]
+        occupied = self.bin_counts > 0
+        locus, bins, counts = locus[occupied], bins[occupied], self.bin_counts[occupied].astype(float)
+
+        # bins with the same absolute value within a locus share their ranks
+        abs_bins = np.abs(bins)
+        order = np.lexsort((abs_bins, locus))
+        locus, bins, abs_bins, counts = locus[order], bins[order], abs_bins[order], counts[order]
+        starts = np.ones(len(locus), dtype=bool)
+        starts[1:] = (locus[1:] != locus[:-1]) | (abs_bins[1:] != abs_bins[:-1])
+        group = np.cumsum(starts) - 1
+        group_counts = np.bincount(group, weights=counts)
+        group_locus = locus[starts]
+
+        # average rank of each absolute value, zeros included as in pratt
+        locus_totals = np.bincount(group_locus, weights=group_counts, minlength=num_loci)
+        before = np.cumsum(group_counts) - group_counts - (np.cumsum(locus_totals) - locus_totals)[group_locus]
+        ranks = (before + (group_counts + 1) / 2)[group]
+
+        def locus_sum(mask, weights):
+            return np.bincount(locus[mask], weights=weights[mask], minlength=num_loci)
+
+        r_plus = locus_sum(bins > 0, counts * ranks)
+        r_minus = locus_sum(bins < 0, counts * ranks)
+        n_zero = locus_sum(bins == 0, counts)
+        nonzero_groups = abs_bins[starts] > 0
+        ties = group_counts[nonzero_groups]
+        ties = np.bincount(group_locus[nonzero_groups], weights=ties * (ties * ties - 1), minlength=num_loci)
+
+        count = self.n.astype(float)
+        pvals = EHF.signed_rank_normal_pvals(r_plus, r_minus, count, n_zero, ties)
+
+        exact = np.nonzero((count <= EHF.EXACT_MAX_N) & (n_zero == 0) & (count > 0))[0]
+        if len(exact):
+            small = pd.DataFrame({self.regions[i]: pd.Series(self.values(i)) for i in exact})
+            pvals[exact] = EHF.calculate_raw_wilcoxon_pvals(small)
+        return pvals
+
+    def features(self) -> pd.DataFrame:
+        """
+        Unannotated per-locus features, same columns as EHF.extract_block_features.
+        Loci without any non-zero value are dropped, as in EHF.process_df.
+        """
+        keep = self.nonzero > 0
+        stats = self if keep.all() else self.subset(self.regions[keep])
+        columns = (stats.values(i) for i in range(len(stats.regions)))
+        return EHF.assemble_features(stats.regions, stats.wilcoxon_pvals(), columns,
+                                     stats.prop_nonzero(), stats.counts(), stats.std())
+
+    def subset(self, regions) -> 'LocusStats':
+        idx = self.regions.get_indexer(regions)
+        mins = self.mins[idx]
+        offsets = np.concatenate([[0], np.cumsum(self.widths()[idx])])
+        return LocusStats(self.regions[idx], self.n_rows, self.n[idx], self.total[idx], self.total_sq[idx],
+                          self.nonzero[idx], mins, offsets, self._place(idx, mins, offsets))
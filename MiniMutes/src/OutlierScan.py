@@ -0,0 +1,184 @@
+import argparse
+import logging
+import os
+import tempfile
+import warnings
+from functools import lru_cache
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import pandas as pd
+
+import ExpansionFeatureExtractor as EHF
+import Progress
+import Query
+import SparseDiff as SD
+
+cpu_count = int(os.getenv('SLURM_CPUS_PER_TASK') or cpu_count())
+
+# Scale factors making the MAD and the mean absolute deviation estimates of the sd of a normal
+MAD_SCALE = 1.4826
+MEAN_AD_SCALE = 1.2533
+# Lowest scale, one repeat unit: on mostly-zero diff loci the estimates are far below the
+# genotyping noise of +-1 and would make every such wobble an outlier
+MIN_SCALE = 1.0
+
+OUTLIER_COLUMNS = ['disease', 'kind', 'donor_id', 'ReferenceRegion', 'value', 'median', 'scale', 'robust_z']
+
+
+def robust_baselines(values: np.ndarray):
+    """
+    Median and robust scale of every column, ignoring missing values.
+    The scale is the MAD, or the mean absolute deviation for loci where more than half the donors
+    share the median (common for diffs, which are mostly 0), both scaled to a normal sd and
+    floored at MIN_SCALE.
+    Args:
+        values: (donors, loci) array.
+    Returns:
+        median, scale, counts: One value per column, scale is 0 for columns without values.
+    """
+    with warnings.catch_warnings():
+        # all-missing columns give nan baselines
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        median = np.nanmedian(values, axis=0)
+        deviation = np.abs(values - median)
+        mad = np.nanmedian(deviation, axis=0) * MAD_SCALE
+        mean_ad = np.nanmean(deviation, axis=0) * MEAN_AD_SCALE
+    counts = (~np.isnan(values)).sum(axis=0)
+    scale = np.where(counts > 0, np.maximum(np.where(mad > 0, mad, mean_ad), MIN_SCALE), 0)
+    return median, scale, counts
+
+
+def scan_block(block: pd.DataFrame, threshold: float, min_delta: float = 0, direction: str = 'both'):
+    """
+    Robust baselines of a block of loci and the donor values far from them.
+    Args:
+        block: Dataframe with rows as donors and cols as regions.
+        threshold: Minimum |robust z| of an outlier.
+        min_delta: Minimum |value - median| of an outlier, guards against tiny scales.
+        direction: 'both', 'up' (above the median) or 'down'.
+    Returns:
+        baselines: Cols ['ReferenceRegion', 'median', 'scale', 'counts'].
+        outliers: Cols ['donor_id', 'ReferenceRegion', 'value', 'median', 'scale', 'robust_z'].
+    """
+    values = block.values.astype(np.float32)
+    median, scale, counts = robust_baselines(values)
+    baselines = pd.DataFrame({'ReferenceRegion': block.columns, 'median': median, 'scale': scale, 'counts': counts})
+
+    delta = values - median
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(scale > 0, delta / scale, 0)
+    signed = {'both': np.abs(z), 'up': z, 'down': -z}[direction]
+    rows, cols = np.nonzero((signed >= threshold) & (np.abs(delta) >= min_delta))
+    outliers = pd.DataFrame({'donor_id': block.index.values[rows], 'ReferenceRegion': block.columns.values[cols],
+                             'value': values[rows, cols], 'median': median[cols], 'scale': scale[cols],
+                             'robust_z': z[rows, cols]})
+    return baselines, outliers
+
+
+@lru_cache(maxsize=1)
+def _load_sparse(path: str):
+    return SD.SparseDiff.load(path)
+
+
+def read_block(path: str, start: int, stop: int) -> pd.DataFrame:
+    if EHF.is_sparse_path(path):
+        return _load_sparse(path).columns(start, stop).to_frame()
+    return EHF.read_diff_columns(path, start, stop)
+
+
+def _scan_task(task):
+    disease, kind, path, start, stop, threshold, min_delta, direction = task
+    block = read_block(path, start, stop)
+    baselines, outliers = scan_block(block, threshold, min_delta, direction)
+    for df in (baselines, outliers):
+        df.insert(0, 'kind', kind)
+        df.insert(0, 'disease', disease)
+    return baselines, outliers, Progress.worker_usage()
+
+
+def scan_outliers(diseases, folder: str = '.', kinds=('diff', 'case'), threshold: float = 5, min_delta: float = 0,
+                  direction: str = 'both', block_size: int = EHF.DEFAULT_BLOCK_SIZE, processes: int = cpu_count):
+    """
+    Donor outliers of the cooker matrices of many diseases, against robust per-locus baselines.
+    Every csv is parsed once and spilled to a temporary directory (see EHF.spill_diff), then every
+    matrix is split in blocks of loci and all blocks share one pool, so only processes blocks are in
+    memory at a time.
+    Args:
+        diseases: Disease names of {disease}_{kind}.csv (or {disease}_diff.npz) in folder.
+        kinds: Matrices to scan.
+        threshold, min_delta, direction: See scan_block.
+    Returns:
+        outliers: Cols OUTLIER_COLUMNS plus 'rank', sorted by decreasing |robust_z|.
+        baselines: Cols ['disease', 'kind', 'ReferenceRegion', 'median', 'scale', 'counts'].
+    """
+    matrices = []
+    for disease in diseases:
+        for kind in kinds:
+            path = Query.matrix_path(disease, kind, folder)
+            if not os.path.exists(path):
+                logging.warning(f'{path} does not exist, skipping.')
+                continue
+            matrices.append((disease, kind, path))
+
+    all_baselines, all_outliers = [], []
+    with Pool(processes=processes) as pool, tempfile.TemporaryDirectory() as spill_dir:
+        # every csv is parsed once, its blocks are then sliced from the spill
+        Progress.set_stage('spilling')
+        sources = EHF.spill_diffs([path for _, _, path in matrices], spill_dir, pool)
+
+        tasks = []
+        for disease, kind, path in matrices:
+            num_cols = len(EHF.read_diff_header(sources[path]))
+            tasks += [(disease, kind, sources[path], start, min(start + block_size, num_cols), threshold, min_delta, direction)
+                      for start in range(0, num_cols, block_size)]
+        logging.info(f'Scanning {len(tasks)} blocks.')
+        Progress.add_total(len(tasks))
+        Progress.set_stage('scanning')
+
+        for baselines, outliers, usage in pool.imap_unordered(_scan_task, tasks):
+            all_baselines.append(baselines)
+            all_outliers.append(outliers)
+            Progress.update(loci=len(baselines), usage=usage)
+
+    Progress.set_stage('ranking')
+    outliers = pd.concat(all_outliers, ignore_index=True) if all_outliers else pd.DataFrame(columns=OUTLIER_COLUMNS)
+    outliers = outliers.iloc[np.argsort(-np.abs(outliers['robust_z'].values), kind='stable')].reset_index(drop=True)
+    outliers['rank'] = np.arange(1, len(outliers) + 1)
+    baselines = pd.concat(all_baselines, ignore_index=True) if all_baselines else pd.DataFrame()
+    return outliers, baselines
+
+
+def init_argparse():
+    parser = argparse.ArgumentParser(description='Rank donor values far from robust (median/MAD) per-locus baselines in ExpansionCooker matrices.')
+    parser.add_argument('diseases', metavar='Disease', nargs='+', help='Disease names of the outputs.')
+    parser.add_argument('--folder', '-f', default='.', help='Folder with the outputs. (default: .)')
+    parser.add_argument('--kinds', '-k', nargs='+', default=['diff', 'case'], choices=['diff', 'case', 'control'], help='Matrices to scan. (default: diff case)')
+    parser.add_argument('--threshold', '-t', type=float, default=5, help='Minimum |robust z| of an outlier. (default: 5)')
+    parser.add_argument('--min-delta', type=float, default=0, help='Minimum |value - median| of an outlier. (default: 0)')
+    parser.add_argument('--direction', default='both', choices=['both', 'up', 'down'], help='Keep outliers above, below or on both sides of the median. (default: both)')
+    parser.add_argument('--block-size', '-b', type=int, default=EHF.DEFAULT_BLOCK_SIZE, help=f'Loci per block. (default: {EHF.DEFAULT_BLOCK_SIZE})')
+    parser.add_argument('--processes', '-p', type=int, default=cpu_count, help='Worker processes. (Default: SLURM_CPUS_PER_TASK or all CPUs)')
+    parser.add_argument('--baselines', default=None, help='Also write the per-locus baselines to this csv.')
+    parser.add_argument('--progress-interval', type=float, default=60, help='Seconds between progress lines in the log, 0 to disable. (Default: 60)')
+    parser.add_argument('--output', '-o', required=True, help='Output csv of the ranked outliers.')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    args = init_argparse().parse_args()
+
+    with Progress.Progress('outliers', unit='blocks', interval=args.progress_interval):
+        outliers, baselines = scan_outliers(args.diseases, args.folder, args.kinds, args.threshold, args.min_delta,
+                                            args.direction, args.block_size, args.processes)
+
+    outliers.to_csv(args.output, index=False)
+    logging.info(f'{len(outliers)} outliers in {outliers["donor_id"].nunique()} donors saved to {args.output}')
+    if args.baselines:
+        baselines.to_csv(args.baselines, index=False)
+        logging.info(f'Baselines of {len(baselines)} loci saved to {args.baselines}')
+
+
+if __name__ == '__main__':
+    main()
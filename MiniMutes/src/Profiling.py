@@ -0,0 +1,148 @@
+import cProfile
+import glob
+import io
+import logging
+import os
+import pstats
+import shutil
+import signal
+import sys
+from collections import Counter
+
+# Profiler modes: deterministic cProfile, or the stack sampler. They never run together, the sampler's
+# signal handler would be profiled by cProfile and charged to the interrupted function, and cProfile's
+# overhead would be sampled as the profiled code's time.
+MODES = ['cprofile', 'sample']
+
+# Profiling of this process, set by configure in the main process or as a Pool initializer
+PROFILE_DIR = None
+MAX_TASKS = 0
+INTERVAL = 0.005
+MODE = 'cprofile'
+
+_profiled = 0
+
+
+def configure(profile_dir, max_tasks, interval=0.005, mode='cprofile'):
+    """
+    Profile the first max_tasks calls of maybe_profile in this process, writing the profiles to profile_dir.
+    Args:
+        interval: Seconds of CPU time between stack samples.
+        mode: One of MODES.
+    """
+    global PROFILE_DIR, MAX_TASKS, INTERVAL, MODE, _profiled
+    if mode not in MODES:
+        raise ValueError(f'Unknown profiling mode {mode}, expected one of {MODES}.')
+    PROFILE_DIR, MAX_TASKS, INTERVAL, MODE, _profiled = profile_dir, max_tasks, interval, mode, 0
+
+
+class StackSampler:
+    """
+    Signal based sampling profiler: every interval seconds of CPU time (ITIMER_PROF) the Python stack
+    is recorded, giving counts per stack in the collapsed format of flamegraph.pl.
+    Only samples the main thread, where pool workers run their tasks. Stacks stop below root,
+    so the frames of the pool machinery are left out.
+    """
+
+    def __init__(self, interval=0.005, root=None):
+        self.interval = interval
+        self.root = root
+        self.counts = Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None and frame is not self.root:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+
+def maybe_profile(func, *args, **kwargs):
+    """
+    Call func, under cProfile or the stack sampler (see MODE) if this process still has tasks to profile.
+    Each profiled call writes {pid}_{n}.prof or {pid}_{n}.collapsed to PROFILE_DIR.
+    """
+    global _profiled
+    if PROFILE_DIR is None or _profiled >= MAX_TASKS:
+        return func(*args, **kwargs)
+
+    _profiled += 1
+    prefix = os.path.join(PROFILE_DIR, f'{os.getpid()}_{_profiled}')
+    if MODE == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f'{prefix}.prof')
+
+    sampler = StackSampler(INTERVAL, root=sys._getframe())
+    sampler.start()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sampler.stop()
+        with open(f'{prefix}.collapsed', 'w') as f:
+            f.writelines(f'{stack} {count}\n' for stack, count in sampler.counts.items())
+
+
+def merge_profiles(profile_dir, out_prefix, top=50, cleanup=True):
+    """
+    Merge the per-task profiles of all workers into {out_prefix}_profile.pstats (load with pstats.Stats)
+    for cProfile, or {out_prefix}_profile.collapsed (input of flamegraph.pl or speedscope) for the stack
+    sampler, and a text summary {out_prefix}_profile.txt of the top functions by cumulative and own time,
+    or of the top stacks.
+    Returns:
+        paths: Written files, empty if nothing was profiled.
+    """
+    prof_files = sorted(glob.glob(os.path.join(profile_dir, '*.prof')))
+    collapsed_files = sorted(glob.glob(os.path.join(profile_dir, '*.collapsed')))
+    if not prof_files and not collapsed_files:
+        logging.warning(f'No profiles in {profile_dir}.')
+        return []
+
+    summary = io.StringIO()
+    paths = []
+    if prof_files:
+        stats = pstats.Stats(prof_files[0], stream=summary)
+        for path in prof_files[1:]:
+            stats.add(path)
+        stats.dump_stats(f'{out_prefix}_profile.pstats')
+        paths.append(f'{out_prefix}_profile.pstats')
+        summary.write(f'{len(prof_files)} profiled tasks\n')
+        for sort in ['cumulative', 'tottime']:
+            stats.sort_stats(sort).print_stats(top)
+
+    if collapsed_files:
+        counts = Counter()
+        for path in collapsed_files:
+            with open(path) as f:
+                for line in f:
+                    stack, count = line.rstrip('\n').rsplit(' ', 1)
+                    counts[stack] += int(count)
+        with open(f'{out_prefix}_profile.collapsed', 'w') as f:
+            f.writelines(f'{stack} {count}\n' for stack, count in counts.most_common())
+        paths.append(f'{out_prefix}_profile.collapsed')
+        total = sum(counts.values())
+        summary.write(f'{len(collapsed_files)} sampled tasks, {total} stack samples\n')
+        for stack, count in counts.most_common(top):
+            summary.write(f'{count / total:7.2%}  {stack}\n')
+
+    with open(f'{out_prefix}_profile.txt', 'w') as f:
+        f.write(summary.getvalue())
+    paths.append(f'{out_prefix}_profile.txt')
+
+    if cleanup:
+        shutil.rmtree(profile_dir)
+    logging.info(f'Merged {len(prof_files) + len(collapsed_files)} profiles into {", ".join(paths)}')
+    return paths
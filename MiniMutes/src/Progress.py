@@ -0,0 +1,220 @@
+import logging
+import os
+import resource
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Interface the metrics endpoint listens on, set to 0.0.0.0 to scrape it from another node
+METRICS_HOST = os.getenv('METRICS_HOST') or '127.0.0.1'
+
+# Tracker of the running job, the module functions are no-ops without one and in forked workers
+ACTIVE = None
+
+
+def worker_usage() -> dict:
+    """
+    Resource usage of the calling process, to send back with a worker's result.
+    ru_maxrss is the peak resident set size, in KB on Linux.
+    """
+    return {'pid': os.getpid(), 'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def format_seconds(seconds) -> str:
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    return f'{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class Progress:
+    """
+    Progress of a long run in the main process: items done and queued, loci/sec, bytes read,
+    peak RSS of the workers and the current stage.
+    Logs a progress line every interval seconds and, if a port is given, serves the same
+    numbers in the Prometheus text format on http://METRICS_HOST:port/metrics.
+    """
+
+    def __init__(self, job: str, total: int = 0, unit: str = 'donors', interval: float = 60, port: int = None):
+        self.job = job
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.port = port
+        self.done = 0
+        self.loci = 0
+        self.bytes_read = 0
+        self.stage = 'starting'
+        self.worker_rss = {}
+        self.slowest = (None, 0.0)
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.stage_started = self.started
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+        self._reporter = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self) -> 'Progress':
+        global ACTIVE
+        ACTIVE = self
+        if self.interval:
+            self._reporter = threading.Thread(target=self._report, daemon=True)
+            self._reporter.start()
+        if self.port is not None:
+            self._server = ThreadingHTTPServer((METRICS_HOST, self.port), self._handler())
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            logging.info(f'Serving metrics on http://{METRICS_HOST}:{self._server.server_address[1]}/metrics')
+        return self
+
+    def stop(self) -> None:
+        global ACTIVE
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if ACTIVE is self:
+            ACTIVE = None
+        logging.info(f'Done. {self.line()}')
+
+    def _report(self):
+        while not self._stop.wait(self.interval):
+            logging.info(self.line())
+
+    ### UPDATES ###
+
+    def set_stage(self, stage: str) -> None:
+        if stage == self.stage:
+            return
+        with self._lock:
+            elapsed = time.time() - self.stage_started
+            logging.info(f'Stage {self.stage} took {format_seconds(elapsed)}, starting {stage}.')
+            self.stage = stage
+            self.stage_started = time.time()
+
+    def add_total(self, n: int) -> None:
+        with self._lock:
+            self.total += n
+
+    def update(self, done: int = 1, loci: int = 0, bytes_read: int = 0, usage: dict = None,
+               item: str = None, seconds: float = None) -> None:
+        """
+        Record finished items.
+        Args:
+            done: Number of items finished.
+            loci: Loci processed by these items.
+            bytes_read: Bytes of input read by these items.
+            usage: worker_usage() of the worker that ran them.
+            item, seconds: Name and run time of the item, the slowest one is reported.
+        """
+        with self._lock:
+            self.done += done
+            self.loci += loci
+            self.bytes_read += bytes_read
+            if usage is not None:
+                self.worker_rss[usage['pid']] = max(self.worker_rss.get(usage['pid'], 0), usage['max_rss_bytes'])
+            if seconds is not None and seconds > self.slowest[1]:
+                self.slowest = (item, seconds)
+
+    ### REPORTING ###
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = time.time() - self.started
+            rate = self.done / elapsed if elapsed > 0 else 0
+            queued = max(self.total - self.done, 0)
+            return {
+                'stage': self.stage,
+                'done': self.done,
+                'queued': queued,
+                'loci': self.loci,
+                'loci_per_second': self.loci / elapsed if elapsed > 0 else 0,
+                'bytes_read': self.bytes_read,
+                'elapsed': elapsed,
+                'eta': queued / rate if rate > 0 else None,
+                'worker_rss': dict(self.worker_rss),
+                'main_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                'slowest': self.slowest,
+            }
+
+    def line(self) -> str:
+        s = self.snapshot()
+        max_worker = max(s['worker_rss'].values(), default=0)
+        slowest = f", slowest {s['slowest'][0]} {s['slowest'][1]:.0f}s" if s['slowest'][0] is not None else ''
+        return (f"[{self.job}] {s['stage']}: {s['done']}/{s['done'] + s['queued']} {self.unit}, "
+                f"{s['loci_per_second']:.0f} loci/s, {s['bytes_read'] / 2 ** 30:.2f} GiB read, "
+                f"elapsed {format_seconds(s['elapsed'])}, ETA {format_seconds(s['eta'])}, "
+                f"peak RSS main {s['main_rss'] / 2 ** 30:.2f} GiB, worker {max_worker / 2 ** 30:.2f} GiB{slowest}")
+
+    def metrics(self) -> str:
+        s = self.snapshot()
+        labels = f'job="{self.job}",unit="{self.unit}"'
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP minimutes_{name} {help_text}')
+            lines.append(f'# TYPE minimutes_{name} {kind}')
+            for extra, value in samples:
+                lines.append(f'minimutes_{name}{{{labels}{extra}}} {value}')
+
+        metric('items_done_total', 'counter', 'Items (donors or blocks) finished.', [('', s['done'])])
+        metric('items_queued', 'gauge', 'Items not finished yet.', [('', s['queued'])])
+        metric('loci_total', 'counter', 'Loci processed.', [('', s['loci'])])
+        metric('loci_per_second', 'gauge', 'Loci processed per second since the start.', [('', f"{s['loci_per_second']:.3f}")])
+        metric('bytes_read_total', 'counter', 'Bytes of input read.', [('', s['bytes_read'])])
+        metric('elapsed_seconds', 'gauge', 'Seconds since the start.', [('', f"{s['elapsed']:.1f}")])
+        metric('eta_seconds', 'gauge', 'Estimated seconds left, -1 if unknown.',
+               [('', f"{s['eta']:.1f}" if s['eta'] is not None else -1)])
+        metric('stage', 'gauge', 'Current stage.', [(f',stage="{s["stage"]}"', 1)])
+        metric('main_max_rss_bytes', 'gauge', 'Peak RSS of the main process.', [('', s['main_rss'])])
+        metric('worker_max_rss_bytes', 'gauge', 'Peak RSS per worker process.',
+               [(f',pid="{pid}"', rss) for pid, rss in sorted(s['worker_rss'].items())])
+        if s['slowest'][0] is not None:
+            metric('slowest_item_seconds', 'gauge', 'Run time of the slowest item so far.',
+                   [(f',item="{s["slowest"][0]}"', f"{s['slowest'][1]:.1f}")])
+        return '\n'.join(lines) + '\n'
+
+    def _handler(self):
+        progress = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = progress.metrics().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f'Metrics request: {format % args}')
+
+        return MetricsHandler
+
+
+def _active():
+    return ACTIVE if ACTIVE is not None and ACTIVE.pid == os.getpid() else None
+
+
+def set_stage(stage: str) -> None:
+    if _active():
+        ACTIVE.set_stage(stage)
+
+
+def add_total(n: int) -> None:
+    if _active():
+        ACTIVE.add_total(n)
+
+
+def update(**kwargs) -> None:
+    if _active():
+        ACTIVE.update(**kwargs)
@@ -0,0 +1,282 @@
+import argparse
+import hashlib
+import logging
+import os
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+import ExpansionFeatureExtractor as EHF
+from SparseDiff import SparseDiff
+
+CHUNKSIZE = 100_000
+
+OPS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+    '!=': np.not_equal,
+    'in': lambda col, values: np.isin(col, list(values)),
+    'not in': lambda col, values: ~np.isin(col, list(values)),
+}
+
+PREDICATE_PATTERN = re.compile(r'^\s*(abs\(\s*(\w+)\s*\)|\w+)\s*(<=|>=|==|!=|<|>)\s*(.+?)\s*$')
+
+
+def parse_predicate(text: str) -> tuple:
+    """
+    Parse 'column op value' into a predicate, e.g. 'corrected_pvals < 0.05' or 'abs(value) > 5'.
+    Returns:
+        predicate: (column, op, value), column is 'abs(name)' for absolute values.
+    """
+    match = PREDICATE_PATTERN.match(text)
+    if not match:
+        raise ValueError(f'Could not parse predicate: {text}')
+    column = f'abs({match.group(2)})' if match.group(2) else match.group(1)
+    value = match.group(4).strip('\'"')
+    try:
+        value = float(value)
+    except ValueError:
+        pass
+    return column, match.group(3), value
+
+
+def predicate_columns(predicates) -> list:
+    return [column[4:-1] if column.startswith('abs(') else column for column, _, _ in predicates]
+
+
+def predicate_mask(df: pd.DataFrame, predicates) -> np.ndarray:
+    """
+    Conjunction of the predicates over the rows of df, rows with a missing value never match.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    for (column, op, value), name in zip(predicates, predicate_columns(predicates)):
+        col = df[name].values
+        if column.startswith('abs('):
+            col = np.abs(col)
+        with np.errstate(invalid='ignore'):
+            mask &= np.asarray(OPS[op](col, value), dtype=bool) & ~pd.isna(col)
+    return mask
+
+
+def matches_zero(predicates) -> bool:
+    """
+    Whether a value of 0 passes all the predicates on 'value', the zeros of a sparse diff need not be scanned otherwise.
+    """
+    return bool(predicate_mask(pd.DataFrame({'value': [0.0]}), predicates)[0])
+
+
+def _freeze(predicates) -> tuple:
+    return tuple((column, op, tuple(sorted(value)) if isinstance(value, (list, set, tuple)) else value)
+                 for column, op, value in predicates)
+
+
+def _mtimes(paths) -> tuple:
+    return tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in paths)
+
+
+### FEATURES ###
+
+def feats_paths(disease: str, folder: str):
+    return os.path.join(folder, f'{disease}_feats.csv'), os.path.join(folder, f'{disease}_clusters.npz')
+
+
+def scan_features(disease: str, folder: str, predicates=(), columns=None, one_cluster=None) -> pd.DataFrame:
+    """
+    Rows of {disease}_feats.csv matching the predicates, filtered chunk by chunk while the file is read.
+    Only the requested and filtered columns are parsed.
+    Args:
+        predicates: (column, op, value) tuples, all must hold.
+        columns: Columns to return, all if None.
+        one_cluster: If given, keep only loci with exactly one cluster with |mean| >= one_cluster.
+                     Computed from {disease}_clusters.npz, so the cluster lists are never parsed.
+    Returns:
+        df: Matching rows with a 'disease' column.
+    """
+    feats_path, clusters_path = feats_paths(disease, folder)
+    header = pd.read_csv(feats_path, nrows=0).columns
+    needed = set(predicate_columns(predicates)) | {'ReferenceRegion'}
+    usecols = [c for c in header if c in needed or columns is None or c in columns]
+
+    row_mask = None
+    if one_cluster is not None:
+        row_mask = EHF.one_cluster_mask(EHF.read_cluster_features(clusters_path), one_cluster)
+
+    parts = []
+    for chunk in pd.read_csv(feats_path, usecols=usecols, chunksize=CHUNKSIZE):
+        mask = predicate_mask(chunk, predicates)
+        if row_mask is not None:
+            mask &= row_mask[chunk.index.values]
+        parts.append(chunk[mask])
+
+    df = pd.concat(parts) if parts else pd.DataFrame(columns=usecols)
+    if columns is not None:
+        df = df[[c for c in usecols if c in columns or c == 'ReferenceRegion']]
+    df.insert(0, 'disease', disease)
+    return df.reset_index(drop=True)
+
+
+@lru_cache(maxsize=32)
+def _query_features(diseases, folder, predicates, columns, one_cluster, mtimes):
+    return pd.concat([scan_features(disease, folder, predicates, columns and list(columns), one_cluster)
+                      for disease in diseases], ignore_index=True)
+
+
+### VALUES ###
+
+def matrix_path(disease: str, kind: str, folder: str) -> str:
+    """
+    Sparse diff if the cooker wrote one, else the wide csv.
+    """
+    sparse_path = os.path.join(folder, f'{disease}_diff.npz')
+    if kind == 'diff' and os.path.exists(sparse_path):
+        return sparse_path
+    return os.path.join(folder, f'{disease}_{kind}.csv')
+
+
+def _long_matches(block: pd.DataFrame, predicates) -> pd.DataFrame:
+    values = block.values.astype(np.float32)
+    rows, cols = np.nonzero(~np.isnan(values))
+    long = pd.DataFrame({'donor_id': block.index.values[rows], 'ReferenceRegion': block.columns.values[cols],
+                         'value': values[rows, cols]})
+    return long[predicate_mask(long, predicates)]
+
+
+def _scan_sparse(path: str, regions, samples, predicates) -> pd.DataFrame:
+    sd = SparseDiff.load(path)
+    if regions is not None:
+        sd = sd.take(np.nonzero(sd.regions.isin(regions))[0])
+    if matches_zero(predicates):
+        # zeros match too, densify only the selected columns
+        long = _long_matches(sd.to_frame(), predicates)
+    else:
+        cols = np.repeat(np.arange(len(sd.regions)), sd.n_nonzero())
+        long = pd.DataFrame({'donor_id': sd.samples.values[sd.indices], 'ReferenceRegion': sd.regions.values[cols],
+                             'value': sd.data})
+        long = long[predicate_mask(long, predicates)]
+    if samples is not None:
+        long = long[long['donor_id'].isin(samples)]
+    return long
+
+
+def scan_values(disease: str, kind: str, folder: str, regions=None, samples=None, predicates=()) -> pd.DataFrame:
+    """
+    Long table of the donor values of a cooker matrix matching the predicates on 'value'.
+    Only the columns of the given regions are parsed, and rows are filtered chunk by chunk,
+    so the full matrix is never held in memory. A sparse {disease}_diff.npz is preferred for diffs,
+    its zeros are only scanned when 0 passes the predicates.
+    Args:
+        kind: 'case', 'control' or 'diff'.
+        regions, samples: Keep only these regions and donors.
+        predicates: (column, op, value) tuples on 'value', e.g. ('abs(value)', '>', 5).
+    Returns:
+        df: Cols ['disease', 'donor_id', 'ReferenceRegion', 'value'].
+    """
+    path = matrix_path(disease, kind, folder)
+    if EHF.is_sparse_path(path):
+        long = _scan_sparse(path, regions, samples, predicates)
+    else:
+        header = EHF.read_diff_header(path)
+        keep = None if regions is None else set(regions)
+        # positions in the file, the donor index is column 0
+        usecols = [0] + [i + 1 for i, c in enumerate(header) if c != 'sample_id' and (keep is None or c in keep)]
+        parts = []
+        for chunk in pd.read_csv(path, usecols=usecols, index_col=0, chunksize=CHUNKSIZE):
+            if samples is not None:
+                chunk = chunk[chunk.index.isin(samples)]
+            parts.append(_long_matches(chunk, predicates))
+        long = pd.concat(parts) if parts else pd.DataFrame(columns=['donor_id', 'ReferenceRegion', 'value'])
+    long.insert(0, 'disease', disease)
+    return long.reset_index(drop=True)
+
+
+@lru_cache(maxsize=32)
+def _query_values(diseases, kind, folder, regions, samples, predicates, mtimes):
+    return pd.concat([scan_values(disease, kind, folder, regions, samples, predicates) for disease in diseases],
+                     ignore_index=True)
+
+
+### CACHED QUERIES ###
+
+def _disk_cached(cache_dir, key, compute):
+    if cache_dir is None:
+        return compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.pkl')
+    if os.path.exists(path):
+        logging.info(f'Query result read from cache {path}')
+        return pd.read_pickle(path)
+    result = compute()
+    result.to_pickle(path)
+    return result
+
+
+def query_features(diseases, folder='.', where=(), columns=None, one_cluster=None, cache_dir=None) -> pd.DataFrame:
+    """
+    Feature rows of many diseases matching all predicates, e.g. loci with corrected p < 0.05
+    and one cluster in any disease: query_features(diseases, where=['corrected_pvals < 0.05'], one_cluster=3).
+    Results are cached by query and input modification times, in memory and in cache_dir if given.
+    Do not modify them in place.
+    Args:
+        where: Predicates as 'column op value' strings or (column, op, value) tuples.
+    """
+    diseases = tuple(diseases)
+    predicates = _freeze(parse_predicate(p) if isinstance(p, str) else p for p in where)
+    columns = tuple(columns) if columns is not None else None
+    mtimes = _mtimes(path for disease in diseases for path in feats_paths(disease, folder))
+    key = ('features', diseases, os.path.abspath(folder), predicates, columns, one_cluster, mtimes)
+    return _disk_cached(cache_dir, key,
+                        lambda: _query_features(diseases, folder, predicates, columns, one_cluster, mtimes))
+
+
+def query_values(diseases, kind='diff', folder='.', regions=None, samples=None, where=(), cache_dir=None) -> pd.DataFrame:
+    """
+    Donor values of many diseases matching all predicates, e.g. all donors with |diff| > 5
+    at some regions: query_values(diseases, 'diff', regions=regions, where=['abs(value) > 5']).
+    Results are cached by query and input modification times, in memory and in cache_dir if given.
+    Do not modify them in place.
+    """
+    diseases = tuple(diseases)
+    predicates = _freeze(parse_predicate(p) if isinstance(p, str) else p for p in where)
+    regions = tuple(sorted(regions)) if regions is not None else None
+    samples = tuple(sorted(samples)) if samples is not None else None
+    mtimes = _mtimes(matrix_path(disease, kind, folder) for disease in diseases)
+    key = ('values', diseases, kind, os.path.abspath(folder), regions, samples, predicates, mtimes)
+    return _disk_cached(cache_dir, key,
+                        lambda: _query_values(diseases, kind, folder, regions, samples, predicates, mtimes))
+
+
+def init_argparse():
+    parser = argparse.ArgumentParser(description='Query ExpansionCooker and ExpansionFeatureExtractor outputs, filtering while reading.')
+    parser.add_argument('target', choices=['features', 'case', 'control', 'diff'], help='Features or one of the cooker matrices.')
+    parser.add_argument('diseases', metavar='Disease', nargs='+', help='Disease names of the outputs.')
+    parser.add_argument('--folder', '-f', default='.', help='Folder with the outputs. (default: .)')
+    parser.add_argument('--where', '-w', action='append', default=[], help="Predicate, e.g. 'corrected_pvals < 0.05' or 'abs(value) > 5'. Repeat for several.")
+    parser.add_argument('--columns', '-c', nargs='+', default=None, help='Feature columns to return. (default: all)')
+    parser.add_argument('--one-cluster', type=float, default=None, help='Keep only loci with one cluster with |mean| at least this.')
+    parser.add_argument('--regions', '-r', default=None, help='File with one region per line to restrict the matrices to.')
+    parser.add_argument('--cache-dir', default=None, help='Folder to cache query results in.')
+    parser.add_argument('--output', '-o', required=True, help='Output csv.')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    args = init_argparse().parse_args()
+
+    if args.target == 'features':
+        df = query_features(args.diseases, args.folder, args.where, args.columns, args.one_cluster, args.cache_dir)
+    else:
+        regions = pd.read_csv(args.regions, header=None)[0].tolist() if args.regions else None
+        df = query_values(args.diseases, args.target, args.folder, regions, where=args.where, cache_dir=args.cache_dir)
+
+    df.to_csv(args.output, index=False)
+    logging.info(f'{len(df)} rows saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
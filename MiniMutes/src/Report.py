@@ -0,0 +1,388 @@
+import argparse
+import html
+import logging
+import os
+from functools import lru_cache
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import orjson
+import pandas as pd
+
+import DistributionTests as DT
+import ExpansionFeatureExtractor as EHF
+import HistogramStore as HS
+
+cpu_count = int(os.getenv('SLURM_CPUS_PER_TASK') or cpu_count())
+
+# Minimum loci per payload task, every task parses the whole case and control csvs
+CHUNK_SIZE = 500
+# Bumped when the payload format changes, so older caches are not reused
+PAYLOAD_VERSION = 1
+# Feature columns shown in the locus table, when present
+TABLE_COLUMNS = ['corrected_pvals', 'num_clusters', 'out3', 'out5', 'prop_nonzero', 'counts', 'ks_pvals', 'emd',
+                 'stability', 'LocusStructure', 'COSMIC_GeneSymbol']
+
+
+### PAYLOADS ###
+
+def smoothed_diff(hist_case: np.ndarray, hist_control: np.ndarray) -> np.ndarray:
+    """
+    Case - control bin counts smoothed with a 9 bin moving average, as in Graphers.calculate_data.
+    """
+    diff = hist_case - hist_control
+    conv_diff = np.convolve(diff, np.ones(9) / 9, mode='same')
+    return diff if len(conv_diff) <= 9 else conv_diff
+
+
+def locus_payloads(hists: dict, loci) -> dict:
+    """
+    Compact plot data of the loci from paired histograms: the first value, the case and control
+    counts from there on, and the smoothed difference. Every value from the lowest to the highest
+    has a bin, as in Graphers.calculate_data. Loci without paired values are left out.
+    """
+    index = pd.Index(hists['regions'])
+    payloads = {}
+    for locus in loci:
+        if locus not in index:
+            continue
+        j = index.get_loc(locus)
+        start, stop = hists['offsets'][j], hists['offsets'][j + 1]
+        case = hists['case'][start:stop].astype(np.int64)
+        control = hists['control'][start:stop].astype(np.int64)
+        if not case.any() or not control.any():
+            continue
+        payloads[locus] = {'min': int(hists['mins'][j]), 'case': case.tolist(), 'control': control.tolist(),
+                           'diff': np.round(smoothed_diff(case, control), 3).tolist()}
+    return payloads
+
+
+@lru_cache(maxsize=1)
+def _store_histograms(path: str) -> dict:
+    # tasks of one disease follow each other, keep the last store per worker
+    return DT.store_histograms(path)
+
+
+def matrix_usecols(header: pd.Index, loci: list) -> list:
+    """
+    Positions to read of the loci in a matrix with the header given by EHF.read_diff_header, index column first.
+    """
+    positions = header.get_indexer(loci)
+    return [0] + sorted(positions[positions >= 0] + 1)
+
+
+def _payload_task(task):
+    disease, loci, case_path, control_path, store, case_cols, control_cols = task
+    if store:
+        hists = _store_histograms(store)
+    else:
+        case_df = pd.read_csv(case_path, index_col=0, usecols=case_cols)
+        control_df = pd.read_csv(control_path, index_col=0, usecols=control_cols)
+        hists = DT.paired_histograms(case_df, control_df)
+    return disease, locus_payloads(hists, loci)
+
+
+def payload_sources(disease: str, folder: str, hists_dir: str = None) -> dict:
+    """
+    Files the payloads of a disease are computed from: its HistogramStore file if hists_dir has one,
+    else the case and control matrices in folder.
+    """
+    store = HS.store_path(hists_dir, disease) if hists_dir else None
+    if store and os.path.exists(store):
+        return {'store': store}
+    return {'case': os.path.join(folder, f'{disease}_case.csv'), 'control': os.path.join(folder, f'{disease}_control.csv')}
+
+
+def _cache_key(sources: dict) -> list:
+    return [PAYLOAD_VERSION] + [[kind, path, os.stat(path).st_mtime_ns] for kind, path in sorted(sources.items())]
+
+
+def read_cache(path: str, key: list) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as f:
+        cache = orjson.loads(f.read())
+    return cache['payloads'] if cache.get('key') == key else {}
+
+
+def write_cache(path: str, key: list, payloads: dict) -> None:
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps({'key': key, 'payloads': payloads}))
+
+
+def build_payloads(loci_by_disease: dict, folder: str = '.', hists_dir: str = None, cache_dir: str = None,
+                   processes: int = cpu_count) -> dict:
+    """
+    Plot payloads of the loci of every disease, computed on a process pool with about one chunk of loci
+    per process and disease (at least CHUNK_SIZE loci).
+    Payloads are cached per disease in cache_dir and reused while the source files are unchanged.
+    Returns:
+        payloads: Dict of disease to dict of locus to payload.
+    """
+    payloads, keys, tasks = {}, {}, []
+    for disease, loci in loci_by_disease.items():
+        sources = payload_sources(disease, folder, hists_dir)
+        missing = [path for path in sources.values() if not os.path.exists(path)]
+        if missing:
+            logging.warning(f'No histograms or case and control matrices for {disease} ({missing[0]}), no plots.')
+            payloads[disease] = {}
+            continue
+        keys[disease] = _cache_key(sources)
+        cached = read_cache(os.path.join(cache_dir, f'{disease}_payloads.json'), keys[disease]) if cache_dir else {}
+        payloads[disease] = {locus: cached[locus] for locus in loci if locus in cached}
+        todo = [locus for locus in loci if locus not in cached]
+        logging.info(f'{disease}: {len(loci) - len(todo)} payloads from the cache, {len(todo)} to compute.')
+        chunk_size = max(CHUNK_SIZE, -(-len(todo) // processes))
+        chunks = [todo[start:start + chunk_size] for start in range(0, len(todo), chunk_size)]
+        if 'store' in sources:
+            tasks += [(disease, chunk, None, None, sources['store'], None, None) for chunk in chunks]
+        elif chunks:
+            # the wide headers are read once per disease, the tasks only parse their columns
+            case_header = EHF.read_diff_header(sources['case'])
+            control_header = EHF.read_diff_header(sources['control'])
+            tasks += [(disease, chunk, sources['case'], sources['control'], None,
+                       matrix_usecols(case_header, chunk), matrix_usecols(control_header, chunk)) for chunk in chunks]
+
+    if tasks:
+        with Pool(processes=min(processes, len(tasks))) as pool:
+            for disease, chunk_payloads in pool.imap_unordered(_payload_task, tasks):
+                payloads[disease].update(chunk_payloads)
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        for disease, key in keys.items():
+            path = os.path.join(cache_dir, f'{disease}_payloads.json')
+            # keep the payloads of loci cached by earlier reports too
+            write_cache(path, key, {**read_cache(path, key), **payloads[disease]})
+    return payloads
+
+
+### REPORT ###
+
+def read_loci_table(path: str, disease: str = None, top: int = None) -> pd.DataFrame:
+    """
+    Features of the report loci, with a disease column taken from the {disease}_feats.csv name if missing.
+    If top is given, keeps the top loci of each disease by corrected p-value.
+    """
+    df = pd.read_csv(path)
+    if 'disease' not in df.columns:
+        name = os.path.basename(path).split('.')[0]
+        df.insert(0, 'disease', disease or (name[:-len('_feats')] if name.endswith('_feats') else name))
+    if 'corrected_pvals' in df.columns:
+        df = df.sort_values('corrected_pvals', kind='stable')
+    if top:
+        df = df.groupby('disease', sort=False).head(top)
+    return df.reset_index(drop=True)
+
+
+def report_data(features: pd.DataFrame, payloads: dict, title: str) -> dict:
+    records = features.astype(object).where(features.notna(), None).to_dict('records')
+    return {
+        'title': title,
+        'columns': list(features.columns),
+        'table_columns': ['disease', 'ReferenceRegion'] + [c for c in TABLE_COLUMNS if c in features.columns],
+        'rows': records,
+        'payloads': payloads,
+    }
+
+
+def render_html(data: dict) -> str:
+    # '</' would end the script element early
+    payload = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY).decode().replace('</', '<\\/')
+    return REPORT_TEMPLATE.replace('__TITLE__', html.escape(data['title'])).replace('__DATA__', payload)
+
+
+def build_report(features_path: str, output: str, folder: str = '.', hists_dir: str = None, disease: str = None,
+                 top: int = None, cache_dir: str = None, processes: int = cpu_count, title: str = None) -> str:
+    """
+    Write a self-contained HTML report of the loci of a features file, with their case and control
+    histograms and smoothed difference rendered in the browser from embedded JSON.
+    Returns:
+        output: Path of the report.
+    """
+    features = read_loci_table(features_path, disease, top)
+    loci_by_disease = {d: group['ReferenceRegion'].tolist() for d, group in features.groupby('disease', sort=False)}
+    payloads = build_payloads(loci_by_disease, folder, hists_dir, cache_dir, processes)
+
+    title = title or os.path.basename(features_path).split('.')[0]
+    with open(output, 'w') as f:
+        f.write(render_html(report_data(features, payloads, title)))
+    logging.info(f'Report of {len(features)} loci ({os.path.getsize(output) / 2 ** 20:.1f} MiB) saved to {output}')
+    return output
+
+
+REPORT_TEMPLATE = r'''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>__TITLE__</title>
+<style>
+body { font-family: sans-serif; margin: 1em 2em; color: #222; }
+#controls { margin: 0.5em 0; }
+#controls input { width: 24em; }
+table { border-collapse: collapse; font-size: 13px; }
+th, td { padding: 2px 8px; border-bottom: 1px solid #ddd; text-align: left; white-space: nowrap; }
+th { cursor: pointer; background: #f3f3f3; position: sticky; top: 0; }
+tr.locus:hover { background: #eef; cursor: pointer; }
+tr.selected { background: #dde; }
+#layout { display: flex; gap: 2em; align-items: flex-start; }
+#table-pane { max-height: 85vh; overflow-y: auto; }
+#detail { position: sticky; top: 1em; }
+#detail table td:first-child { color: #666; }
+.legend span { margin-right: 1.5em; }
+</style>
+</head>
+<body>
+<h2 id="title"></h2>
+<div id="controls">
+  <input id="filter" placeholder="Filter by disease, locus, gene or motif">
+  <button id="prev">&lt;</button> <span id="page"></span> <button id="next">&gt;</button>
+</div>
+<div id="layout">
+  <div id="table-pane"><table id="loci"><thead></thead><tbody></tbody></table></div>
+  <div id="detail"></div>
+</div>
+<script id="report-data" type="application/json">__DATA__</script>
+<script>
+const DATA = JSON.parse(document.getElementById('report-data').textContent);
+const PAGE_SIZE = 200;
+let rows = DATA.rows.map((row, i) => Object.assign({_i: i}, row));
+let view = rows, page = 0, sortKey = null, sortAsc = true, selected = null;
+
+function fmt(v) {
+  if (v === null || v === undefined) return '';
+  if (typeof v === 'number') {
+    if (Number.isInteger(v)) return String(v);
+    return (Math.abs(v) < 1e-3 && v !== 0) ? v.toExponential(2) : v.toPrecision(4).replace(/\.?0+$/, '');
+  }
+  return String(v);
+}
+
+function applyView() {
+  const q = document.getElementById('filter').value.toLowerCase();
+  view = rows.filter(r => !q || ['disease', 'ReferenceRegion', 'COSMIC_GeneSymbol', 'LocusStructure']
+    .some(c => r[c] !== undefined && r[c] !== null && String(r[c]).toLowerCase().includes(q)));
+  if (sortKey) {
+    view.sort((a, b) => {
+      const x = a[sortKey], y = b[sortKey];
+      if (x === y) return 0;
+      if (x === null || x === undefined) return 1;
+      if (y === null || y === undefined) return -1;
+      return (x < y ? -1 : 1) * (sortAsc ? 1 : -1);
+    });
+  }
+  page = Math.min(page, Math.max(0, Math.ceil(view.length / PAGE_SIZE) - 1));
+  drawTable();
+}
+
+function drawTable() {
+  const head = document.querySelector('#loci thead');
+  head.innerHTML = '<tr>' + DATA.table_columns.map(c =>
+    `<th data-col="${c}">${c}${c === sortKey ? (sortAsc ? ' &#9650;' : ' &#9660;') : ''}</th>`).join('') + '</tr>';
+  head.querySelectorAll('th').forEach(th => th.onclick = () => {
+    sortAsc = sortKey === th.dataset.col ? !sortAsc : true;
+    sortKey = th.dataset.col;
+    applyView();
+  });
+  const body = document.querySelector('#loci tbody');
+  const shown = view.slice(page * PAGE_SIZE, (page + 1) * PAGE_SIZE);
+  body.innerHTML = shown.map(r => `<tr class="locus${r._i === selected ? ' selected' : ''}" data-i="${r._i}">` +
+    DATA.table_columns.map(c => `<td>${escapeHtml(fmt(r[c]))}</td>`).join('') + '</tr>').join('');
+  body.querySelectorAll('tr').forEach(tr => tr.onclick = () => select(Number(tr.dataset.i)));
+  const pages = Math.max(1, Math.ceil(view.length / PAGE_SIZE));
+  document.getElementById('page').textContent = `page ${page + 1}/${pages}, ${view.length} loci`;
+}
+
+function escapeHtml(s) {
+  return s.replace(/[&<>"]/g, ch => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}[ch]));
+}
+
+function stepPath(values, counts, x, y) {
+  let d = '';
+  counts.forEach((c, k) => {
+    const x0 = x(values[k] - 0.5), x1 = x(values[k] + 0.5);
+    d += (k === 0 ? `M${x0},${y(0)}` : '') + `L${x0},${y(c)}L${x1},${y(c)}`;
+  });
+  return d + `L${x(values[values.length - 1] + 0.5)},${y(0)}`;
+}
+
+function chart(p) {
+  const W = 640, H = 300, L = 50, R = 50, T = 15, B = 35;
+  const n = p.case.length, values = p.case.map((_, k) => p.min + k);
+  const ymax = Math.max(1, ...p.case, ...p.control);
+  const dmax = Math.max(1e-9, ...p.diff.map(Math.abs)) * 2;
+  const x = v => L + (v - (p.min - 0.5)) / n * (W - L - R);
+  const y = c => H - B - c / ymax * (H - T - B);
+  const yd = d => T + (H - T - B) / 2 - d / dmax * (H - T - B) / 2;
+  const step = Math.max(1, Math.ceil(n / 10));
+  let ticks = '';
+  for (let k = 0; k < n; k += step) {
+    ticks += `<line x1="${x(values[k])}" x2="${x(values[k])}" y1="${H - B}" y2="${H - B + 4}" stroke="#444"/>` +
+      `<text x="${x(values[k])}" y="${H - B + 16}" font-size="11" text-anchor="middle">${values[k]}</text>`;
+  }
+  const diffLine = p.diff.map((d, k) => `${k ? 'L' : 'M'}${x(values[k])},${yd(d)}`).join('');
+  return `<svg width="${W}" height="${H}" xmlns="http://www.w3.org/2000/svg">
+    <path d="${stepPath(values, p.control, x, y)}" fill="rgba(31,119,180,0.3)" stroke="rgb(31,119,180)"/>
+    <path d="${stepPath(values, p.case, x, y)}" fill="rgba(255,127,14,0.3)" stroke="rgb(255,127,14)"/>
+    <line x1="${L}" x2="${W - R}" y1="${yd(0)}" y2="${yd(0)}" stroke="gray" stroke-dasharray="4,3"/>
+    <path d="${diffLine}" fill="none" stroke="purple" stroke-width="1.5"/>
+    <line x1="${L}" x2="${W - R}" y1="${H - B}" y2="${H - B}" stroke="#444"/>${ticks}
+    <text x="${L - 6}" y="${T + 8}" font-size="11" text-anchor="end">${ymax}</text>
+    <text x="${L - 6}" y="${H - B}" font-size="11" text-anchor="end">0</text>
+    <text x="${W - R + 6}" y="${T + 8}" font-size="11">${fmt(dmax / 2)}</text>
+    <text x="${W - R + 6}" y="${H - B}" font-size="11">${fmt(-dmax / 2)}</text>
+    <text x="${(W + L - R) / 2}" y="${H - 3}" font-size="12" text-anchor="middle">Repeat Length</text>
+  </svg>`;
+}
+
+function select(i) {
+  selected = i;
+  const row = DATA.rows[i];
+  const p = (DATA.payloads[row.disease] || {})[row.ReferenceRegion];
+  const plot = p ? chart(p) + '<div class="legend"><span style="color:rgb(255,127,14)">&#9632; Case</span>' +
+    '<span style="color:rgb(31,119,180)">&#9632; Control</span><span style="color:purple">&#9472; Smoothed Case - Control Difference</span></div>'
+    : '<p>No case and control histograms for this locus.</p>';
+  const stats = DATA.columns.filter(c => row[c] !== null && row[c] !== undefined)
+    .map(c => `<tr><td>${escapeHtml(c)}</td><td>${escapeHtml(fmt(row[c]))}</td></tr>`).join('');
+  document.getElementById('detail').innerHTML = `<h3>${escapeHtml(row.disease)} ; ${escapeHtml(row.ReferenceRegion)}</h3>` +
+    plot + `<table>${stats}</table>`;
+  drawTable();
+}
+
+document.getElementById('title').textContent = DATA.title;
+document.getElementById('filter').oninput = () => { page = 0; applyView(); };
+document.getElementById('prev').onclick = () => { page = Math.max(0, page - 1); drawTable(); };
+document.getElementById('next').onclick = () => { page = Math.min(Math.ceil(view.length / PAGE_SIZE) - 1, page + 1); drawTable(); };
+applyView();
+if (rows.length) select(0);
+</script>
+</body>
+</html>
+'''
+
+
+def init_argparse():
+    parser = argparse.ArgumentParser(description='Write a self-contained HTML report of the loci of a features file.')
+    parser.add_argument('input', metavar='Loci_File', type=str, help='Features file, or csv with ReferenceRegion (and disease) columns.')
+    parser.add_argument('--output', '-o', required=True, help='Output html.')
+    parser.add_argument('--folder', '-f', default='.', help='Folder with the {disease}_case/control.csv files. (default: .)')
+    parser.add_argument('--hists-dir', default=None, help='HistogramStore folder, used instead of the matrices for diseases it has. (default: None)')
+    parser.add_argument('--disease', '-d', default=None, help='Disease of the loci if the file has no disease column. (default: from the file name)')
+    parser.add_argument('--top', '-t', type=int, default=None, help='Only report the top loci per disease by corrected p-value.')
+    parser.add_argument('--title', default=None, help='Report title. (default: input file name)')
+    parser.add_argument('--cache-dir', default=None, help='Folder of the payload cache. (default: {output}_cache)')
+    parser.add_argument('--no-cache', default=False, action='store_true', help='Neither read nor write the payload cache.')
+    parser.add_argument('--processes', '-p', type=int, default=cpu_count, help='Worker processes. (Default: SLURM_CPUS_PER_TASK or all CPUs)')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    args = init_argparse().parse_args()
+    cache_dir = None if args.no_cache else (args.cache_dir or os.path.splitext(args.output)[0] + '_cache')
+    build_report(args.input, args.output, args.folder, args.hists_dir, args.disease, args.top, cache_dir,
+                 args.processes, args.title)
+
+
+if __name__ == '__main__':
+    main()
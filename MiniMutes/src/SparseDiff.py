@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+
+import ExpansionFeatureExtractor as EHF
+
+
+class SparseDiff:
+    """
+    Column compressed (CSC) diff matrix with rows as samples and cols as regions.
+
+    Only the non-zero values are stored, and missing values are kept as a separate CSC
+    pattern, so zeros and NaNs cost nothing. The non-zero values of column j are
+    data[indptr[j]:indptr[j + 1]] at rows indices[indptr[j]:indptr[j + 1]], its missing
+    rows are missing_indices[missing_indptr[j]:missing_indptr[j + 1]].
+    """
+
+    def __init__(self, samples, regions, data, indices, indptr, missing_indices, missing_indptr):
+        self.samples = pd.Index(samples)
+        self.regions = pd.Index(regions)
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.missing_indices = missing_indices
+        self.missing_indptr = missing_indptr
+
+    @staticmethod
+    def _csc_pattern(mask: np.ndarray):
+        # nonzero of the transpose walks column by column, rows sorted within a column
+        cols, rows = np.nonzero(mask.T)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(cols, minlength=mask.shape[1]))])
+        return rows.astype(np.int32), indptr.astype(np.int64), (rows, cols)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'SparseDiff':
+        """
+        Build from a diff dataframe with rows as samples and cols as regions.
+        """
+        if 'sample_id' in df.columns:
+            df = df.drop(columns=['sample_id'])
+        values = df.values.astype(float)
+        missing = np.isnan(values)
+
+        indices, indptr, (rows, cols) = cls._csc_pattern(~missing & (values != 0))
+        missing_indices, missing_indptr, _ = cls._csc_pattern(missing)
+        return cls(df.index, df.columns, values[rows, cols].astype(np.float32), indices, indptr,
+                   missing_indices, missing_indptr)
+
+    def to_frame(self) -> pd.DataFrame:
+        values = np.zeros((self.num_rows, len(self.regions)))
+        values[self.indices, self._column_ids(self.indptr)] = self.data
+        values[self.missing_indices, self._column_ids(self.missing_indptr)] = np.nan
+        return pd.DataFrame(values, index=self.samples, columns=self.regions)
+
+    def save(self, path: str) -> None:
+        # write through a file handle so numpy does not append .npz to the path
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, samples=np.asarray(self.samples, dtype=str),
+                                regions=np.asarray(self.regions, dtype=str),
+                                data=self.data, indices=self.indices, indptr=self.indptr,
+                                missing_indices=self.missing_indices, missing_indptr=self.missing_indptr)
+
+    @classmethod
+    def load(cls, path: str) -> 'SparseDiff':
+        with np.load(path) as data:
+            return cls(data['samples'], data['regions'], data['data'], data['indices'], data['indptr'],
+                       data['missing_indices'], data['missing_indptr'])
+
+    @staticmethod
+    def read_regions(path: str) -> pd.Index:
+        # npz members are loaded lazily, only the regions are read
+        with np.load(path) as data:
+            return pd.Index(data['regions'])
+
+    ### SLICING ###
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.samples)
+
+    def _column_ids(self, indptr: np.ndarray) -> np.ndarray:
+        return np.repeat(np.arange(len(self.regions)), np.diff(indptr))
+
+    def take(self, cols) -> 'SparseDiff':
+        """
+        Subset to the given column positions.
+        """
+        cols = np.asarray(cols, dtype=np.int64)
+
+        def gather(indptr):
+            lengths = indptr[cols + 1] - indptr[cols]
+            # positions of the selected columns' entries in the flat arrays
+            starts = np.repeat(indptr[cols] - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+            positions = starts + np.arange(lengths.sum())
+            return positions, np.concatenate([[0], np.cumsum(lengths)])
+
+        positions, indptr = gather(self.indptr)
+        missing_positions, missing_indptr = gather(self.missing_indptr)
+        return SparseDiff(self.samples, self.regions[cols], self.data[positions], self.indices[positions], indptr,
+                          self.missing_indices[missing_positions], missing_indptr)
+
+    def columns(self, start: int, stop: int) -> 'SparseDiff':
+        return self.take(np.arange(start, min(stop, len(self.regions))))
+
+    def drop_zero_columns(self) -> 'SparseDiff':
+        """
+        Remove columns without non-zero values, as EHF.process_df does for dense diffs.
+        """
+        keep = np.nonzero(self.n_nonzero() > 0)[0]
+        return self if len(keep) == len(self.regions) else self.take(keep)
+
+    def column_values(self, j: int) -> np.ndarray:
+        """
+        Non-missing values of column j, non-zero values first.
+        """
+        nonzero = self.data[self.indptr[j]:self.indptr[j + 1]].astype(float)
+        n_missing = self.missing_indptr[j + 1] - self.missing_indptr[j]
+        return np.concatenate([nonzero, np.zeros(self.num_rows - n_missing - len(nonzero))])
+
+    ### COLUMN STATISTICS ###
+
+    def n_nonzero(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def n_missing(self) -> np.ndarray:
+        return np.diff(self.missing_indptr)
+
+    def counts(self) -> np.ndarray:
+        return self.num_rows - self.n_missing()
+
+    def n_zero(self) -> np.ndarray:
+        return self.counts() - self.n_nonzero()
+
+    def std(self) -> np.ndarray:
+        col_ids = self._column_ids(self.indptr)
+        data = self.data.astype(float)
+        total = np.bincount(col_ids, weights=data, minlength=len(self.regions))
+        total_sq = np.bincount(col_ids, weights=data ** 2, minlength=len(self.regions))
+        n = self.counts()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = (total_sq - total ** 2 / n) / (n - 1)
+        return np.sqrt(np.clip(var, 0, None))
+
+    def prop_nonzero(self) -> np.ndarray:
+        # missing values count as non-zero, as with astype(bool) in EHF.extract_block_features
+        return (self.n_nonzero() + self.n_missing()) / (self.num_rows + (2 * np.sqrt(self.num_rows)) + 3)
+
+    def wilcoxon_pvals(self) -> np.ndarray:
+        """
+        Two-sided Wilcoxon signed-rank p-values (zero_method='pratt') from the non-zero values only.
+        The zeros of a column take the lowest ranks, so the non-zero values are ranked after them.
+        Columns small enough for scipy's exact distribution fall back to scipy.
+        """
+        num_cols = len(self.regions)
+        col_ids = self._column_ids(self.indptr)
+        abs_data = np.abs(self.data)
+        order = np.lexsort((abs_data, col_ids))
+        cols, abs_sorted, signed = col_ids[order], abs_data[order], self.data[order]
+
+        # runs of tied absolute values within a column
+        new_run = np.ones(len(cols), dtype=bool)
+        new_run[1:] = (cols[1:] != cols[:-1]) | (abs_sorted[1:] != abs_sorted[:-1])
+        run_starts = np.nonzero(new_run)[0]
+        run_lengths = np.diff(np.append(run_starts, len(cols)))
+        run_cols = cols[run_starts]
+
+        n_zero = self.n_zero()
+        run_ranks = n_zero[run_cols] + (run_starts - self.indptr[run_cols]) + (run_lengths + 1) / 2
+        ranks = np.repeat(run_ranks, run_lengths)
+
+        r_plus = np.bincount(cols, weights=ranks * (signed > 0), minlength=num_cols)
+        r_minus = np.bincount(cols, weights=ranks * (signed < 0), minlength=num_cols)
+        ties = np.bincount(run_cols, weights=run_lengths * (run_lengths.astype(float) ** 2 - 1), minlength=num_cols)
+
+        count = self.counts().astype(float)
+        pvals = EHF.signed_rank_normal_pvals(r_plus, r_minus, count, n_zero, ties)
+
+        exact = np.nonzero((count <= EHF.EXACT_MAX_N) & (n_zero == 0) & (count > 0))[0]
+        if len(exact):
+            small = pd.DataFrame({self.regions[j]: pd.Series(self.column_values(j)) for j in exact})
+            pvals[exact] = EHF.calculate_raw_wilcoxon_pvals(small)
+        return pvals
+
+    def features(self) -> pd.DataFrame:
+        """
+        Unannotated per-locus features, same columns as EHF.extract_block_features.
+        Columns without any non-zero value are dropped, as in EHF.process_df.
+        """
+        sd = self.drop_zero_columns()
+        columns = (sd.column_values(j) for j in range(len(sd.regions)))
+        return EHF.assemble_features(sd.regions, sd.wilcoxon_pvals(), columns,
+                                     sd.prop_nonzero(), sd.counts(), sd.std())
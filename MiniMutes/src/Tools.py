@@ -1,6 +1,8 @@
 import ExpansionFeatureExtractor as EHF
 import pandas as pd
 import numpy as np
+import os
+from functools import lru_cache
 
 def get_features(diffs):
     df = EHF.process_df(diffs)
@@ -24,21 +26,188 @@ def get_features(diffs):
     features_df['std'] = df.std().values
     return features_df
 
-def getLocusWithOneCluster(features_df):
-    one_clusts = features_df[features_df['num_clusters'] == 1]
-    one_clusts = one_clusts[one_clusts['cluster_means'].apply(lambda x: (len(x) == 1 and 3 <= np.abs(x[0])))]
-    return one_clusts
+def getLocusWithOneCluster(features_df, clusters=None):
+    """
+    Loci with exactly one cluster with |mean| >= 3.
+    clusters: ragged cluster features of features_df (EHF.read_cluster_features of {name}_clusters.npz),
+    built from the list columns of features_df if not given.
+    """
+    if clusters is None:
+        clusters = EHF.ragged_clusters(features_df)
+    return features_df[EHF.one_cluster_mask(clusters, 3)]
 
 
-def loadGenotypes(cancer):
-    ca_case = pd.read_csv(f'../data/genotypes/{cancer}_case_tidy.csv')
-    ca_control = pd.read_csv(f'../data//genotypes/{cancer}_control_tidy.csv')
+def loadClusters(name, folder='.'):
+    """
+    Ragged cluster features and their long per-cluster table, without parsing the feats csv.
+    """
+    clusters = EHF.read_cluster_features(os.path.join(folder, f'{name}_clusters.npz'))
+    return clusters, EHF.cluster_table(clusters)
+
+
+# columns of the tidy files kept as categoricals, other numeric columns are downcast
+CATEGORICAL_COLUMNS = ['sample_id', 'donor_id', 'ReferenceRegion', 'group', 'Chromosome']
+TIDY_CHUNKSIZE = 1_000_000
+
+
+def compactValues(s):
+    """
+    Smallest dtype holding a numeric column: a small integer if all values are integers, else float32.
+    """
+    if s.dtype.kind not in 'fiu':
+        return s
+    if s.notna().all() and (s == s.round()).all():
+        return pd.to_numeric(s, downcast='integer')
+    return s.astype(np.float32)
+
+
+def regionColumns(regions):
+    """
+    Chromosome, Start and End of ReferenceRegion strings (chrom:start-end).
+    For a categorical only the categories are parsed, then mapped onto the rows through the codes.
+    """
+    regions = pd.Series(regions).astype('category')
+    parsed = regions.cat.categories.to_series().str.extract(r'^([^:]+):(\d+)-(\d+)$')
+    codes = regions.cat.codes.values
+    missing = codes < 0
+    chroms = pd.Categorical(parsed[0])
+    chrom = pd.Categorical.from_codes(np.where(missing, -1, chroms.codes[codes]), chroms.categories)
+    # unparsable regions get -1 coordinates
+    start = np.where(missing, -1, parsed[1].fillna(-1).astype(np.int64).values[codes]).astype(np.int32)
+    end = np.where(missing, -1, parsed[2].fillna(-1).astype(np.int64).values[codes]).astype(np.int32)
+    return chrom, start, end
+
+
+def splitReferenceRegion(df):
+    df['Chromosome'], df['Start'], df['End'] = regionColumns(df['ReferenceRegion'])
+
+
+def _concatCategorical(parts):
+    df = pd.concat(parts, ignore_index=True)
+    # categories differ between chunks, concat falls back to object
+    for col in df.columns:
+        if col in CATEGORICAL_COLUMNS and df[col].dtype != 'category':
+            df[col] = df[col].astype('category')
+    return df
+
+
+@lru_cache(maxsize=8)
+def _readTidy(path, mtime, regions, samples, chromosomes, columns, split_regions):
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = [c for c in header if columns is None or c in columns or c in ('ReferenceRegion', 'sample_id', 'donor_id')]
+    dtypes = {c: 'category' for c in usecols if c in CATEGORICAL_COLUMNS}
+    sample_col = 'sample_id' if 'sample_id' in header else 'donor_id'
+
+    parts = []
+    for chunk in pd.read_csv(path, usecols=usecols, dtype=dtypes, chunksize=TIDY_CHUNKSIZE):
+        # row filters on each chunk, so filtered out rows never pile up
+        if regions is not None:
+            chunk = chunk[chunk['ReferenceRegion'].isin(regions)]
+        if samples is not None:
+            chunk = chunk[chunk[sample_col].isin(samples)]
+        if split_regions or chromosomes is not None:
+            chunk = chunk.copy()
+            splitReferenceRegion(chunk)
+            if chromosomes is not None:
+                chunk = chunk[chunk['Chromosome'].isin(chromosomes)]
+        for col in chunk.columns:
+            if col not in CATEGORICAL_COLUMNS:
+                chunk[col] = chunk[col].astype(np.float32) if chunk[col].dtype.kind == 'f' else chunk[col]
+        parts.append(chunk)
+
+    df = _concatCategorical(parts) if parts else pd.DataFrame(columns=usecols)
+    for col in df.columns:
+        if col not in CATEGORICAL_COLUMNS:
+            df[col] = compactValues(df[col])
+    if 'Chromosome' in df.columns and not split_regions:
+        df = df.drop(columns=['Chromosome', 'Start', 'End'])
+    if columns is not None:
+        df = df[[c for c in df.columns if c in columns or c in ('Chromosome', 'Start', 'End')]]
+    return df
+
+
+def _key(values):
+    return None if values is None else tuple(sorted(values))
+
+
+def loadTidy(path, regions=None, samples=None, chromosomes=None, columns=None, split_regions=True):
+    """
+    Typed, cached loader of a tidy (long) csv with one row per sample and region.
+    Sample and region columns are categoricals, values are small integers or float32,
+    and the region is pre-split into Chromosome, Start and End.
+    The filters are applied while the file is read in chunks.
+    Results are cached by path, modification time and filters: do not modify them in place.
+    Args:
+        regions, samples, chromosomes: Keep only the rows with these values.
+        columns: Keep only these columns.
+        split_regions: Add the Chromosome, Start and End columns.
+    """
+    return _readTidy(path, os.path.getmtime(path), _key(regions), _key(samples), _key(chromosomes), _key(columns),
+                     split_regions)
+
+
+def loadGenotypes(cancer, **filters):
+    ca_case = loadTidy(f'../data/genotypes/{cancer}_case_tidy.csv', **filters)
+    ca_control = loadTidy(f'../data/genotypes/{cancer}_control_tidy.csv', **filters)
     return ca_case, ca_control
 
-def loadDiffs(cancer):
-    ca_diffs = pd.read_csv(f'../data/diffs/{cancer}_diffs.csv')
+def loadDiffs(cancer, **filters):
+    ca_diffs = loadTidy(f'../data/diffs/{cancer}_diffs.csv', **filters)
     return ca_diffs
 
-def splitReferenceRegion(df):
-    df['Chromosome'], rest = df['ReferenceRegion'].str.split(':', 1).str
-    df['Start'], df['End'] = rest.str.split('-', 1).str
\ No newline at end of file
+
+@lru_cache(maxsize=8)
+def _readMatrix(path, mtime, regions, samples):
+    header = EHF.read_diff_header(path)
+    keep = [c for c in header if regions is None or c in regions]
+    # positions in the file, the sample index is column 0
+    usecols = [0] + [i + 1 for i, c in enumerate(header) if regions is None or c in regions]
+    df = pd.read_csv(path, usecols=usecols, index_col=0, dtype={c: np.float32 for c in keep})
+    if samples is not None:
+        df = df[df.index.isin(samples)]
+    return df
+
+
+def loadMatrix(path, regions=None, samples=None):
+    """
+    Typed, cached loader of a wide cooker matrix (rows as samples, cols as regions) as float32.
+    Only the given regions' columns are parsed. Results are cached: do not modify them in place.
+    """
+    return _readMatrix(path, os.path.getmtime(path), _key(regions), _key(samples))
+
+
+def loadColumnar(dataset, chromosomes=None, columns=None, samples=None):
+    """
+    Read the columnar dataset written by expansionhunter-json-to-ndjson.py --format columnar.
+    Only the partitions of the given chromosomes and the given columns are read.
+    Dictionary encoded columns (sample, region, motif, locus) come back as categoricals.
+    """
+    parts = []
+    for part_dir in sorted(os.listdir(dataset)):
+        if not part_dir.startswith('chrom='):
+            continue
+        chrom = part_dir[len('chrom='):]
+        if chromosomes is not None and chrom not in chromosomes:
+            continue
+        for part in sorted(os.listdir(os.path.join(dataset, part_dir))):
+            if not part.endswith('.npz'):
+                continue
+            with np.load(os.path.join(dataset, part_dir, part)) as data:
+                names = [key for key in data.files if not key.endswith('_dictionary')]
+                df = pd.DataFrame({'chrom': chrom}, index=range(len(data['sample'])))
+                for key in (names if columns is None else [c for c in names if c in columns or c == 'sample']):
+                    if f'{key}_dictionary' in data.files:
+                        df[key] = pd.Categorical.from_codes(data[key], data[f'{key}_dictionary'])
+                    else:
+                        df[key] = data[key]
+            if samples is not None:
+                df = df[df['sample'].isin(samples)]
+            parts.append(df)
+    if not parts:
+        return pd.DataFrame()
+    df = pd.concat(parts, ignore_index=True)
+    # dictionaries are per part, unify them so the columns stay categorical
+    for key in df.columns:
+        if df[key].dtype == object:
+            df[key] = df[key].astype('category')
+    return df
@@ -9,10 +9,18 @@
 # SBATCH --mem=16G
 # SBATCH --time=24:00:00
 
-# --- Configuration
+import argparse
+import csv
+import os
+import time
+from glob import glob
+from multiprocessing import Pool, cpu_count
+from pathlib import Path
 
-# Adjust this to the number of cores available
-CORES = 32
+import numpy as np
+import orjson
+
+# --- Defaults
 
 # Directory where NDJSONs should be placed
 OUTPUT_DIR = "data/ndjson/"
@@ -20,67 +28,363 @@ OUTPUT_DIR = "data/ndjson/"
 # Wildcard path to ExpansionHunter JSON outputs. Each file's name is assumed to be the sample name
 INPUT_FILES = "exams/*.json"
 
-# Path to JQ command line tool binary
-# Leave as the default if the tool is available in your environment
-# Note: in HPC systems where you need to run `module load jq` to access the binary, simply
-# load it into your environment and then use the output of `which jq` as the path to the binary
-JQ_BIN = "jq"
-
 # --- End
 
-import os
-from glob import glob
-from pathlib import Path
 
+def variant_records(sample_id, data, reads=False):
+    """Yields one record per variant of an ExpansionHunter output.
+    Each record holds the sample ID, genotype, motif and reference region.
+    With `reads`, it also holds the locus, allele count, genotype confidence
+    interval and read counts, which is everything ExpansionCooker needs
+    to genotype a pair.
+    """
+    for locus_id, locus in data["LocusResults"].items():
+        for variant_id, variant in locus.get("Variants", {}).items():
+            record = {
+                "sample": sample_id,
+                "genotype": variant.get("Genotype"),
+                "motif": variant.get("RepeatUnit"),
+                "region": variant.get("ReferenceRegion"),
+            }
+            if reads:
+                record.update({
+                    "locus": locus_id,
+                    "variant": variant_id,
+                    "allele_count": locus.get("AlleleCount"),
+                    "ci": variant.get("GenotypeConfidenceInterval"),
+                    "spanning_reads": variant.get("CountsOfSpanningReads"),
+                    "flanking_reads": variant.get("CountsOfFlankingReads"),
+                    "inrepeat_reads": variant.get("CountsOfInrepeatReads"),
+                })
+            yield record
 
-def convert(sample_id, in_path, out_path):
-    """Runs the JQ command line tool to convert a single JSON to NDJSON.
-    The JQ syntax first accesses the `LocusResults` key in the output.
-    Then, filters out the `Variants`. It includes only the sample ID,
-    genotype, motif and reference region for each variant. Each entry
-    in the ND-JSON file is a JSON object suffixed by a new line--hence
-    the newline delimited format.
+
+def convert(sample_id, in_path, out_path, reads=False):
+    """Converts a single JSON to NDJSON in-process.
+    Each entry in the ND-JSON file is a JSON object suffixed by a new
+    line--hence the newline delimited format. The output is written to a
+    temporary file first, so an interrupted run never leaves a partial
+    NDJSON that looks up to date.
     """
-    cmd = f"cat {in_path} | {JQ_BIN} -c '.LocusResults[] | .Variants[] | {{ sample: \"{sample_id}\", genotype: .Genotype, motif: .RepeatUnit, region: .ReferenceRegion }}' > {out_path}"
-    return os.system(cmd)
+    with open(in_path, "rb") as f:
+        data = orjson.loads(f.read())
 
+    tmp_path = f"{out_path}.tmp"
+    try:
+        with open(tmp_path, "wb") as out:
+            for record in variant_records(sample_id, data, reads):
+                out.write(orjson.dumps(record))
+                out.write(b"\n")
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-if __name__ == "__main__":
-    # first, find all samples present in the input directory
-    samples = []
-    for p in glob(INPUT_FILES):
-        # extract sample name from path
-        sample_id = p.split("/")[-1].split(".")[0]
-        samples.append((sample_id, p))
-
-    # for each core, chunk the list of inputs and run the conversion
-    chunk_size = len(samples) // CORES + 1
-    for i in range(CORES):
-        pid = os.fork()
-        if pid > 0:
-            # we are in the parent process, proceed to launch next process
+
+def parse_pair(value, sep):
+    """Splits an EH "a/b" genotype or "lo-hi" interval into integers, -1 if missing."""
+    if not value:
+        return [-1, -1]
+    parts = [int(v) for v in value.split(sep)]
+    return parts + [-1] * (2 - len(parts))
+
+
+def columnar_records(sample_id, data, reads=False):
+    """Columns of one ExpansionHunter output as numpy arrays, one row per variant.
+    Allele lengths are integers (-1 when missing) instead of "a/b" strings,
+    with `reads` the confidence intervals are integers as well. Strings are
+    UTF-8 bytes, a byte per character, and the sample is left to the writer.
+    """
+    cols = {key: [] for key in ["chrom", "region", "motif", "allele1", "allele2"]}
+    if reads:
+        cols.update({key: [] for key in ["locus", "allele_count", "ci1_lo", "ci1_hi", "ci2_lo", "ci2_hi",
+                                         "spanning_reads", "flanking_reads"]})
+    for record in variant_records(sample_id, data, reads):
+        region = record["region"] or ""
+        cols["chrom"].append(region.split(":")[0])
+        cols["region"].append(region)
+        cols["motif"].append(record["motif"] or "")
+        allele1, allele2 = parse_pair(record["genotype"], "/")
+        cols["allele1"].append(allele1)
+        cols["allele2"].append(allele2)
+        if reads:
+            cols["locus"].append(record["locus"])
+            cols["allele_count"].append(record["allele_count"] or 0)
+            ci = (record["ci"] or "").split("/") + [""]
+            for i, interval in enumerate(ci[:2], 1):
+                lo, hi = parse_pair(interval, "-")
+                cols[f"ci{i}_lo"].append(lo)
+                cols[f"ci{i}_hi"].append(hi)
+            cols["spanning_reads"].append(record["spanning_reads"] or "")
+            cols["flanking_reads"].append(record["flanking_reads"] or "")
+    return {key: np.array(values, dtype=INT_COLUMNS[key]) if key in INT_COLUMNS
+            else np.char.encode(np.array(values, dtype=str), "utf-8") for key, values in cols.items()}
+
+
+# Columns stored as codes into a per-part dictionary
+DICTIONARY_COLUMNS = ["sample", "region", "motif", "locus"]
+INT_COLUMNS = {"allele1": np.int32, "allele2": np.int32, "allele_count": np.int8,
+               "ci1_lo": np.int32, "ci1_hi": np.int32, "ci2_lo": np.int32, "ci2_hi": np.int32}
+
+
+class ColumnarWriter:
+    """Appends converted samples to a columnar dataset partitioned by chromosome.
+    Samples are buffered as the arrays of columnar_records and every `batch_size`
+    samples one part per chromosome is written to OUTDIR/chrom=<chrom>/part-<batch>.npz.
+    New samples are appended by later runs; the rows of a re-converted sample are removed
+    from the older parts once its new rows are written. Converted samples, with or without
+    variants, are listed in OUTDIR/_samples.txt with the mtime of their JSON so re-runs can skip them.
+    """
+
+    def __init__(self, outdir, batch_size, recorded=()):
+        self.outdir = outdir
+        self.batch_size = batch_size
+        self.recorded = set(recorded)
+        self.buffer = []
+        self.batch_id = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+        self.num_parts = 0
+
+    def add(self, sample_id, mtime, cols):
+        self.buffer.append((sample_id, mtime, cols))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        sample_ids = np.array([sample_id for sample_id, _, _ in self.buffer], dtype=str)
+        counts = [len(cols["region"]) for _, _, cols in self.buffer]
+        # sample of every row as its rank among the sample ids, so codes follow the dictionary order
+        order = np.argsort(sample_ids, kind="stable")
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+        sample_ranks = np.repeat(ranks, counts)
+
+        keys = [key for key in self.buffer[0][2] if key != "chrom"]
+        merged = {key: np.concatenate([cols[key] for _, _, cols in self.buffer]) for key in keys}
+        chroms = np.concatenate([cols["chrom"] for _, _, cols in self.buffer])
+        for chrom in np.unique(chroms):
+            rows = chroms == chrom
+            arrays = {}
+            for key, values in merged.items():
+                values = values[rows]
+                if key in DICTIONARY_COLUMNS:
+                    dictionary, codes = np.unique(values, return_inverse=True)
+                    arrays[key] = codes.astype(np.int32)
+                    arrays[f"{key}_dictionary"] = np.char.decode(dictionary, "utf-8")
+                elif key in INT_COLUMNS:
+                    arrays[key] = values
+                else:
+                    arrays[key] = np.char.decode(values, "utf-8")
+            present, codes = np.unique(sample_ranks[rows], return_inverse=True)
+            arrays["sample"] = codes.astype(np.int32)
+            arrays["sample_dictionary"] = sample_ids[order][present]
+
+            part_dir = os.path.join(self.outdir, f"chrom={np.char.decode(chrom, 'utf-8')}")
+            os.makedirs(part_dir, exist_ok=True)
+            part_path = os.path.join(part_dir, f"part-{self.batch_id}-{self.num_parts:05d}.npz")
+            write_part(part_path, arrays)
+        self.num_parts += 1
+
+        # old rows go only after the new ones are written, and samples are listed last, so an
+        # interrupted flush is redone by the next run
+        replaced = {sample_id for sample_id, _, _ in self.buffer} & self.recorded
+        if replaced:
+            remove_samples(self.outdir, replaced, keep=f"part-{self.batch_id}-")
+        with open(os.path.join(self.outdir, "_samples.txt"), "a") as f:
+            for sample_id, mtime, _ in self.buffer:
+                f.write(f"{sample_id}\t{mtime!r}\n")
+        self.buffer = []
+
+
+def write_part(part_path, arrays):
+    with open(part_path + ".tmp", "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(part_path + ".tmp", part_path)
+
+
+def remove_samples(outdir, samples, keep=""):
+    """Rewrites the parts of a columnar dataset without the rows of the given samples,
+    except the parts whose names start with `keep`. Parts left without rows are deleted.
+    """
+    samples = np.array(sorted(samples), dtype=str)
+    for part_path in glob(os.path.join(outdir, "chrom=*", "part-*.npz")):
+        if keep and os.path.basename(part_path).startswith(keep):
+            continue
+        with np.load(part_path) as data:
+            if not np.isin(data["sample_dictionary"], samples).any():
+                continue
+            arrays = {key: data[key] for key in data.files}
+        rows = ~np.isin(arrays["sample_dictionary"][arrays["sample"]], samples)
+        if not rows.any():
+            os.remove(part_path)
             continue
+        for key in [key for key in arrays if not key.endswith("_dictionary")]:
+            arrays[key] = arrays[key][rows]
+            if f"{key}_dictionary" in arrays:
+                used, codes = np.unique(arrays[key], return_inverse=True)
+                arrays[key] = codes.astype(np.int32)
+                arrays[f"{key}_dictionary"] = arrays[f"{key}_dictionary"][used]
+        write_part(part_path, arrays)
+
+
+def converted_samples(outdir):
+    """JSON mtime of every sample in a columnar dataset, from OUTDIR/_samples.txt.
+    The last line of a sample wins; lines without an mtime (older datasets) give None.
+    """
+    path = os.path.join(outdir, "_samples.txt")
+    samples = {}
+    if not os.path.exists(path):
+        return samples
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0]:
+                samples[fields[0]] = float(fields[1]) if len(fields) > 1 else None
+    return samples
+
+
+def columnar_task(task):
+    sample_id, in_path, reads = task
+    try:
+        mtime = os.path.getmtime(in_path)
+        with open(in_path, "rb") as f:
+            data = orjson.loads(f.read())
+        return sample_id, in_path, "converted", "", mtime, columnar_records(sample_id, data, reads)
+    except Exception as e:
+        return sample_id, in_path, "failed", f"{type(e).__name__}: {e}", None, None
+
+
+def has_read_fields(out_path):
+    """Whether an NDJSON was converted with `reads`, from the fields of its first record.
+    None for an NDJSON without records.
+    """
+    with open(out_path, "rb") as f:
+        for line in f:
+            if line.strip():
+                return "allele_count" in orjson.loads(line)
+    return None
+
+
+def is_up_to_date(in_path, out_path, reads=False):
+    """Whether the NDJSON is newer than the JSON and has the fields asked for by `reads`."""
+    if not os.path.exists(out_path) or os.path.getmtime(out_path) < os.path.getmtime(in_path):
+        return False
+    return has_read_fields(out_path) == reads
+
+
+def convert_task(task):
+    sample_id, in_path, out_path, reads = task
+    try:
+        convert(sample_id, in_path, out_path, reads)
+        return sample_id, in_path, "converted", ""
+    except Exception as e:
+        return sample_id, in_path, "failed", f"{type(e).__name__}: {e}"
+
+
+def find_samples(patterns):
+    samples = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.json")
+        for p in sorted(glob(pattern)):
+            # extract sample name from path
+            sample_id = os.path.basename(p).split(".")[0]
+            samples.append((sample_id, p))
+    return samples
+
+
+def write_report(path, rows):
+    # csv quotes paths and errors with commas, quotes or newlines
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["sample", "path", "status", "error"])
+        writer.writerows(rows)
+
+
+def init_argparse():
+    parser = argparse.ArgumentParser(description="Convert ExpansionHunter JSON outputs to NDJSON.")
+    parser.add_argument("inputs", metavar="Input", nargs="*", default=[INPUT_FILES],
+                        help=f"JSON files, wildcard paths or directories of JSONs. (default: {INPUT_FILES})")
+    parser.add_argument("--outdir", "-o", default=OUTPUT_DIR, help=f"Directory where NDJSONs are placed. (default: {OUTPUT_DIR})")
+    parser.add_argument("--processes", "-p", type=int, default=None,
+                        help="Number of worker processes. (default: SLURM_CPUS_PER_TASK or all cpus)")
+    parser.add_argument("--reads", default=False, action="store_true",
+                        help="Include the locus, allele count, confidence interval and read count fields needed by ExpansionCooker.")
+    parser.add_argument("--force", default=False, action="store_true", help="Convert even if the NDJSON is newer than the JSON, or the columnar dataset has the sample.")
+    parser.add_argument("--format", default="ndjson", choices=["ndjson", "columnar"],
+                        help="ndjson: one NDJSON per sample. columnar: append to a dataset in OUTDIR partitioned by chromosome. (default: ndjson)")
+    parser.add_argument("--batch-size", type=int, default=500, help="Samples per part of the columnar dataset. (default: 500)")
+    parser.add_argument("--report", default=None, help="Path of the conversion report. (default: OUTDIR/conversion_report.csv)")
+    return parser
+
+
+def main():
+    args = init_argparse().parse_args()
+    os.makedirs(args.outdir, exist_ok=True)
+    processes = args.processes or int(os.getenv("SLURM_CPUS_PER_TASK") or cpu_count())
+
+    if args.format == "columnar":
+        return main_columnar(args, processes)
+
+    # first, find all samples present in the inputs
+    tasks, report = [], []
+    for sample_id, in_path in find_samples(args.inputs):
+        out_path = str(Path(args.outdir) / (sample_id + ".ndjson"))
+        if not args.force and is_up_to_date(in_path, out_path, args.reads):
+            report.append((sample_id, in_path, "up to date", ""))
+        else:
+            tasks.append((sample_id, in_path, out_path, args.reads))
+
+    print(f"Converting {len(tasks)} samples on {processes} processes ({len(report)} up to date)", flush=True)
+
+    # one file per task, idle workers pick up the next file as soon as they finish
+    with Pool(processes=processes) as pool:
+        for j, row in enumerate(pool.imap_unordered(convert_task, tasks, chunksize=1), 1):
+            report.append(row)
+            if row[2] == "failed":
+                print(f"Failed {row[0]}: {row[3]}", flush=True)
+            if j % 100 == 0:
+                print(f"Progress {j}/{len(tasks)} samples", flush=True)
+
+    return finish(args, report)
+
+
+def main_columnar(args, processes):
+    # a sample is up to date while its JSON keeps the recorded mtime, else its rows are replaced
+    recorded = converted_samples(args.outdir)
+    tasks, report = [], []
+    for sample_id, in_path in find_samples(args.inputs):
+        if not args.force and sample_id in recorded and recorded[sample_id] == os.path.getmtime(in_path):
+            report.append((sample_id, in_path, "up to date", ""))
         else:
-            # we are in the child process, start converting inputs
-            start = i * chunk_size
-            batch = samples[start : start + chunk_size]
+            tasks.append((sample_id, in_path, args.reads))
 
-            print(
-                f"[Core {i + 1}] Beginning to process {len(batch)} samples", flush=True
-            )
+    print(f"Appending {len(tasks)} samples to {args.outdir} on {processes} processes ({len(report)} up to date)", flush=True)
 
-            for j, (sample_id, in_path) in enumerate(batch):
-                if j % 10 == 0:
-                    print(f"[Core {i + 1}] Progress {j}/{len(batch)} samples", flush=True)
-                out_path = Path(OUTPUT_DIR) / (sample_id + ".ndjson")
-                convert(sample_id, in_path, str(out_path))
+    writer = ColumnarWriter(args.outdir, args.batch_size, recorded)
+    with Pool(processes=processes) as pool:
+        for j, (sample_id, in_path, status, error, mtime, cols) in enumerate(pool.imap_unordered(columnar_task, tasks, chunksize=1), 1):
+            report.append((sample_id, in_path, status, error))
+            if status == "failed":
+                print(f"Failed {sample_id}: {error}", flush=True)
+            else:
+                writer.add(sample_id, mtime, cols)
+            if j % 100 == 0:
+                print(f"Progress {j}/{len(tasks)} samples", flush=True)
+    writer.flush()
 
-            # when finished, exit the child process
-            print(f"[Core {i + 1}] Finished", flush=True)
-            exit()
+    return finish(args, report)
 
-    # make the parent process wait for all child proccesses
-    for _ in range(CORES):
-        os.wait()
 
-    print(f"All input files converted. Exiting.", flush=True)
+def finish(args, report):
+    report_path = args.report or os.path.join(args.outdir, "conversion_report.csv")
+    write_report(report_path, report)
+
+    num_failed = sum(row[2] == "failed" for row in report)
+    print(f"All input files processed, {num_failed} failed. Report: {report_path}", flush=True)
+    return 1 if num_failed else 0
+
+
+if __name__ == "__main__":
+    exit(main())